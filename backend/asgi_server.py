@@ -0,0 +1,187 @@
+# ASGI serving mode for the API.
+#
+# /api/generate waits on its job future inside the event loop instead of
+# holding an OS thread for up to 60 seconds, so one process can keep thousands
+# of generations in flight. Token checks and Telegram uploads run in the
+# default executor. The remaining short routes (register, verify, refresh,
+# user/tokens, ...) are served by the Flask app through a bounded WSGI thread
+# pool, which keeps their Firestore calls off the event loop as well.
+#
+# Run with:  python asgi_server.py
+#       or:  uvicorn asgi_server:app --host 0.0.0.0 --port 5001
+import os
+import asyncio
+import contextlib
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import final_server
+from final_server import (
+    GENERATION_TIMEOUT,
+    PORT,
+    WORKER_ID,
+    charge_request,
+    health_payload,
+    idempotency_store,
+    idempotent_replay_payload,
+    job_coalescer,
+    release_idempotency_key,
+    send_image_to_telegram_bot,
+    verify_token,
+)
+from styles import styles
+
+# Threads serving the Flask-backed routes
+WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 16))
+
+
+def respond(body, status=200):
+    """JSON response with the same CORS header Flask-CORS adds"""
+    return JSONResponse(body, status_code=status, headers={'Access-Control-Allow-Origin': '*'})
+
+
+def authenticate(request):
+    """Async counterpart of final_server.token_required; returns (user, error_response)"""
+    auth_header = request.headers.get('Authorization')
+    token = None
+
+    if auth_header:
+        try:
+            token = auth_header.split(' ')[1]  # Bearer <token>
+        except IndexError:
+            return None, respond({'message': 'Invalid token format'}, 401)
+
+    if not token:
+        return None, respond({'message': 'Token is missing'}, 401)
+
+    payload = verify_token(token, 'access')
+    if not payload:
+        return None, respond({'message': 'Token is invalid or expired'}, 401)
+
+    return {'id': payload['user_id'], 'role': payload['role']}, None
+
+
+async def wait_for_job(job_future, timeout=GENERATION_TIMEOUT):
+    """Await a concurrent.futures.Future without cancelling it on timeout.
+
+    Coalesced and idempotent requests share the same future, so one caller
+    giving up must not cancel it for the others.
+    """
+    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job_future)), timeout)
+
+
+async def generate_image(request):
+    """Generate image using the job queue with token validation."""
+    user, error_response = authenticate(request)
+    if error_response:
+        return error_response
+
+    idempotency_record = None
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data or not data.get('prompt'):
+            return respond({'message': 'Prompt is required'}, 400)
+
+        prompt = data['prompt']
+        style = data.get('style')
+        user_id = user['id']
+
+        # Validate style
+        if not style or style not in styles:
+            style = styles[0]  # Use first style as default
+
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            store_key = idempotency_store.make_key(user_id, idempotency_key)
+            idempotency_record, is_new_key = idempotency_store.reserve(store_key, prompt, style)
+            if not is_new_key:
+                print(f"Replaying idempotent request {idempotency_key} for user {user_id}")
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await wait_for_job(idempotency_record.future)
+                body, status = idempotent_replay_payload(idempotency_record)
+                return respond(body, status)
+
+        # Check and consume one token, unless a failed attempt with this key already paid
+        token_error = await asyncio.to_thread(charge_request, user_id, idempotency_record)
+        if token_error:
+            body, status = token_error
+            return respond(body, status)
+
+        job_future, is_new_job = job_coalescer.submit(prompt, style)
+        if idempotency_record is not None:
+            idempotency_record.attach(job_future)
+        if not is_new_job:
+            print(f"Request from user {user_id} attached to pending identical job")
+
+        try:
+            image_b64 = await wait_for_job(job_future)
+        except asyncio.TimeoutError:
+            print(f"Image generation timed out for user {user_id}, token may need refund")
+            return respond({'message': 'Image generation timed out'}, 500)
+
+        if not image_b64:
+            print(f"Image generation failed for user {user_id}, token may need refund")
+            return respond({'message': 'Image generation failed'}, 500)
+
+        if is_new_job:
+            telegram_success = await asyncio.to_thread(send_image_to_telegram_bot, image_b64, prompt, style)
+            if not telegram_success:
+                print(f"Failed to send image to Telegram for user {user_id}")
+
+        print(f"Image generated successfully for user {user_id}")
+
+        return respond({
+            'message': 'Image generated successfully',
+            'image': image_b64,
+            'prompt': prompt,
+            'style': style
+        }, 200)
+
+    except Exception as e:
+        print(f"Error in generate_image: {e}")
+        release_idempotency_key(idempotency_record)
+        return respond({'message': 'Internal server error'}, 500)
+
+
+async def get_styles(request):
+    """Get available image generation styles"""
+    return respond({
+        'styles': list(styles),
+        'count': len(styles)
+    }, 200)
+
+
+async def health_check(request):
+    """Health check endpoint"""
+    body = health_payload()
+    body['serving_mode'] = 'asgi'
+    return respond(body, 200)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    final_server.start_gen_worker()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route('/api/generate', generate_image, methods=['POST']),
+        Route('/api/styles', get_styles, methods=['GET']),
+        Route('/api/health', health_check, methods=['GET']),
+        # Everything else (including CORS preflights) is served by Flask
+        Mount('/', app=WSGIMiddleware(final_server.app, workers=WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    print(f"Starting ASGI server worker {WORKER_ID} on port {PORT}...")
+    uvicorn.run(app, host='0.0.0.0', port=PORT, log_level='info')
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Driver backend benchmark: per-job control overhead of Selenium vs direct CDP.
+
+Builds one Gen with GEN_DRIVER_BACKEND=cdp (its chromedriver session stays
+usable, so both paths drive the same page) and times the steps a job performs
+besides waiting for the image: selecting the style and entering the prompt,
+and one pass over the result frames.
+
+    python bench_cdp_driver.py --rounds 20
+
+--full N additionally runs N complete generations per backend through Gen.play.
+"""
+
+import argparse
+import statistics
+import time
+
+from gen import Gen, GENERATOR_IFRAME_XPATH, RESULT_IFRAME_XPATH, RESULT_IMAGE_XPATH
+from styles import styles
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def selenium_prepare(gen, prompt, style):
+    gen.set_style(style)
+    gen.enter_prompt(prompt)
+
+
+def selenium_scan_results(gen, count=6):
+    for i in range(count):
+        try:
+            gen.driver.switch_to.frame(gen.driver.find_element("xpath", RESULT_IFRAME_XPATH.format(index=i + 1)))
+            gen.driver.find_element("xpath", RESULT_IMAGE_XPATH).get_attribute("src")
+        except Exception:
+            pass
+        gen.driver.switch_to.default_content()
+        gen.driver.switch_to.frame(gen.driver.find_element("xpath", GENERATOR_IFRAME_XPATH))
+
+
+def cdp_scan_results(gen):
+    # A single pass with an already expired deadline still reads each frame once
+    gen.cdp_scrape_results(timeout=0.001)
+
+
+def summarize(label, samples):
+    if not samples:
+        print(f"{label:<28} {'n/a':>9}")
+        return
+    print(f"{label:<28} {statistics.mean(samples) * 1000:>9.1f} {statistics.median(samples) * 1000:>9.1f} "
+          f"{max(samples) * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=20, help='Timed repetitions of each step')
+    parser.add_argument('--full', type=int, default=0, help='Complete generations per backend')
+    args = parser.parse_args()
+
+    gen = Gen(worker_id='bench-cdp', driver_backend='cdp')
+    try:
+        if gen.cdp is None:
+            print(f"DevTools backend unavailable: {gen.init_error or gen.cdp_error}")
+            return
+        cdp = gen.cdp
+        results = {key: [] for key in ('selenium_prepare', 'cdp_prepare', 'selenium_scan', 'cdp_scan')}
+        for round_number in range(args.rounds):
+            style = styles[round_number % len(styles)]
+            prompt = f"benchmark prompt {round_number}"
+            results['selenium_prepare'].append(timed(lambda: selenium_prepare(gen, prompt, style)))
+            results['cdp_prepare'].append(timed(lambda: gen.cdp_prepare(prompt, style)))
+            results['selenium_scan'].append(timed(lambda: selenium_scan_results(gen)))
+            results['cdp_scan'].append(timed(lambda: cdp_scan_results(gen)))
+
+        for backend in ('selenium', 'cdp'):
+            results[f'{backend}_full_job'] = []
+            gen.cdp = cdp if backend == 'cdp' else None
+            for job in range(args.full):
+                started = time.perf_counter()
+                image = gen.play(f"benchmark image {job}", styles[0])
+                if image:
+                    results[f'{backend}_full_job'].append(time.perf_counter() - started)
+        gen.cdp = cdp
+
+        print()
+        print(f"{'step':<28} {'mean ms':>9} {'p50 ms':>9} {'max ms':>9}")
+        for key, samples in results.items():
+            summarize(key, samples)
+    finally:
+        if gen.cdp is not None:
+            gen.cdp.close()
+        if gen.driver is not None:
+            gen.driver.quit()
+
+
+if __name__ == '__main__':
+    main()
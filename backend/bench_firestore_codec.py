@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Firestore codec benchmark: the schema codec against the if/elif converters
+FirestoreService uses.
+
+Encodes and decodes realistic user profile documents (a bare token read, a full
+profile, a profile with nested map and array fields) and reports microseconds
+per document for each converter. The service keeps its converters unless the
+codec measures faster on the token and profile documents:
+
+    python bench_firestore_codec.py --iterations 20000
+"""
+
+import argparse
+import timeit
+
+from firestore_codec import user_profile_codec
+from firestore_service import FirestoreService
+
+service_encode = FirestoreService._convert_to_firestore_fields
+service_decode = FirestoreService._convert_firestore_doc
+
+
+PROFILE = {
+    'uid': 'Xk3lQ9sVt2bN8mYwP4aZ1cR7',
+    'email': 'someone@example.com',
+    'name': 'Some One',
+    'photoUrl': 'https://lh3.googleusercontent.com/a/ACg8ocK-example=s96-c',
+    'tokenCount': 42,
+    'createdAt': '2024-01-01T00:00:00Z',
+    'updatedAt': '2024-06-30T12:34:56.789000Z',
+}
+
+DOCUMENTS = {
+    'token only': {'tokenCount': 42},
+    'profile': PROFILE,
+    'nested': dict(PROFILE, verified=True, settings={'nsfw': False, 'style': 'anime', 'quality': 0.9},
+                   recentStyles=['anime', 'photo', 'painting']),
+}
+
+
+def bench(label, function, argument, iterations):
+    seconds = min(timeit.repeat(lambda: function(argument), number=iterations, repeat=3))
+    return seconds / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help='Conversions per measurement')
+    args = parser.parse_args()
+
+    print(f"{'document':<12} {'op':<7} {'service us':>10} {'codec us':>10} {'speedup':>8}")
+    for name, data in DOCUMENTS.items():
+        encoded = user_profile_codec.encode(data)
+        for op, service, codec, argument in (('encode', service_encode, user_profile_codec.encode, data),
+                                             ('decode', service_decode, user_profile_codec.decode, encoded)):
+            service_us = bench(name, service, argument, args.iterations)
+            codec_us = bench(name, codec, argument, args.iterations)
+            print(f"{name:<12} {op:<7} {service_us:>10.2f} {codec_us:>10.2f} {service_us / codec_us:>7.2f}x")
+
+    print()
+    sample = DOCUMENTS['nested']
+    print("Codec round trip matches input:", user_profile_codec.decode(user_profile_codec.encode(sample)) == sample)
+    print("Service round trip matches input:", service_decode(service_encode(sample)) == sample)
+
+
+if __name__ == '__main__':
+    main()
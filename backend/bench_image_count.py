@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Image count benchmark: generation time against results rendered per click.
+
+Builds one Gen and runs --jobs generations at each image count, asking for that
+many variants so the page's image-count setting is changed between rounds.
+The DOM capture path always waits a fixed 15 seconds before scanning, so use
+--capture network to see the full effect on completion time:
+
+    python bench_image_count.py --counts 6 1 --jobs 5 --capture network
+"""
+
+import argparse
+import statistics
+import time
+
+from gen import Gen
+from styles import styles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[6, 1], help='Images per click to compare')
+    parser.add_argument('--jobs', type=int, default=5, help='Generations per image count')
+    parser.add_argument('--capture', choices=['dom', 'network'], default=None, help='Image capture mode')
+    args = parser.parse_args()
+
+    gen = Gen(worker_id='bench-image-count', capture_mode=args.capture)
+    try:
+        if not gen.is_ready():
+            print(f"Initialization failed: {gen.init_error}")
+            return
+        rows = []
+        for count in args.counts:
+            durations = []
+            for job in range(args.jobs):
+                started = time.perf_counter()
+                image = gen.play(f"benchmark image {job}", styles[0], count)
+                if image:
+                    durations.append(time.perf_counter() - started)
+            if not gen.image_count_supported:
+                print("The page exposes no image count setting (set GEN_IMAGE_COUNT_XPATH); results are not comparable")
+            rows.append((count, durations))
+
+        print()
+        print(f"{'images':>6} {'ok':>4} {'mean s':>8} {'p50 s':>8} {'max s':>8}")
+        for count, durations in rows:
+            if not durations:
+                print(f"{count:>6} {0:>4} {'n/a':>8} {'n/a':>8} {'n/a':>8}")
+                continue
+            print(f"{count:>6} {len(durations):>4} {statistics.mean(durations):>8.1f} "
+                  f"{statistics.median(durations):>8.1f} {max(durations):>8.1f}")
+    finally:
+        gen.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Resource blocking benchmark: what CDP request blocking saves per Gen worker.
+
+Builds Gen browsers alternately with and without GEN_BLOCKED_URLS applied and
+compares generator page load time, transferred bytes, initialization time and
+browser RSS after initialization. Each Gen runs the full initialization
+(including one test generation), so this takes a few minutes:
+
+    python bench_resource_blocking.py --rounds 3
+
+Patterns come from GEN_BLOCKED_URLS / GEN_ALLOWED_URLS, same as the server.
+"""
+
+import argparse
+import statistics
+
+from gen import Gen
+
+
+def build_and_measure(worker_id, block_resources):
+    gen = Gen(worker_id=worker_id, block_resources=block_resources)
+    try:
+        if not gen.is_ready():
+            print(f"{worker_id}: initialization failed: {gen.init_error}")
+            return None
+        page = gen.page_metrics or {}
+        return {
+            'load_ms': page.get('load_ms'),
+            'transfer_kb': page.get('transfer_kb'),
+            'resources': page.get('resources'),
+            'init_seconds': gen.init_seconds,
+            'rss_mb': gen.init_rss_bytes / (1024 * 1024) if gen.init_rss_bytes else None,
+        }
+    finally:
+        if gen.driver is not None:
+            gen.driver.quit()
+
+
+def mean_of(samples, key):
+    values = [sample[key] for sample in samples if sample and sample.get(key) is not None]
+    return statistics.mean(values) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=3, help='Browsers built per configuration')
+    args = parser.parse_args()
+
+    samples = {False: [], True: []}
+    for round_number in range(args.rounds):
+        # Alternate so network conditions affect both configurations alike
+        for block_resources in (False, True):
+            worker_id = f"bench-{'blocked' if block_resources else 'plain'}"
+            print(f"Round {round_number + 1}/{args.rounds}: building {worker_id}")
+            samples[block_resources].append(build_and_measure(worker_id, block_resources))
+
+    print()
+    print(f"{'metric':<14} {'plain':>10} {'blocked':>10} {'saved':>10}")
+    for key in ('load_ms', 'transfer_kb', 'resources', 'init_seconds', 'rss_mb'):
+        plain = mean_of(samples[False], key)
+        blocked = mean_of(samples[True], key)
+        if plain is None or blocked is None:
+            print(f"{key:<14} {'n/a':>10} {'n/a':>10} {'n/a':>10}")
+            continue
+        print(f"{key:<14} {plain:>10.1f} {blocked:>10.1f} {plain - blocked:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Serving benchmark: compare request throughput and latency of running servers.
+
+Start the same API under each serving mode on different ports, e.g.
+
+    PORT=5001 python final_server.py     # Werkzeug app.run
+    PORT=5101 python wsgi_server.py      # gunicorn gthread
+    PORT=5201 python asgi_server.py      # uvicorn
+
+then run
+
+    python bench_serving.py http://localhost:5001 http://localhost:5101 http://localhost:5201
+
+Endpoints default to /api/health and /api/styles, which measure the serving
+stack itself without occupying the browser. Pass --endpoint to add others.
+"""
+
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_load(url, total_requests, concurrency):
+    """Fire total_requests GETs at url from concurrency threads"""
+    local = threading.local()
+
+    def one_request(_):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        session = local.session
+        started = time.perf_counter()
+        try:
+            ok = session.get(url, timeout=30).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one_request, range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for ok, latency in results if ok]
+    return {
+        'ok': len(latencies),
+        'errors': total_requests - len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': (statistics.mean(latencies) * 1000) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('servers', nargs='+', help='Base URLs of running servers')
+    parser.add_argument('--endpoint', action='append', default=None, help='Endpoint path (repeatable)')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint per server')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent client threads')
+    args = parser.parse_args()
+
+    endpoints = args.endpoint or ['/api/health', '/api/styles']
+
+    print(f"{'server':<32} {'endpoint':<16} {'ok':>6} {'err':>5} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for server in args.servers:
+        for endpoint in endpoints:
+            # Warm up connections and lazy initialisation
+            run_load(server + endpoint, min(50, args.requests), min(5, args.concurrency))
+            stats = run_load(server + endpoint, args.requests, args.concurrency)
+            print(f"{server:<32} {endpoint:<16} {stats['ok']:>6} {stats['errors']:>5} "
+                  f"{stats['rps']:>9.1f} {stats['p50_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
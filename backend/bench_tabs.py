@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Tab benchmark: generation throughput and browser RSS against generator tab count.
+
+For each tab count, builds one Gen with that many tabs, runs --jobs generations
+through Gen.play from one thread per tab (as the server does), and reports
+jobs per minute, mean job time and the RSS of the browser process tree.
+
+    python bench_tabs.py --tabs 1 2 3 --jobs 12
+"""
+
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gen import Gen
+from styles import styles
+
+
+def run_jobs(gen, jobs):
+    durations = []
+    failures = 0
+    lock = threading.Lock()
+
+    def one_job(index):
+        nonlocal failures
+        started = time.perf_counter()
+        image = gen.play(f"benchmark image {index}", styles[index % len(styles)])
+        with lock:
+            if image:
+                durations.append(time.perf_counter() - started)
+            else:
+                failures += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=gen.tab_count) as pool:
+        list(pool.map(one_job, range(jobs)))
+    return durations, failures, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tabs', type=int, nargs='+', default=[1, 2, 3], help='Tab counts to compare')
+    parser.add_argument('--jobs', type=int, default=12, help='Generations per tab count')
+    args = parser.parse_args()
+
+    rows = []
+    for tabs in args.tabs:
+        print(f"Building browser with {tabs} tab(s)")
+        gen = Gen(worker_id=f'bench-tabs-{tabs}', tabs=tabs)
+        try:
+            if not gen.is_ready():
+                print(f"{tabs} tab(s): initialization failed: {gen.init_error}")
+                continue
+            idle_rss = gen.measure_rss() or 0
+            durations, failures, elapsed = run_jobs(gen, args.jobs)
+            busy_rss = gen.measure_rss() or 0
+            rows.append((tabs, len(durations), failures, len(durations) / elapsed * 60 if elapsed else 0.0,
+                         statistics.mean(durations) if durations else 0.0,
+                         idle_rss / (1024 * 1024), busy_rss / (1024 * 1024)))
+        finally:
+            if gen.driver is not None:
+                gen.driver.quit()
+
+    print()
+    print(f"{'tabs':>4} {'ok':>4} {'fail':>5} {'jobs/min':>9} {'mean s':>7} {'idle MB':>8} {'after MB':>9}")
+    for tabs, ok, failures, per_minute, mean_seconds, idle_mb, busy_mb in rows:
+        print(f"{tabs:>4} {ok:>4} {failures:>5} {per_minute:>9.1f} {mean_seconds:>7.1f} {idle_mb:>8.0f} {busy_mb:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
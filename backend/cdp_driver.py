@@ -0,0 +1,193 @@
+import json
+import time
+import logging
+import requests
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    # websocket-client; installed with seleniumbase/selenium
+    import websocket
+except ImportError:
+    websocket = None
+
+logger = logging.getLogger(__name__)
+
+# Resolve an XPath in the document of the current execution context
+XPATH_JS = "document.evaluate({xpath}, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue"
+
+class CDPError(Exception):
+    """A DevTools command failed or the connection to Chrome was lost"""
+
+
+class CDPConnection:
+    """Synchronous JSON-RPC client for one DevTools target over a persistent websocket.
+
+    call() sends a command and blocks until its response arrives; events received
+    in the meantime are buffered for wait_for_event().
+    """
+
+    def __init__(self, ws_url: str, timeout: float = 15):
+        if websocket is None:
+            raise CDPError("websocket-client is not installed")
+        self.ws_url = ws_url
+        self.timeout = timeout
+        # Chrome rejects DevTools websockets that send an Origin it was not told to allow
+        self._ws = websocket.create_connection(ws_url, timeout=timeout, suppress_origin=True)
+        self._next_id = 0
+        self._events = deque()
+
+    def _receive(self, timeout: float) -> Optional[Dict[str, Any]]:
+        self._ws.settimeout(max(timeout, 0.01))
+        try:
+            message = self._ws.recv()
+        except websocket.WebSocketTimeoutException:
+            return None
+        except (websocket.WebSocketException, OSError) as e:
+            raise CDPError(f"DevTools connection lost: {e}")
+        return json.loads(message)
+
+    def call(self, method: str, params: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+        self._next_id += 1
+        command_id = self._next_id
+        try:
+            self._ws.send(json.dumps({'id': command_id, 'method': method, 'params': params or {}}))
+        except (websocket.WebSocketException, OSError) as e:
+            raise CDPError(f"DevTools connection lost: {e}")
+
+        deadline = time.time() + (timeout or self.timeout)
+        while time.time() < deadline:
+            message = self._receive(deadline - time.time())
+            if message is None:
+                continue
+            if message.get('id') == command_id:
+                if 'error' in message:
+                    raise CDPError(f"{method}: {message['error'].get('message')}")
+                return message.get('result', {})
+            if 'method' in message:
+                self._events.append(message)
+        raise CDPError(f"{method}: no response after {timeout or self.timeout}s")
+
+    def clear_events(self):
+        self._events.clear()
+
+    def wait_for_event(self, predicate: Callable[[Dict[str, Any]], bool], timeout: float,
+                       should_stop: Optional[Callable[[], bool]] = None, poll_seconds: float = 0.25) -> Optional[Dict[str, Any]]:
+        """First buffered or incoming event matching predicate, or None on timeout"""
+        deadline = time.time() + timeout
+        while True:
+            while self._events:
+                event = self._events.popleft()
+                if predicate(event):
+                    return event
+            if should_stop is not None and should_stop():
+                raise CDPError("stopped while waiting for event")
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            message = self._receive(min(poll_seconds, remaining))
+            if message is not None and 'method' in message:
+                self._events.append(message)
+
+    def close(self):
+        try:
+            self._ws.close()
+        except Exception as e:
+            logger.debug(f"Error closing DevTools websocket: {e}")
+
+
+class CDPPage:
+    """Page automation through a direct DevTools connection instead of chromedriver.
+
+    Elements are addressed by chains of XPaths: every XPath but the last names an
+    iframe, and the expression runs in an isolated world inside that frame, so
+    cross-origin frames are reachable without switching frames.
+    """
+
+    def __init__(self, connection: CDPConnection):
+        self.connection = connection
+        self._contexts: Dict[tuple, int] = {}
+
+    @classmethod
+    def attach(cls, debugger_address: str, url_contains: str, timeout: float = 15) -> 'CDPPage':
+        """Connect to the page target on debugger_address whose URL contains url_contains"""
+        targets = requests.get(f"http://{debugger_address}/json", timeout=timeout).json()
+        for target in targets:
+            if target.get('type') == 'page' and url_contains in target.get('url', ''):
+                return cls(CDPConnection(target['webSocketDebuggerUrl'], timeout=timeout))
+        raise CDPError(f"No page target with URL containing {url_contains!r} on {debugger_address}")
+
+    def evaluate(self, expression: str, context_id: Optional[int] = None, return_by_value: bool = True) -> Any:
+        params = {'expression': expression, 'returnByValue': return_by_value, 'awaitPromise': True}
+        if context_id is not None:
+            params['contextId'] = context_id
+        result = self.connection.call('Runtime.evaluate', params)
+        if 'exceptionDetails' in result:
+            details = result['exceptionDetails']
+            text = details.get('exception', {}).get('description') or details.get('text')
+            raise CDPError(f"Evaluation failed: {text}")
+        value = result.get('result', {})
+        return value.get('value') if return_by_value else value
+
+    def frame_context(self, iframe_xpaths: List[str], cache: bool = True) -> Optional[int]:
+        """Execution context inside the frame reached through iframe_xpaths (None = top document)"""
+        key = tuple(iframe_xpaths)
+        if cache and key in self._contexts:
+            return self._contexts[key]
+
+        context_id = None
+        for xpath in iframe_xpaths:
+            element = self.evaluate(XPATH_JS.format(xpath=json.dumps(xpath)), context_id, return_by_value=False)
+            object_id = element.get('objectId')
+            if not object_id:
+                raise CDPError(f"iframe not found: {xpath}")
+            try:
+                frame_id = self.connection.call('DOM.describeNode', {'objectId': object_id})['node'].get('frameId')
+            finally:
+                self.connection.call('Runtime.releaseObject', {'objectId': object_id})
+            if not frame_id:
+                raise CDPError(f"Element is not a frame: {xpath}")
+            context_id = self.connection.call('Page.createIsolatedWorld', {'frameId': frame_id, 'worldName': 'gen'})['executionContextId']
+
+        if cache:
+            self._contexts[key] = context_id
+        return context_id
+
+    def evaluate_in_frame(self, iframe_xpaths: List[str], expression: str, cache: bool = True) -> Any:
+        """evaluate() inside a frame, rebuilding a cached context once if the frame was reloaded"""
+        try:
+            return self.evaluate(expression, self.frame_context(iframe_xpaths, cache))
+        except CDPError:
+            if not cache or tuple(iframe_xpaths) not in self._contexts:
+                raise
+            self._contexts.pop(tuple(iframe_xpaths), None)
+            return self.evaluate(expression, self.frame_context(iframe_xpaths, cache))
+
+    def insert_text(self, text: str):
+        """Type text into the focused element as a single input event"""
+        self.connection.call('Input.insertText', {'text': text})
+
+    def enable_network(self):
+        self.connection.call('Network.enable', {})
+
+    def wait_for_response_body(self, url_matches: Callable[[str], bool], timeout: float,
+                               should_stop: Optional[Callable[[], bool]] = None) -> Optional[Dict[str, Any]]:
+        """Body of the first image response whose URL matches, once it has finished loading"""
+        candidates = set()
+
+        def is_finished_image(event):
+            params = event.get('params', {})
+            if event.get('method') == 'Network.responseReceived':
+                response = params.get('response', {})
+                if response.get('mimeType', '').startswith('image/') and url_matches(response.get('url', '')):
+                    candidates.add(params.get('requestId'))
+                return False
+            return event.get('method') == 'Network.loadingFinished' and params.get('requestId') in candidates
+
+        event = self.connection.wait_for_event(is_finished_image, timeout, should_stop)
+        if event is None:
+            return None
+        return self.connection.call('Network.getResponseBody', {'requestId': event['params']['requestId']})
+
+    def close(self):
+        self.connection.close()
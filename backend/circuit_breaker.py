@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """Health-tracked circuit breaker for calls to a remote dependency.
+
+    Closed: calls go through and their outcome and latency are recorded. The
+    breaker opens after failure_threshold consecutive failures, or when at
+    least slow_ratio of the last window calls (once min_calls were seen) failed
+    or took longer than slow_call_seconds. Open: allow() is False, so callers
+    skip the dependency at once. After open_seconds the breaker is half-open
+    and lets one probe call through at a time. A successful probe closes it;
+    a failed one opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, slow_call_seconds: float = 2.0,
+                 slow_ratio: float = 0.5, window: int = 20, min_calls: int = 10, open_seconds: float = 15.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_ratio = slow_ratio
+        self.min_calls = min(min_calls, window)
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._consecutive_failures = 0
+        # True for each recent call that failed or was slow
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.trips = 0
+        self.latency_trips = 0
+        self.rejected = 0
+        self.successes = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.last_trip_reason = None
+        self.last_latency_ms = None
+
+    def allow(self) -> bool:
+        """Whether a call may go to the dependency now; a True in half-open state is the probe"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def release_probe(self):
+        """Free the half-open probe slot of a call that ended with no outcome recorded"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def _trip(self, reason: str):
+        """Open the breaker; caller holds the lock"""
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._recent.clear()
+        self.trips += 1
+        self.last_trip_reason = reason
+        logger.warning(f"Circuit {self.name} opened: {reason}")
+
+    def record_success(self, elapsed_seconds: float):
+        with self._lock:
+            self.last_latency_ms = round(elapsed_seconds * 1000, 1)
+            slow = elapsed_seconds > self.slow_call_seconds
+            self.successes += 1
+            self.slow_calls += slow
+            self._consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                if slow:
+                    self.latency_trips += 1
+                    self._trip(f"probe took {self.last_latency_ms} ms")
+                    return
+                self.state = CLOSED
+                self._probing = False
+                logger.info(f"Circuit {self.name} closed")
+                return
+            self._recent.append(slow)
+            self._check_window()
+
+    def record_failure(self, error: Optional[str] = None, elapsed_seconds: Optional[float] = None):
+        with self._lock:
+            if elapsed_seconds is not None:
+                self.last_latency_ms = round(elapsed_seconds * 1000, 1)
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self.state == HALF_OPEN:
+                self._trip(f"probe failed: {error}")
+                return
+            if self.state == OPEN:
+                return
+            self._recent.append(True)
+            if self._consecutive_failures >= self.failure_threshold:
+                self._trip(f"{self._consecutive_failures} consecutive failures, last: {error}")
+                return
+            self._check_window()
+
+    def _check_window(self):
+        """Trip on too many failed or slow calls among the recent ones; caller holds the lock"""
+        if self.state != CLOSED or len(self._recent) < self.min_calls:
+            return
+        bad = sum(self._recent)
+        if bad / len(self._recent) >= self.slow_ratio:
+            self.latency_trips += 1
+            self._trip(f"{bad} of the last {len(self._recent)} calls failed or took over "
+                       f"{self.slow_call_seconds}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'open_for_seconds': round(time.monotonic() - self._opened_at, 1) if self.state != CLOSED else None,
+                'trips': self.trips,
+                'latency_trips': self.latency_trips,
+                'last_trip_reason': self.last_trip_reason,
+                'rejected': self.rejected,
+                'successes': self.successes,
+                'failures': self.failures,
+                'slow_calls': self.slow_calls,
+                'last_latency_ms': self.last_latency_ms
+            }
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from process_journal import ProcessJournal
+
+logger = logging.getLogger(__name__)
+
+# Journal token changes made in the in-memory fallback store and replay them to Firestore
+FALLBACK_LEDGER = int(os.getenv('FALLBACK_LEDGER', 0))
+RECONCILE_INTERVAL_SECONDS = float(os.getenv('FALLBACK_RECONCILE_INTERVAL_SECONDS', 10))
+# Each operation is two writes (increment and operation marker); a commit takes at most 500
+RECONCILE_BATCH_OPS = 250
+
+class FallbackLedger:
+    """Append-only journal of token deltas applied by the in-memory fallback store.
+
+    Every delta gets an operation id and is fsynced to the journal before the
+    store reports success. A background reconciler replays pending operations
+    to Firestore in batched commits. Each operation increments the user's
+    tokenCount and creates users/<uid>/tokenOps/<op id> with an exists=false
+    precondition, so an operation that already reached Firestore is never
+    applied twice, even if the reconciler crashes mid-batch. A replayed debit
+    that takes a count below zero is clamped back to zero.
+
+    The journal is per process (see ProcessJournal) and opened by start(),
+    after the fork; operations in the journals of processes that exited are
+    taken over then.
+    """
+
+    def __init__(self, journal_path: Optional[str] = None, interval: Optional[float] = None):
+        self.journal_path = journal_path
+        self.interval = interval or RECONCILE_INTERVAL_SECONDS
+        self._journal = None
+        # op id -> (user id, delta), oldest first
+        self._pending: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.service = None
+
+        # Metrics
+        self.recorded = 0
+        self.applied = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.failures = 0
+        self.clamped = 0
+        self.last_reconciled_at = None
+
+    def _load(self, path: str):
+        """Add the pending operations journaled at path; caller holds the lock"""
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write; that delta was never acknowledged
+                    logger.warning("Skipping unreadable fallback ledger record")
+                    continue
+                if 'done' in record:
+                    for op_id in record['done']:
+                        self._pending.pop(op_id, None)
+                else:
+                    self._pending[record['op']] = (record['user'], record['delta'])
+
+    def _append(self, record: Dict[str, Any]):
+        """Write one journal record durably; caller holds the lock"""
+        self._journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _compact(self):
+        """Rewrite the journal as the pending operations only; caller holds the lock"""
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as temp:
+            temp.write(''.join(json.dumps({'op': op_id, 'user': user_id, 'delta': delta}, separators=(',', ':')) + '\n'
+                               for op_id, (user_id, delta) in self._pending.items()))
+            temp.flush()
+            os.fsync(temp.fileno())
+        self._journal.close()
+        os.replace(temp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def record(self, user_id: str, delta: int) -> str:
+        """Journal a token delta made in the fallback store; its operation id"""
+        op_id = uuid.uuid4().hex
+        with self._lock:
+            if self._journal is None:
+                raise RuntimeError("Fallback ledger is not started")
+            self._append({'op': op_id, 'user': user_id, 'delta': delta, 'at': round(time.time(), 3)})
+            self._pending[op_id] = (user_id, delta)
+            self.recorded += 1
+        return op_id
+
+    def _writes(self, op_id: str, user_id: str, delta: int) -> List[Dict[str, Any]]:
+        return [
+            {
+                'update': {'name': self.service._document_name(f"users/{user_id}/tokenOps/{op_id}"), 'fields': {
+                    'delta': {'integerValue': str(delta)},
+                    'source': {'stringValue': 'fallback'}
+                }},
+                'updateTransforms': [{'fieldPath': 'appliedAt', 'setToServerValue': 'REQUEST_TIME'}],
+                # Fails if this operation was applied before
+                'currentDocument': {'exists': False}
+            },
+            {
+                'update': {'name': self.service._document_name(f"users/{user_id}")},
+                'updateMask': {'fieldPaths': []},
+                'updateTransforms': [{'fieldPath': 'tokenCount', 'increment': {'integerValue': str(delta)}}],
+                'currentDocument': {'exists': True}
+            }
+        ]
+
+    def _apply_one(self, op_id: str, user_id: str, delta: int) -> str:
+        """Replay one operation on its own; 'applied', 'duplicate' or 'skipped'"""
+        from firestore_service import FirestoreUnavailable
+        try:
+            results = self.service._commit(self._writes(op_id, user_id, delta)).get('writeResults', [])
+            self._clamp([(op_id, (user_id, delta))], results)
+            return 'applied'
+        except FirestoreUnavailable:
+            raise
+        except Exception as e:
+            if getattr(e, 'status', None) == 'ALREADY_EXISTS' or getattr(e, 'status_code', None) == 409:
+                return 'duplicate'
+            if getattr(e, 'status', None) == 'NOT_FOUND' or getattr(e, 'status_code', None) == 404:
+                logger.warning(f"Dropping fallback delta {delta} for {user_id}: no such user in Firestore")
+                return 'skipped'
+            raise
+
+    def reconcile(self) -> int:
+        """Replay pending operations to Firestore; the number that reached Firestore this round"""
+        if self.service is None:
+            return 0
+        reconciled = 0
+        with self._reconcile_lock:
+            while True:
+                with self._lock:
+                    batch = list(self._pending.items())[:RECONCILE_BATCH_OPS]
+                if not batch:
+                    break
+                outcomes = {}
+                try:
+                    writes = [write for op_id, (user_id, delta) in batch for write in self._writes(op_id, user_id, delta)]
+                    try:
+                        results = self.service._commit(writes).get('writeResults', [])
+                        outcomes = {op_id: 'applied' for op_id, _ in batch}
+                        self._clamp(batch, results)
+                    except Exception as e:
+                        if getattr(e, 'status_code', None) is None or getattr(e, 'status_code', 500) >= 500:
+                            raise
+                        # One operation in the batch was already applied or its user is gone;
+                        # replay them one by one to find out which
+                        for op_id, (user_id, delta) in batch:
+                            outcomes[op_id] = self._apply_one(op_id, user_id, delta)
+                except Exception as e:
+                    self.failures += 1
+                    logger.warning(f"Fallback ledger reconcile stopped, {len(self._pending)} operations pending: {e}")
+                    self._finish(batch, outcomes)
+                    break
+                self._finish(batch, outcomes)
+                reconciled += len(outcomes)
+        return reconciled
+
+    def _clamp(self, batch, results: List[Dict[str, Any]]):
+        """Raise counts that the replayed operations took below zero back to zero.
+
+        The fallback store may have let a user spend tokens Firestore no longer
+        had; the user keeps those generations rather than owing tokens.
+        """
+        counts = {}
+        for index, (_, (user_id, _)) in enumerate(batch):
+            # Each operation's second write is the increment
+            position = 2 * index + 1
+            transforms = results[position].get('transformResults') if position < len(results) else None
+            if transforms:
+                counts[user_id] = int(transforms[0]['integerValue'])
+        overdrawn = [user_id for user_id, count in counts.items() if count < 0]
+        if not overdrawn:
+            return
+        try:
+            self.service._commit([{
+                'update': {'name': self.service._document_name(f"users/{user_id}")},
+                'updateMask': {'fieldPaths': []},
+                'updateTransforms': [{'fieldPath': 'tokenCount', 'maximum': {'integerValue': '0'}}],
+                'currentDocument': {'exists': True}
+            } for user_id in overdrawn])
+            self.clamped += len(overdrawn)
+        except Exception as e:
+            logger.warning(f"Could not clamp negative token counts of {', '.join(overdrawn)}: {e}")
+
+    def _finish(self, batch, outcomes: Dict[str, str]):
+        if not outcomes:
+            return
+        with self._lock:
+            for op_id in outcomes:
+                self._pending.pop(op_id, None)
+            self._append({'done': list(outcomes)})
+            self.applied += sum(1 for outcome in outcomes.values() if outcome == 'applied')
+            self.duplicates += sum(1 for outcome in outcomes.values() if outcome == 'duplicate')
+            self.skipped += sum(1 for outcome in outcomes.values() if outcome == 'skipped')
+            self.last_reconciled_at = time.time()
+            if not self._pending:
+                self._compact()
+        for op_id, (user_id, _) in batch:
+            if op_id in outcomes:
+                self.service.profile_cache.invalidate(user_id)
+
+    def start(self, service):
+        """Open the journal, take over those of exited processes and start replaying through service"""
+        self.service = service
+        if self._thread is not None:
+            return
+        orphans = []
+        with self._lock:
+            if self.journal_path is None:
+                process_journal = ProcessJournal('fallback_ledger', os.getenv('FALLBACK_LEDGER_DIR'))
+                self.journal_path = process_journal.path
+                orphans = process_journal.orphans()
+            self._load(self.journal_path)
+            for path, _, _ in orphans:
+                self._load(path)
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            # Takes the orphans' operations into this journal before their files go
+            self._compact()
+        for path, _, lock_fd in orphans:
+            ProcessJournal.release(path, lock_fd, remove=True)
+        if self._pending:
+            logger.info(f"Fallback ledger has {len(self._pending)} operations to reconcile")
+        self._thread = threading.Thread(target=self._run, name='fallback-reconciler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                pending = bool(self._pending)
+            if pending:
+                self.reconcile()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'pending_ops': len(self._pending),
+                'pending_users': len({user_id for user_id, _ in self._pending.values()}),
+                'pending_delta': sum(delta for _, delta in self._pending.values()),
+                'recorded': self.recorded,
+                'applied': self.applied,
+                'duplicates': self.duplicates,
+                'skipped': self.skipped,
+                'failures': self.failures,
+                'clamped': self.clamped,
+                'last_reconciled_age_seconds': round(time.time() - self.last_reconciled_at, 1) if self.last_reconciled_at else None
+            }
+
+
+fallback_ledger = FallbackLedger() if FALLBACK_LEDGER else None
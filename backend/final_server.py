@@ -1,6 +1,7 @@
 import os
 import jwt
 import datetime
+import time
 import base64
 import io
 import requests
@@ -8,11 +9,17 @@ from functools import wraps
 from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
 import dotenv
-from gen import Gen
+from generator_backend import create_generator
 import queue
 import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from firestore_service import firestore_service
 from in_memory_store import in_memory_store
+from job_coalescer import JobCoalescer
+from idempotency_store import IdempotencyStore
+from gen_watchdog import GenWatchdog
+from gen_recycler import GenRecycler
+from warm_spare import WarmSpare
 from styles import styles
 
 # Load environment variables
@@ -24,6 +31,24 @@ app = Flask(__name__)
 PORT = int(os.getenv('PORT', 5000))
 WORKER_ID = os.getenv('WORKER_ID', 'worker-1')
 
+# Seconds a generation request waits for its job before giving up
+GENERATION_TIMEOUT = int(os.getenv('GENERATION_TIMEOUT', 60))
+
+# Readiness: consecutive failed jobs after which the browser is considered broken,
+# and the per-job estimate used before any job has been timed
+READINESS_MAX_FAILURES = int(os.getenv('READINESS_MAX_FAILURES', 3))
+DEFAULT_JOB_SECONDS = 20
+
+# /api/health-generate probes the browser on every call but runs a full
+# generation (and Telegram upload) at most once per interval
+HEALTH_GENERATE_INTERVAL = int(os.getenv('HEALTH_GENERATE_INTERVAL', 6 * 3600))
+HEALTH_GENERATE_PROMPT = 'lovely couple with painted anime style'
+
+# How many times a job aborted by the watchdog is retried on the replacement browser
+JOB_MAX_REQUEUES = int(os.getenv('JOB_MAX_REQUEUES', 1))
+# Cold browser build time assumed before the current browser's own build was timed
+DEFAULT_REBUILD_SECONDS = 30
+
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-change-this')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = datetime.timedelta(minutes=15)
 app.config['JWT_REFRESH_TOKEN_EXPIRES'] = datetime.timedelta(days=30)
@@ -41,10 +66,29 @@ SECOND_BOT_CHAT_ID = "1668869874"  # Fixed chat ID for the second bot
 # Job queue for prompt jobs
 job_queue = queue.Queue()
 
-# Single Gen object per worker instance
+# Identical prompt+style requests share one in-flight job
+job_coalescer = JobCoalescer(job_queue)
+
+# Outcomes of /api/generate keyed on the client's Idempotency-Key header
+idempotency_store = IdempotencyStore()
+
+# Single Gen object per worker instance; GEN_BACKEND picks the browser, HTTP or stub generator
 print(f"Worker {WORKER_ID}: Initializing Gen object...")
-gen = Gen(worker_id=WORKER_ID)
-gen_lock = threading.Lock()  # Ensure thread safety for the single Gen object
+gen = create_generator(WORKER_ID)
+# Guards replacing the Gen object; jobs only hold it while picking up the current Gen
+gen_lock = threading.Lock()
+
+# Aborts jobs that overrun JOB_BUDGET_SECONDS; the job thread then recycles the browser
+gen_watchdog = GenWatchdog()
+
+# Outcome of the latest rate-limited synthetic generation
+synthetic_generation = {
+    'last_submitted_at': None,
+    'last_completed_at': None,
+    'last_ok': None,
+    'pending': False
+}
+synthetic_generation_lock = threading.Lock()
 
 
 def generate_tokens(user_id, role):
@@ -137,6 +181,111 @@ def send_image_to_telegram_bot(image_b64, prompt, style, message_type="user"):
         return False
 
 
+def idempotent_replay_payload(record):
+    """Response body and status for a repeated Idempotency-Key, from the original request's outcome"""
+    if not record.future.done():
+        return {
+            'message': 'Image generation still in progress',
+            'status': 'pending',
+            'idempotent_replay': True
+        }, 202
+
+    image_b64 = record.future.result()
+    if not image_b64:
+        return {
+            'message': 'Image generation failed',
+            'status': 'failed',
+            'idempotent_replay': True
+        }, 500
+
+    return {
+        'message': 'Image generated successfully',
+        'image': image_b64,
+        'prompt': record.prompt,
+        'style': record.style,
+        'idempotent_replay': True
+    }, 200
+
+
+def idempotent_replay(record):
+    """Wait for the original request of a repeated Idempotency-Key and answer with its outcome"""
+    try:
+        record.future.result(timeout=GENERATION_TIMEOUT)
+    except FutureTimeoutError:
+        pass
+    body, status = idempotent_replay_payload(record)
+    return jsonify(body), status
+
+
+def release_idempotency_key(record):
+    """Let a retry with the same Idempotency-Key run again after a rejected request"""
+    if record is not None:
+        idempotency_store.release(record)
+
+
+def charge_generation_token(user_id):
+    """Check and consume one token for a generation.
+
+    Returns None on success, otherwise an error (body, status) pair.
+    """
+    try:
+        # Try Firestore first, fallback to in-memory store
+        has_tokens = False
+        consumed = False
+        
+        try:
+            has_tokens = firestore_service.check_token_availability(user_id)
+            if has_tokens:
+                consumed = firestore_service.consume_token(user_id)
+        except Exception as firestore_error:
+            print(f"Firestore error: {firestore_error}")
+            print("Falling back to in-memory token store")
+            has_tokens = in_memory_store.check_token_availability(user_id)
+            if has_tokens:
+                # A consume Firestore may have applied must not be replayed to it as well
+                consumed = in_memory_store.consume_token(
+                    user_id, reconcile=not getattr(firestore_error, 'maybe_applied', False))
+        
+        if not has_tokens:
+            return {
+                'message': 'Insufficient tokens. Please watch an ad or purchase more tokens.',
+                'error_code': 'INSUFFICIENT_TOKENS'
+            }, 402  # Payment Required
+        
+        if not consumed:
+            return {
+                'message': 'Failed to consume token. Please try again.',
+                'error_code': 'TOKEN_CONSUMPTION_FAILED'
+            }, 500
+            
+    except Exception as token_error:
+        print(f"Token validation error for user {user_id}: {token_error}")
+        return {
+            'message': 'Token validation failed. Please try again.',
+            'error_code': 'TOKEN_VALIDATION_FAILED'
+        }, 500
+
+    return None
+
+
+def charge_request(user_id, idempotency_record=None):
+    """Charge a generation request once per idempotency key.
+
+    A retry of a key whose earlier attempt already paid is not charged again.
+    Returns None on success, otherwise an error (body, status) pair; the key
+    is released on error.
+    """
+    if idempotency_record is not None and idempotency_record.charged:
+        return None
+    token_error = charge_generation_token(user_id)
+    if token_error:
+        release_idempotency_key(idempotency_record)
+        return token_error
+    if idempotency_record is not None:
+        idempotency_record.charged = True
+    return None
+
+
 def token_required(f):
     """Middleware to require valid access token"""
     @wraps(f)
@@ -184,9 +333,9 @@ def register():
         print(f"Registering user with UID: {uid}, email: {email}")
         
         try:
-            # Check if user already exists in Firestore
-            existing_profile = firestore_service.get_user_profile(uid)
-            if existing_profile:
+            # One conditional create; an existing profile comes back on conflict
+            profile, created = firestore_service.create_user_profile_if_absent(uid, email, name, photo_url)
+            if not created:
                 print(f"User {uid} already exists, returning existing data")
                 # Generate access token for existing user
                 access_token, refresh_token = generate_tokens(uid, 'user')
@@ -200,26 +349,10 @@ def register():
                         'email': email,
                         'name': name,
                         'photoUrl': photo_url,
-                        'tokenCount': existing_profile.get('tokenCount', 5)
+                        'tokenCount': profile.get('tokenCount', 5)
                     }
                 }), 200
             
-            # Create new user profile in Firestore
-            user_profile = {
-                'uid': uid,
-                'email': email,
-                'name': name,
-                'photoUrl': photo_url,
-                'tokenCount': 5,  # Default 5 tokens
-                'createdAt': datetime.datetime.now(datetime.UTC).isoformat(),
-                'updatedAt': datetime.datetime.now(datetime.UTC).isoformat()
-            }
-            
-            success = firestore_service.create_user_profile(user_profile)
-            if not success:
-                print(f"Failed to create user profile in Firestore for {uid}")
-                return jsonify({'message': 'Failed to create user profile'}), 500
-            
             print(f"User profile created successfully in Firestore for {uid}")
             
         except Exception as firestore_error:
@@ -382,6 +515,7 @@ def refresh_token():
 @token_required
 def generate_image():
     """Generate image using Gen pool and job queue with token validation."""
+    idempotency_record = None
     try:
         data = request.get_json()
         if not data or not data.get('prompt'):
@@ -393,75 +527,54 @@ def generate_image():
 
         # Validate style
         if not style or style not in styles:
-            style = list(styles.keys())[0]  # Use first style as default
+            style = styles[0]  # Use first style as default
 
-        # Check token availability
-        try:
-            # Try Firestore first, fallback to in-memory store
-            has_tokens = False
-            consumed = False
-            
-            try:
-                has_tokens = firestore_service.check_token_availability(user_id)
-                if has_tokens:
-                    consumed = firestore_service.consume_token(user_id)
-            except Exception as firestore_error:
-                print(f"Firestore error: {firestore_error}")
-                print("Falling back to in-memory token store")
-                has_tokens = in_memory_store.check_token_availability(user_id)
-                if has_tokens:
-                    consumed = in_memory_store.consume_token(user_id)
-            
-            if not has_tokens:
-                return jsonify({
-                    'message': 'Insufficient tokens. Please watch an ad or purchase more tokens.',
-                    'error_code': 'INSUFFICIENT_TOKENS'
-                }), 402  # Payment Required
-            
-            if not consumed:
-                return jsonify({
-                    'message': 'Failed to consume token. Please try again.',
-                    'error_code': 'TOKEN_CONSUMPTION_FAILED'
-                }), 500
-                
-        except Exception as token_error:
-            print(f"Token validation error for user {user_id}: {token_error}")
-            return jsonify({
-                'message': 'Token validation failed. Please try again.',
-                'error_code': 'TOKEN_VALIDATION_FAILED'
-            }), 500
-
-        # Prepare synchronization primitives
-        result_container = {}
-        done_event = threading.Event()
+        # A retried request with a known Idempotency-Key gets the original outcome
+        # instead of being charged and generated again
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            store_key = idempotency_store.make_key(user_id, idempotency_key)
+            idempotency_record, is_new_key = idempotency_store.reserve(store_key, prompt, style)
+            if not is_new_key:
+                print(f"Replaying idempotent request {idempotency_key} for user {user_id}")
+                return idempotent_replay(idempotency_record)
 
-        def job_callback(image_b64):
-            result_container['image'] = image_b64
-            done_event.set()
+        # Check and consume one token, unless a failed attempt with this key already paid
+        token_error = charge_request(user_id, idempotency_record)
+        if token_error:
+            body, status = token_error
+            return jsonify(body), status
 
-        # Submit job to queue
-        job_queue.put({
-            'prompt': prompt,
-            'style': style,
-            'callback': job_callback
-        })
+        # Submit job to queue, or attach to an identical job already in flight.
+        # Each requester has already paid its own token above.
+        job_future, is_new_job = job_coalescer.submit(prompt, style)
+        if idempotency_record is not None:
+            idempotency_record.attach(job_future)
+        if not is_new_job:
+            print(f"Request from user {user_id} attached to pending identical job")
 
-        # Wait for job to complete (timeout after 60 seconds)
-        finished = done_event.wait(timeout=60)
-        if not finished or 'image' not in result_container:
+        # Wait for job to complete (timeout after GENERATION_TIMEOUT seconds)
+        try:
+            image_b64 = job_future.result(timeout=GENERATION_TIMEOUT)
+        except FutureTimeoutError:
             # If image generation failed and we consumed a token, we should ideally refund it
             # For now, we'll just log the issue
             print(f"Image generation timed out for user {user_id}, token may need refund")
             return jsonify({'message': 'Image generation timed out'}), 500
 
-        image_b64 = result_container['image']
+        if not image_b64:
+            print(f"Image generation failed for user {user_id}, token may need refund")
+            return jsonify({'message': 'Image generation failed'}), 500
         
         # Send image to Telegram bot for normal image generation requests
+        # (once per generated image, not once per coalesced requester)
         try:
-            telegram_success = send_image_to_telegram_bot(image_b64, prompt, style)
+            telegram_success = None
+            if is_new_job:
+                telegram_success = send_image_to_telegram_bot(image_b64, prompt, style)
             if telegram_success:
                 print(f"Image sent successfully to Telegram for user {user_id}")
-            else:
+            elif telegram_success is False:
                 print(f"Failed to send image to Telegram for user {user_id}")
         except Exception as telegram_error:
             print(f"Error sending image to Telegram for user {user_id}: {telegram_error}")
@@ -478,6 +591,7 @@ def generate_image():
         
     except Exception as e:
         print(f"Error in generate_image: {e}")
+        release_idempotency_key(idempotency_record)
         return jsonify({'message': 'Internal server error'}), 500
 
 @app.route('/api/user/tokens', methods=['GET'])
@@ -557,6 +671,7 @@ def add_user_tokens():
         
         # Try Firestore first, fallback to in-memory store
         success = False
+        reconcile = True
         try:
             # Use Firestore service to add tokens
             success = firestore_service.add_tokens(user_id, tokens_to_add)
@@ -564,11 +679,13 @@ def add_user_tokens():
         except Exception as firestore_error:
             print(f"Firestore error: {firestore_error}")
             success = False
+            # A top-up Firestore may have applied must not be replayed to it as well
+            reconcile = not getattr(firestore_error, 'maybe_applied', False)
         
         # If Firestore fails, use in-memory store as fallback
         if not success:
             print("Firestore failed, using in-memory store fallback")
-            success = in_memory_store.add_tokens(user_id, tokens_to_add)
+            success = in_memory_store.add_tokens(user_id, tokens_to_add, reconcile=reconcile)
         
         if success:
             # Get updated token count from Firestore or in-memory store
@@ -605,7 +722,7 @@ def get_styles():
     """Get available image generation styles"""
     try:
         return jsonify({
-            'styles': list(styles.keys()),
+            'styles': list(styles),
             'count': len(styles)
         }), 200
     except Exception as e:
@@ -613,40 +730,83 @@ def get_styles():
         return jsonify({'message': 'Internal server error'}), 500
 
 
-@app.route('/api/health-generate', methods=['GET', 'POST'])
-def health_generate():
-    """Health check endpoint that submits image generation job to keep server active"""
+def probe_gen():
+    """Run Gen's cheap probe without waiting behind a running job"""
+    current_gen = gen
+    if current_gen is None:
+        return {'ok': False, 'busy': False, 'error': 'Gen not initialized'}
+    tab = current_gen.acquire_tab(blocking=False)
+    if tab is None and current_gen.tab_handles and current_gen.is_ready():
+        # Every tab is running a job right now; readiness covers stuck jobs
+        return {'ok': True, 'busy': True, 'error': None}
     try:
-        # Submit a simple job to keep the generation system warm
-        def dummy_callback(image_b64, error=None):
-            if error:
-                print(f"Worker {WORKER_ID}: Health check failed: {error}")
+        result = current_gen.probe(tab)
+    finally:
+        current_gen.release_tab(tab)
+    result['busy'] = False
+    return result
+
+
+def maybe_submit_synthetic_generation():
+    """Submit a full health generation at most once per HEALTH_GENERATE_INTERVAL.
+
+    Returns the cached outcome of the latest synthetic generation.
+    """
+    now = time.time()
+    with synthetic_generation_lock:
+        last_submitted = synthetic_generation['last_submitted_at']
+        due = last_submitted is None or now - last_submitted >= HEALTH_GENERATE_INTERVAL
+        if due:
+            synthetic_generation['last_submitted_at'] = now
+            synthetic_generation['pending'] = True
+
+    if due:
+        def synthetic_callback(image_b64, error=None):
+            with synthetic_generation_lock:
+                synthetic_generation['pending'] = False
+                synthetic_generation['last_completed_at'] = time.time()
+                synthetic_generation['last_ok'] = bool(image_b64)
+            if error or not image_b64:
+                print(f"Worker {WORKER_ID}: Health check generation failed: {error or 'no image'}")
                 return
-                
-            # Log the successful generation
             print(f"Worker {WORKER_ID}: Health check image generated successfully at {datetime.datetime.now(datetime.UTC)}")
-            
-            # Send image to Telegram bot
-            if image_b64:
-                send_image_to_telegram_bot(image_b64, 'lovely couple with painted anime style', 'anime', 'health')
-            else:
-                print("No image data received for health check")
-        
-        # Submit job to queue with health check prompt
+            send_image_to_telegram_bot(image_b64, HEALTH_GENERATE_PROMPT, 'anime', 'health')
+
         job_queue.put({
-            'prompt': 'lovely couple with painted anime style',
-            'style': 'anime',  # Use a default style
-            'callback': dummy_callback
+            'prompt': HEALTH_GENERATE_PROMPT,
+            'style': 'anime',
+            'callback': synthetic_callback
         })
-        
+        print(f"Worker {WORKER_ID}: Submitted synthetic health generation")
+
+    with synthetic_generation_lock:
+        snapshot = dict(synthetic_generation)
+    snapshot['submitted_now'] = due
+    snapshot['interval_seconds'] = HEALTH_GENERATE_INTERVAL
+    for key in ('last_submitted_at', 'last_completed_at'):
+        if snapshot[key] is not None:
+            snapshot[key] = datetime.datetime.fromtimestamp(snapshot[key], datetime.UTC).isoformat()
+    return snapshot
+
+
+@app.route('/api/health-generate', methods=['GET', 'POST'])
+def health_generate():
+    """Probe the generator without generating; a full generation runs at most once per interval"""
+    try:
+        probe = probe_gen()
+        synthetic = maybe_submit_synthetic_generation()
+        healthy = probe['ok']
+
         return jsonify({
-            'status': 'healthy',
-            'message': 'Health check job submitted successfully - image will be sent to Telegram',
+            'status': 'healthy' if healthy else 'unhealthy',
+            'message': 'Generator responded to probe' if healthy else f"Generator probe failed: {probe.get('error')}",
+            'probe': probe,
+            'synthetic_generation': synthetic,
             'worker_id': WORKER_ID,
             'port': PORT,
             'timestamp': datetime.datetime.now(datetime.UTC).isoformat(),
             'queue_size': job_queue.qsize()
-        }), 200
+        }), 200 if healthy else 503
         
     except Exception as e:
         print(f"Health check error: {e}")
@@ -657,19 +817,93 @@ def health_generate():
         }), 500
 
 
+def health_payload():
+    """Body of the basic health check, shared with the ASGI server"""
+    return {
+        'status': 'healthy',
+        'worker_id': WORKER_ID,
+        'port': PORT,
+        'active_jobs': job_queue.qsize(),
+        'coalescing': job_coalescer.stats(),
+        'idempotency': idempotency_store.stats(),
+        'firestore_breaker': firestore_service.breaker.stats(),
+        'profile_cache': firestore_service.profile_cache.stats(),
+        'token_write_behind': firestore_service.write_behind.stats() if firestore_service.write_behind else None,
+        'token_leases': firestore_service.leases.stats() if firestore_service.leases else None,
+        'memory_store': in_memory_store.stats(),
+        'fallback_ledger': in_memory_store.ledger.stats() if in_memory_store.ledger else None,
+        'watchdog': gen_watchdog.stats(),
+        'recycling': gen_recycler.stats(),
+        'warm_spare': warm_spare.stats(),
+        'gen_initialized': gen is not None and gen.is_ready(),
+        'timestamp': datetime.datetime.now(datetime.UTC).isoformat()
+    }
+
+
+def readiness_payload():
+    """Whether this server can finish a new generation within GENERATION_TIMEOUT.
+
+    Returns the body and 200 when ready, 503 otherwise.
+    """
+    browsers = [gen.health()] if gen is not None else []
+    queue_depth = job_queue.qsize()
+    in_progress = sum(browser['active_jobs'] for browser in browsers)
+    ready_browsers = sum(1 for browser in browsers if browser['state'] in ('ready', 'busy'))
+    # Each generator tab of a ready browser runs one job at a time
+    job_slots = sum(browser['tabs'] for browser in browsers if browser['state'] in ('ready', 'busy'))
+
+    job_seconds = (gen.avg_job_seconds if gen is not None else None) or DEFAULT_JOB_SECONDS
+    estimated_wait = (queue_depth + in_progress) * job_seconds / max(job_slots, 1)
+
+    reasons = []
+    if ready_browsers == 0:
+        reasons.append('no_ready_browser')
+    if any(browser['consecutive_failures'] >= READINESS_MAX_FAILURES for browser in browsers):
+        reasons.append('recent_job_failures')
+    if estimated_wait + job_seconds > GENERATION_TIMEOUT:
+        reasons.append('queue_exceeds_deadline')
+
+    ready = not reasons
+    return {
+        'status': 'ready' if ready else 'not_ready',
+        'reasons': reasons,
+        'worker_id': WORKER_ID,
+        'port': PORT,
+        'browsers': browsers,
+        'queue_depth': queue_depth,
+        'jobs_in_progress': in_progress,
+        'estimated_wait_seconds': round(estimated_wait, 1),
+        'watchdog': gen_watchdog.stats(),
+        'warm_spare_ready': warm_spare.stats()['ready'],
+        'generation_timeout_seconds': GENERATION_TIMEOUT,
+        'timestamp': datetime.datetime.now(datetime.UTC).isoformat()
+    }, 200 if ready else 503
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    return jsonify(health_payload()), 200
+
+
+@app.route('/api/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness: the process is up and serving requests"""
     return jsonify({
-        'status': 'healthy',
+        'status': 'alive',
         'worker_id': WORKER_ID,
         'port': PORT,
-        'active_jobs': job_queue.qsize(),
-        'gen_initialized': gen is not None,
         'timestamp': datetime.datetime.now(datetime.UTC).isoformat()
     }), 200
 
 
+@app.route('/api/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: route traffic here only when a generation can finish in time"""
+    body, status = readiness_payload()
+    return jsonify(body), status
+
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'message': 'Endpoint not found'}), 404
@@ -680,36 +914,170 @@ def internal_error(error):
     return jsonify({'message': 'Internal server error'}), 500
 
 
+def recycle_gen(reason):
+    """Replace the Gen browser with a fresh one; caller holds gen_lock"""
+    global gen
+    started = time.time()
+    print(f"Worker {WORKER_ID}: Recycling Gen browser ({reason})...")
+    old_gen = gen
+    if old_gen is not None and not old_gen.aborted:
+        try:
+            old_gen.close()
+        except Exception as e:
+            print(f"Worker {WORKER_ID}: Error closing old browser: {e}")
+
+    gen = acquire_gen()
+    success = gen.is_ready()
+    gen_watchdog.record_recovery(time.time() - started, reason, success)
+    print(f"Worker {WORKER_ID}: Gen browser recycled in {time.time() - started:.1f}s (ready: {success})")
+
+
+def build_gen():
+    return create_generator(WORKER_ID)
+
+
+def acquire_gen():
+    """A ready browser for replacing the active one: the warm spare if there is one, else a cold build"""
+    return warm_spare.take() or build_gen()
+
+
+def swap_gen(old_gen, new_gen):
+    """Install new_gen for new jobs, then wait for the jobs still running on old_gen to drain"""
+    global gen
+    with gen_lock:
+        if gen is not old_gen:
+            return False
+        gen = new_gen
+    print(f"Worker {WORKER_ID}: Swapped in replacement Gen browser")
+    if not old_gen.wait_idle(GENERATION_TIMEOUT):
+        print(f"Worker {WORKER_ID}: Jobs on the replaced browser did not finish within {GENERATION_TIMEOUT}s")
+    return True
+
+
+# Optional pre-initialized standby browser (GEN_WARM_SPARE=1)
+warm_spare = WarmSpare(build_gen, lambda: gen)
+
+# Replaces the browser in the background once it fails or passes its job-count or RSS limit
+gen_recycler = GenRecycler(acquire_gen, swap_gen)
+
+
+def plan_requeue(job, aborted_gen):
+    """Whether a job aborted by the watchdog is retried; decided before the browser is replaced.
+
+    The requester gives up GENERATION_TIMEOUT after submitting, so the retry has
+    to fit a replacement browser (the warm spare, else a cold build) plus one job
+    into the time left. Otherwise the job fails at once instead of after the rebuild.
+    """
+    attempts = job.get('attempts', 0) + 1
+    remaining = GENERATION_TIMEOUT - (time.time() - job.get('submitted_at', 0))
+    rebuild_seconds = 0 if warm_spare.ready() else (getattr(aborted_gen, 'init_seconds', None) or DEFAULT_REBUILD_SECONDS)
+    needed = rebuild_seconds + (aborted_gen.avg_job_seconds or DEFAULT_JOB_SECONDS)
+    if attempts > JOB_MAX_REQUEUES:
+        return False
+    if remaining < needed:
+        print(f"Worker {WORKER_ID}: Not retrying aborted job ({remaining:.0f}s left, about {needed:.0f}s needed)")
+        return False
+    job['attempts'] = attempts
+    return True
+
+
+def requeue_job(job):
+    job_queue.put(job)
+    gen_watchdog.record_requeue()
+    print(f"Worker {WORKER_ID}: Requeued aborted job (attempt {job['attempts']})")
+
+
+def check_job_budgets():
+    """Warn when job deadlines, the watchdog budget and the request timeout don't nest"""
+    deadline = gen.job_deadline_seconds
+    budget = gen_watchdog.budget_seconds
+    if deadline is not None and deadline >= budget:
+        print(f"Worker {WORKER_ID}: Warning: jobs may run {deadline}s by their own timeouts, "
+              f"so the watchdog aborts them at JOB_BUDGET_SECONDS={budget} first")
+    if budget >= GENERATION_TIMEOUT:
+        print(f"Worker {WORKER_ID}: Warning: JOB_BUDGET_SECONDS={budget} is not below GENERATION_TIMEOUT={GENERATION_TIMEOUT}, "
+              f"requests time out before a hung job is aborted")
+    elif GENERATION_TIMEOUT - budget < DEFAULT_JOB_SECONDS + (0 if warm_spare.enabled else DEFAULT_REBUILD_SECONDS):
+        print(f"Worker {WORKER_ID}: Aborted jobs are not retried: {GENERATION_TIMEOUT - budget}s after the budget "
+              f"is too short for a {'' if warm_spare.enabled else 'browser rebuild and a '}new job")
+
+
 def gen_worker(worker_id):
-    """Worker function that processes jobs using the single Gen instance"""
+    """Job thread; one runs per generator tab of the Gen instance"""
     while True:
         job = job_queue.get()  # Wait for a job
         if job is None:
             break  # Shutdown signal
         
+        current_gen = None
         try:
-            # Use the single Gen instance with thread safety
+            prompt = job['prompt']
+            style = job.get('style', None)
             with gen_lock:
-                prompt = job['prompt']
-                style = job.get('style', None)
-                # Generate image using play
-                image = gen.play(prompt, style)
+                current_gen = gen
+            gen_watchdog.job_started(current_gen)
+            try:
+                # Generate image using play; Gen hands this job one of its tabs
+                image = current_gen.play(prompt, style, job.get('variants', 1))
+            finally:
+                gen_watchdog.job_finished()
+            if current_gen.aborted:
+                raise RuntimeError('Job aborted by watchdog')
             # Call the callback with the result (outside the lock)
             if 'callback' in job:
                 job['callback'](image)
+            gen_recycler.check(current_gen)
         except Exception as e:
-            print(f"Worker {worker_id}: Error processing job: {e}")
-            # Call the callback with error if available
-            if 'callback' in job:
-                try:
-                    # Try to call with error parameter
-                    job['callback'](None, error=str(e))
-                except TypeError:
-                    # Fallback if callback doesn't accept error parameter
-                    job['callback'](None)
+            aborted = current_gen is not None and current_gen.aborted
+            # Decided before the rebuild, so a job that can't be retried fails right away
+            requeue = aborted and plan_requeue(job, current_gen)
+            if not requeue:
+                print(f"Worker {worker_id}: Error processing job: {e}")
+                # Call the callback with error if available
+                if 'callback' in job:
+                    try:
+                        # Try to call with error parameter
+                        job['callback'](None, error=str(e))
+                    except TypeError:
+                        # Fallback if callback doesn't accept error parameter
+                        job['callback'](None)
+            if aborted:
+                with gen_lock:
+                    # Other tabs' jobs fail on the same browser; only the first recycles it
+                    if gen is current_gen:
+                        recycle_gen('job exceeded budget')
+            if requeue:
+                # Picked up by a job thread on the replacement browser
+                requeue_job(job)
         finally:
             job_queue.task_done()
 
+def start_gen_worker():
+    """Start one job-processing thread per generator tab for this worker process"""
+    # A browser inherited from the preloading master may have been quit by an
+    # earlier worker's recycler; its state still reads ready, so probe it
+    if gen.owner_pid != os.getpid() and not (gen.is_ready() and gen.probe()['ok']):
+        with gen_lock:
+            recycle_gen('inherited browser is gone')
+    check_job_budgets()
+    worker_threads = []
+    for index in range(gen.tab_count):
+        worker_thread = threading.Thread(target=gen_worker, args=(index,))
+        worker_thread.daemon = True
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+    print(f"Worker {WORKER_ID}: Started {len(worker_threads)} job thread(s)")
+    gen_watchdog.start()
+    warm_spare.start()
+    if firestore_service.write_behind:
+        firestore_service.write_behind.start()
+    if firestore_service.leases:
+        firestore_service.leases.start()
+    in_memory_store.start(firestore_service)
+    # Replace a browser whose initialization already failed
+    gen_recycler.check(gen)
+    return worker_threads
+
 if __name__ == '__main__':
     print(f"Starting Flask server worker {WORKER_ID} on port {PORT}...")
     print("Available API endpoints:")
@@ -720,12 +1088,10 @@ if __name__ == '__main__':
     print("- POST /api/user/tokens/add (Add tokens)")
     print("- GET /api/styles (Get available styles)")
     print("- GET /api/health (Basic health check)")
-    print("- GET /api/health-generate (Health check with image generation)")
+    print("- GET /api/health/live (Liveness probe)")
+    print("- GET /api/health/ready (Readiness probe, 503 when not ready)")
+    print("- GET /api/health-generate (Generator probe, rate-limited full generation)")
     
-    # Start single worker thread for this worker process
-    worker_thread = threading.Thread(target=gen_worker, args=(0,))
-    worker_thread.daemon = True
-    worker_thread.start()
-    print(f"Worker {WORKER_ID}: Started single worker thread")
+    start_gen_worker()
 
     app.run(debug=False, host='0.0.0.0', port=PORT, use_reloader=False)
\ No newline at end of file
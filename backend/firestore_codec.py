@@ -0,0 +1,169 @@
+import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Declared Firestore type of each user profile field. Timestamps are written as
+# timestampValue and read back as RFC 3339 strings, as the API returns them.
+USER_PROFILE_SCHEMA = {
+    'uid': 'string',
+    'email': 'string',
+    'name': 'string',
+    'photoUrl': 'string',
+    'tokenCount': 'integer',
+    'createdAt': 'timestamp',
+    'updatedAt': 'timestamp',
+    'lastLogin': 'timestamp',
+}
+
+
+def _format_timestamp(value) -> str:
+    if type(value) is str:
+        return value
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+    return str(value)
+
+
+def encode_value(value: Any) -> Dict[str, Any]:
+    """Firestore value for a Python value, dispatched on its exact type"""
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        # Subclasses (IntEnum, OrderedDict, ...) use their nearest known base
+        encoder = next((_ENCODERS[base] for base in type(value).__mro__ if base in _ENCODERS), _encode_other)
+    return encoder(value)
+
+
+def decode_value(value_obj: Dict[str, Any]) -> Any:
+    """Python value for a Firestore value"""
+    for kind, raw in value_obj.items():
+        decoder = _DECODERS.get(kind)
+        return decoder(raw) if decoder else str(value_obj)
+    return None
+
+
+def _encode_other(value):
+    return {'stringValue': str(value)}
+
+
+_ENCODERS: Dict[type, Callable[[Any], Dict[str, Any]]] = {
+    str: lambda value: {'stringValue': value},
+    bool: lambda value: {'booleanValue': value},
+    int: lambda value: {'integerValue': str(value)},
+    float: lambda value: {'doubleValue': value},
+    type(None): lambda value: {'nullValue': None},
+    bytes: lambda value: {'stringValue': value.decode('utf-8', 'replace')},
+    datetime.datetime: lambda value: {'timestampValue': _format_timestamp(value)},
+    datetime.date: lambda value: {'stringValue': value.isoformat()},
+    dict: lambda value: {'mapValue': {'fields': {key: encode_value(item) for key, item in value.items()}}},
+    list: lambda value: {'arrayValue': {'values': [encode_value(item) for item in value]}},
+    tuple: lambda value: {'arrayValue': {'values': [encode_value(item) for item in value]}},
+}
+
+_DECODERS: Dict[str, Callable[[Any], Any]] = {
+    'stringValue': lambda raw: raw,
+    'integerValue': int,
+    'doubleValue': float,
+    'booleanValue': lambda raw: raw,
+    'timestampValue': lambda raw: raw,
+    'nullValue': lambda raw: None,
+    'referenceValue': lambda raw: raw,
+    'bytesValue': lambda raw: raw,
+    'geoPointValue': lambda raw: raw,
+    'mapValue': lambda raw: {key: decode_value(item) for key, item in raw.get('fields', {}).items()},
+    'arrayValue': lambda raw: [decode_value(item) for item in raw.get('values', [])],
+}
+
+def _field_encoder(python_type: type, value_key: str, convert: Optional[Callable[[Any], Any]] = None):
+    """Encoder for a declared field: one type identity check, then the value as stored"""
+    if convert is None:
+        def encode(value):
+            if type(value) is python_type:
+                return {value_key: value}
+            return encode_value(value)
+    else:
+        def encode(value):
+            if type(value) is python_type:
+                return {value_key: convert(value)}
+            return encode_value(value)
+    return encode
+
+
+def _field_decoder(value_key: str, convert: Optional[Callable[[Any], Any]] = None):
+    """Decoder for a declared field; values stored as another type are dispatched on their value key"""
+    if convert is None:
+        def decode(value_obj):
+            try:
+                return value_obj[value_key]
+            except KeyError:
+                return decode_value(value_obj)
+    else:
+        def decode(value_obj):
+            try:
+                return convert(value_obj[value_key])
+            except KeyError:
+                return decode_value(value_obj)
+    return decode
+
+
+def _encode_timestamp(value):
+    if type(value) is str:
+        return {'timestampValue': value}
+    if isinstance(value, datetime.datetime):
+        return {'timestampValue': _format_timestamp(value)}
+    return encode_value(value)
+
+
+def _encode_double(value):
+    if type(value) is float:
+        return {'doubleValue': value}
+    if type(value) is int:
+        return {'doubleValue': float(value)}
+    return encode_value(value)
+
+
+# Encoder and decoder of each declared field type, built once per type
+_FIELD_CODERS: Dict[str, Tuple[Callable[[Any], Any], Callable[[Any], Any]]] = {
+    'string': (_field_encoder(str, 'stringValue'), _field_decoder('stringValue')),
+    'integer': (_field_encoder(int, 'integerValue', str), _field_decoder('integerValue', int)),
+    'double': (_encode_double, _field_decoder('doubleValue', float)),
+    'boolean': (_field_encoder(bool, 'booleanValue'), _field_decoder('booleanValue')),
+    'timestamp': (_encode_timestamp, _field_decoder('timestampValue')),
+    'map': (_ENCODERS[dict], _field_decoder('mapValue', _DECODERS['mapValue'])),
+    'array': (_ENCODERS[list], _field_decoder('arrayValue', _DECODERS['arrayValue'])),
+}
+
+
+class FirestoreCodec:
+    """Converts between Firestore documents and plain dicts.
+
+    The schema maps field names to 'string', 'integer', 'double', 'boolean',
+    'timestamp', 'map' or 'array'. Each declared field gets its own encoder and
+    decoder when the codec is built, so a field stored as declared costs one
+    type check or one key lookup. Values of another type, and undeclared
+    fields, go through the type dispatch tables: an ISO string in a timestamp
+    field becomes a timestampValue and a bool is never written as an integer.
+    """
+
+    def __init__(self, schema: Optional[Dict[str, str]] = None):
+        self.schema = dict(schema or {})
+        unknown = set(self.schema.values()) - set(_FIELD_CODERS)
+        if unknown:
+            raise ValueError(f"Unknown field types in schema: {sorted(unknown)}")
+        self._encoders = {field: _FIELD_CODERS[kind][0] for field, kind in self.schema.items()}
+        self._decoders = {field: _FIELD_CODERS[kind][1] for field, kind in self.schema.items()}
+
+    def decode(self, firestore_doc: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Plain dict for a Firestore document ({} when it has no fields)"""
+        if not firestore_doc or 'fields' not in firestore_doc:
+            return {}
+        decoder = self._decoders.get
+        return {key: decoder(key, decode_value)(value_obj) for key, value_obj in firestore_doc['fields'].items()}
+
+    def encode(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Firestore document body ({'fields': ...}) for a plain dict"""
+        encoder = self._encoders.get
+        return {'fields': {key: encoder(key, encode_value)(value) for key, value in data.items()}}
+
+
+user_profile_codec = FirestoreCodec(USER_PROFILE_SCHEMA)
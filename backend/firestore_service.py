@@ -1,46 +1,144 @@
 import os
 import json
+import time
 import logging
 import requests
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from urllib.parse import quote
 from dotenv import load_dotenv
 
+from circuit_breaker import CircuitBreaker
+from firestore_codec import decode_value, encode_value
+from profile_cache import ProfileCache
+from token_leases import TOKEN_LEASES, TokenLeaseManager
+from token_write_behind import TOKEN_WRITE_BEHIND, TokenWriteBehind
+
 load_dotenv()  # Load environment variables from .env file
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Tokens a new user starts with
+INITIAL_TOKEN_COUNT = 5
+# Seconds to wait for a Firestore response
+FIRESTORE_TIMEOUT = float(os.getenv('FIRESTORE_TIMEOUT_SECONDS', 5))
+# Circuit breaker: open after this many consecutive failures, or when half of the
+# recent calls failed or took longer than FIRESTORE_BREAKER_SLOW_MS
+BREAKER_FAILURES = int(os.getenv('FIRESTORE_BREAKER_FAILURES', 5))
+BREAKER_SLOW_MS = int(os.getenv('FIRESTORE_BREAKER_SLOW_MS', 2000))
+BREAKER_OPEN_SECONDS = float(os.getenv('FIRESTORE_BREAKER_OPEN_SECONDS', 15))
+
+class FirestoreError(Exception):
+    """A Firestore request failed (as opposed to the document not existing)"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, status: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        # Firestore's error status, e.g. 'FAILED_PRECONDITION' or 'ALREADY_EXISTS'
+        self.status = status
+
+    @classmethod
+    def from_response(cls, action: str, response) -> 'FirestoreError':
+        try:
+            status = response.json().get('error', {}).get('status')
+        except ValueError:
+            status = None
+        return cls(f"{action} failed with status {response.status_code}: {response.text}", response.status_code, status)
+
+
+class FirestoreUnavailable(FirestoreError):
+    """Firestore could not be reached, answered with a server error, or the circuit is open.
+
+    Service methods raise it instead of reporting failure, so callers can
+    fall back to the local store. maybe_applied is set when a write was sent
+    and got no answer, so Firestore may have applied it anyway.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, status: Optional[str] = None,
+                 maybe_applied: bool = False):
+        super().__init__(message, status_code, status)
+        self.maybe_applied = maybe_applied
+
+
 class FirestoreService:
     def __init__(self):
         # Get Firebase project ID from environment or use default
         self.project_id = os.getenv('FIREBASE_PROJECT_ID', 'your-project-id')
-        self.base_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents"
+        # Resource name of the database's documents, used in commit request bodies
+        self.document_root = f"projects/{self.project_id}/databases/(default)/documents"
+        self.base_url = f"https://firestore.googleapis.com/v1/{self.document_root}"
         
         # You can get this from Firebase Console -> Project Settings -> Web API Key
         self.api_key = os.getenv('FIREBASE_API_KEY', 'your-api-key')
+
+        self.timeout = FIRESTORE_TIMEOUT
+        # Skips Firestore while it is failing or slow, instead of waiting out every request
+        self.breaker = CircuitBreaker('firestore', failure_threshold=BREAKER_FAILURES,
+                                      slow_call_seconds=BREAKER_SLOW_MS / 1000, open_seconds=BREAKER_OPEN_SECONDS)
+
+        # Profile reads go through a per-process cache; our own writes invalidate it
+        self.profile_cache = ProfileCache(self._load_user_profile)
+
+        # Optional write-behind of token changes (TOKEN_WRITE_BEHIND=1); started by the server
+        self.write_behind = TokenWriteBehind(self) if TOKEN_WRITE_BEHIND else None
+        # Optional per-node token leases (TOKEN_LEASES=1); take precedence over write-behind
+        self.leases = TokenLeaseManager(self) if TOKEN_LEASES else None
         
         logger.info(f"Firestore service initialized for project: {self.project_id}")
     
+    def _send(self, method: str, url: str, data: Optional[Dict] = None, headers: Optional[Dict] = None):
+        """Send one request through the circuit breaker; the response for any status below 500.
+
+        Raises FirestoreUnavailable without calling Firestore while the circuit
+        is open, and when the request fails, times out or gets a 5xx/429.
+        """
+        if not self.breaker.allow():
+            raise FirestoreUnavailable("Firestore circuit is open")
+        default_headers = {
+            'Content-Type': 'application/json',
+        }
+        if headers:
+            default_headers.update(headers)
+
+        started = time.monotonic()
+        outcome_recorded = False
+        try:
+            try:
+                if method.upper() == 'GET':
+                    response = requests.get(url, headers=default_headers, timeout=self.timeout)
+                elif method.upper() == 'POST':
+                    response = requests.post(url, json=data, headers=default_headers, timeout=self.timeout)
+                elif method.upper() == 'PATCH':
+                    response = requests.patch(url, json=data, headers=default_headers, timeout=self.timeout)
+                else:
+                    raise ValueError(f"Unsupported HTTP method: {method}")
+            except requests.exceptions.RequestException as e:
+                outcome_recorded = True
+                self.breaker.record_failure(str(e), time.monotonic() - started)
+                raise FirestoreUnavailable(f"{method} request failed: {e}", maybe_applied=(
+                    method.upper() != 'GET' and not isinstance(e, requests.exceptions.ConnectTimeout)))
+
+            elapsed = time.monotonic() - started
+            if response.status_code >= 500 or response.status_code == 429:
+                error = FirestoreUnavailable.from_response(f"{method} request", response)
+                error.maybe_applied = method.upper() != 'GET' and response.status_code != 429
+                outcome_recorded = True
+                self.breaker.record_failure(str(error), elapsed)
+                raise error
+            outcome_recorded = True
+            self.breaker.record_success(elapsed)
+            return response
+        finally:
+            # Anything else (a body that can't be encoded, a bad method, an interrupt)
+            # says nothing about Firestore, but must not leave a half-open probe taken
+            if not outcome_recorded:
+                self.breaker.release_probe()
+
     def _make_request(self, method: str, url: str, data: Optional[Dict] = None, headers: Optional[Dict] = None) -> Optional[Dict]:
         """Make HTTP request to Firestore REST API"""
         try:
-            default_headers = {
-                'Content-Type': 'application/json',
-            }
-            if headers:
-                default_headers.update(headers)
-            
-            if method.upper() == 'GET':
-                response = requests.get(url, headers=default_headers)
-            elif method.upper() == 'POST':
-                response = requests.post(url, json=data, headers=default_headers)
-            elif method.upper() == 'PATCH':
-                response = requests.patch(url, json=data, headers=default_headers)
-            else:
-                logger.error(f"Unsupported HTTP method: {method}")
-                return None
+            response = self._send(method, url, data, headers)
             
             if response.status_code in [200, 201]:
                 return response.json()
@@ -51,11 +149,14 @@ class FirestoreService:
                 logger.error(f"Request failed with status {response.status_code}: {response.text}")
                 return None
                 
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error making request: {e}")
             return None
     
-    def _convert_firestore_doc(self, firestore_doc: Dict) -> Dict[str, Any]:
+    @staticmethod
+    def _convert_firestore_doc(firestore_doc: Dict) -> Dict[str, Any]:
         """Convert Firestore document format to simple dict"""
         if not firestore_doc or 'fields' not in firestore_doc:
             return {}
@@ -73,39 +174,46 @@ class FirestoreService:
             elif 'timestampValue' in value_obj:
                 result[key] = value_obj['timestampValue']
             else:
-                result[key] = str(value_obj)
+                # Maps, arrays, nulls
+                result[key] = decode_value(value_obj)
         
         return result
     
-    def _convert_to_firestore_fields(self, data: Dict[str, Any]) -> Dict:
+    @staticmethod
+    def _convert_to_firestore_fields(data: Dict[str, Any]) -> Dict:
         """Convert simple dict to Firestore document format"""
         fields = {}
         for key, value in data.items():
             if isinstance(value, str):
                 fields[key] = {'stringValue': value}
+            elif isinstance(value, bool):
+                # Before int: bool is a subclass of int
+                fields[key] = {'booleanValue': value}
             elif isinstance(value, int):
                 fields[key] = {'integerValue': str(value)}
             elif isinstance(value, float):
                 fields[key] = {'doubleValue': value}
-            elif isinstance(value, bool):
-                fields[key] = {'booleanValue': value}
             else:
-                fields[key] = {'stringValue': str(value)}
+                # Datetimes, dicts, lists, None
+                fields[key] = encode_value(value)
         
         return {'fields': fields}
     
     def check_token_availability(self, user_id: str) -> bool:
         """Check if user has tokens available"""
         try:
-            user_doc = self.get_user_profile(user_id)
-            if user_doc:
-                token_count = user_doc.get('tokenCount', 0)
+            if self.leases and self.leases.available(user_id) > 0:
+                return True
+            token_count = self.get_token_count(user_id)
+            if token_count is not None:
                 logger.info(f"User {user_id} has {token_count} tokens")
                 return token_count > 0
             else:
                 logger.warning(f"User {user_id} not found in Firestore")
                 return False
                 
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error checking token availability for user {user_id}: {e}")
             return False
@@ -113,13 +221,24 @@ class FirestoreService:
     def consume_token(self, user_id: str) -> bool:
         """Consume one token from user's account"""
         try:
-            # Get current user profile
-            user_profile = self.get_user_profile(user_id)
-            if not user_profile:
+            if self.leases:
+                consumed = self.leases.consume(user_id)
+                if not consumed:
+                    logger.error(f"User {user_id} not found or has no tokens to consume")
+                return consumed
+
+            if self.write_behind:
+                consumed = self.write_behind.consume(user_id)
+                if not consumed:
+                    logger.error(f"User {user_id} not found or has no tokens to consume")
+                return consumed
+
+            # Read-modify-write needs the stored count, not a cached one
+            current_tokens = self.get_token_count(user_id, use_cache=False)
+            if current_tokens is None:
                 logger.error(f"User {user_id} not found when consuming token")
                 return False
             
-            current_tokens = user_profile.get('tokenCount', 0)
             if current_tokens <= 0:
                 logger.error(f"User {user_id} has no tokens to consume")
                 return False
@@ -136,6 +255,8 @@ class FirestoreService:
             
             return success
             
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error consuming token for user {user_id}: {e}")
             return False
@@ -143,13 +264,26 @@ class FirestoreService:
     def add_tokens(self, user_id: str, tokens_to_add: int) -> bool:
         """Add tokens to user's account"""
         try:
-            # Get current user profile
-            user_profile = self.get_user_profile(user_id)
-            if not user_profile:
+            if self.leases:
+                # Leases change tokenCount concurrently, so add with an increment rather than a rewrite
+                new_token_count = self.increment_token_count(user_id, tokens_to_add)
+                logger.info(f"Added {tokens_to_add} tokens for user {user_id}. New total: {new_token_count}")
+                return True
+
+            if self.write_behind:
+                new_token_count = self.write_behind.add(user_id, tokens_to_add)
+                if new_token_count is None:
+                    logger.error(f"User {user_id} not found when adding tokens")
+                    return False
+                logger.info(f"Added {tokens_to_add} tokens for user {user_id}. New total: {new_token_count}")
+                return True
+
+            # Read-modify-write needs the stored count, not a cached one
+            current_tokens = self.get_token_count(user_id, use_cache=False)
+            if current_tokens is None:
                 logger.error(f"User {user_id} not found when adding tokens")
                 return False
             
-            current_tokens = user_profile.get('tokenCount', 0)
             new_token_count = current_tokens + tokens_to_add
             
             # Update token count
@@ -164,59 +298,184 @@ class FirestoreService:
             
             return success
             
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error adding tokens for user {user_id}: {e}")
             return False
     
-    def get_user_profile(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """Get user profile from Firestore"""
+    def _get_document(self, path: str, field_paths: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """The raw Firestore document at path (e.g. 'users/<uid>'), or None when it does not exist.
+
+        Unlike _make_request this tells a missing document apart from a failed
+        request, raising FirestoreError for the latter. field_paths limits the
+        read to those fields (a projection via mask.fieldPaths).
+        """
+        url = f"{self.base_url}/{path}?key={self.api_key}"
+        if field_paths:
+            url += ''.join(f"&mask.fieldPaths={quote(field)}" for field in field_paths)
+        response = self._send('GET', url)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise FirestoreError.from_response(f"Reading {path}", response)
+        return response.json()
+
+    def _commit(self, writes: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Apply writes atomically in one commit; the commit response (writeResults, commitTime)"""
+        response = self._send('POST', f"{self.base_url}:commit?key={self.api_key}", {'writes': writes})
+        if response.status_code != 200:
+            raise FirestoreError.from_response("Commit", response)
+        return response.json()
+
+    def _document_name(self, path: str) -> str:
+        return f"{self.document_root}/{path}"
+
+    def _load_user_profile(self, user_id: str, field_paths: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """Fetch a profile from Firestore: the profile, None when the user does not exist.
+
+        Raises FirestoreError when the read fails, so a failure is never cached
+        as a missing user.
+        """
+        document = self._get_document(f"users/{user_id}", field_paths)
+        return self._convert_firestore_doc(document) if document is not None else None
+
+    def get_user_profile(self, user_id: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """Get user profile from Firestore, served from the profile cache unless use_cache is False"""
         try:
-            url = f"{self.base_url}/users/{user_id}?key={self.api_key}"
-            response = self._make_request('GET', url)
-            
-            if response:
-                user_data = self._convert_firestore_doc(response)
+            if use_cache:
+                user_data = self.profile_cache.get(user_id)
+            else:
+                user_data = self._load_user_profile(user_id)
+
+            if user_data is not None:
                 logger.info(f"Retrieved profile for user {user_id}")
+                if self.write_behind or self.leases:
+                    user_data['tokenCount'] = self._with_local_tokens(user_id, user_data.get('tokenCount', 0))
                 return user_data
             else:
                 logger.warning(f"User {user_id} not found in Firestore")
                 return None
                 
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error getting user profile for {user_id}: {e}")
             return None
     
-    def create_user_profile(self, user_id: str, email: str, name: str = "", photo_url: str = "") -> bool:
-        """Create a new user profile"""
+    def get_user_fields(self, user_id: str, field_paths: List[str]) -> Optional[Dict[str, Any]]:
+        """Read only field_paths of a user's profile from Firestore (bypasses the profile cache).
+
+        Fields the document lacks are absent from the result; None when the user
+        does not exist or the read fails.
+        """
+        try:
+            return self._load_user_profile(user_id, field_paths)
+        except FirestoreUnavailable:
+            raise
+        except Exception as e:
+            logger.error(f"Error reading {', '.join(field_paths)} for {user_id}: {e}")
+            return None
+
+    def get_token_count(self, user_id: str, use_cache: bool = True) -> Optional[int]:
+        """The user's token count, or None when the user does not exist or cannot be read.
+
+        Served from a fresh cached profile when there is one; otherwise only
+        tokenCount is fetched, without populating the profile cache.
+        """
+        if use_cache:
+            cached, profile = self.profile_cache.peek(user_id)
+            if cached:
+                return self._with_local_tokens(user_id, profile.get('tokenCount', 0)) if profile is not None else None
+        fields = self.get_user_fields(user_id, ['tokenCount'])
+        if fields is None:
+            return None
+        return self._with_local_tokens(user_id, fields.get('tokenCount', 0))
+
+    def _with_local_tokens(self, user_id: str, stored_count: int) -> int:
+        """A stored token count adjusted for tokens this server holds: its lease, or
+        write-behind deltas not yet in Firestore"""
+        if self.leases:
+            return int(stored_count) + self.leases.available(user_id)
+        if not self.write_behind:
+            return int(stored_count)
+        known = self.write_behind.token_count(user_id)
+        return known if known is not None else int(stored_count) + self.write_behind.unflushed(user_id)
+
+    def increment_token_count(self, user_id: str, delta: int) -> int:
+        """Atomically add delta to an existing user's tokenCount; the new stored count"""
+        result = self._commit([{
+            'update': {'name': self._document_name(f"users/{user_id}")},
+            'updateMask': {'fieldPaths': []},
+            'updateTransforms': [
+                {'fieldPath': 'tokenCount', 'increment': {'integerValue': str(delta)}},
+                {'fieldPath': 'updatedAt', 'setToServerValue': 'REQUEST_TIME'}
+            ],
+            'currentDocument': {'exists': True}
+        }])
+        self.profile_cache.invalidate(user_id)
+        return int(decode_value(result['writeResults'][0]['transformResults'][0]))
+
+    def create_user_profile_if_absent(self, user_id: str, email: str = "", name: str = "",
+                                      photo_url: str = "") -> Tuple[Dict[str, Any], bool]:
+        """Create the user's profile unless it exists: (profile, created).
+
+        Most callers are returning users, so the profile is read first (through
+        the profile cache) and returned when it exists. Only when the read finds
+        nothing is the create sent: a single commit with an exists=false
+        precondition, with createdAt/updatedAt set to the server's request time.
+        If another request created the profile in between, the stored profile
+        is read and returned. Raises FirestoreError when neither works.
+        """
+        cached, profile = self.profile_cache.peek(user_id)
+        if not cached:
+            profile = self.get_user_profile(user_id)
+        if profile is not None:
+            return profile, False
+
+        user_data = {
+            'uid': user_id,
+            'email': email,
+            'name': name,
+            'photoUrl': photo_url,
+            'tokenCount': INITIAL_TOKEN_COUNT
+        }
+        write = {
+            'update': {'name': self._document_name(f"users/{user_id}"), **self._convert_to_firestore_fields(user_data)},
+            'currentDocument': {'exists': False},
+            'updateTransforms': [
+                {'fieldPath': 'createdAt', 'setToServerValue': 'REQUEST_TIME'},
+                {'fieldPath': 'updatedAt', 'setToServerValue': 'REQUEST_TIME'}
+            ]
+        }
         try:
-            # Check if user already exists
-            if self.get_user_profile(user_id):
+            result = self._commit([write])
+        except FirestoreError as e:
+            if e.status_code != 409 and e.status != 'ALREADY_EXISTS':
+                raise
+            # Created since the read above; a cached "not found" is out of date
+            self.profile_cache.invalidate(user_id)
+            existing = self.get_user_profile(user_id)
+            if existing is not None:
                 logger.info(f"User {user_id} already exists")
-                return True
-            
-            # Create new user profile
-            user_data = {
-                'uid': user_id,
-                'email': email,
-                'name': name,
-                'photoUrl': photo_url,
-                'tokenCount': 5,  # Initial token count
-                'createdAt': '2024-01-01T00:00:00Z',
-                'updatedAt': '2024-01-01T00:00:00Z'
-            }
-            
-            firestore_data = self._convert_to_firestore_fields(user_data)
-            url = f"{self.base_url}/users/{user_id}?key={self.api_key}"
-            
-            response = self._make_request('PATCH', url, firestore_data)
-            
-            if response:
-                logger.info(f"Created user profile for {user_id}")
-                return True
-            else:
-                logger.error(f"Failed to create user profile for {user_id}")
-                return False
-            
+                return existing, False
+            raise FirestoreError(f"Profile for {user_id} exists but could not be read")
+
+        transforms = result.get('writeResults', [{}])[0].get('transformResults', [])
+        created_at = decode_value(transforms[0]) if transforms else result.get('commitTime')
+        user_data['createdAt'] = user_data['updatedAt'] = created_at
+        # The whole document was just written, so it can be cached as is
+        self.profile_cache.put(user_id, user_data)
+        logger.info(f"Created user profile for {user_id}")
+        return user_data, True
+
+    def create_user_profile(self, user_id: str, email: str, name: str = "", photo_url: str = "") -> bool:
+        """Create a new user profile; True when it was created or already exists"""
+        try:
+            self.create_user_profile_if_absent(user_id, email, name, photo_url)
+            return True
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error creating user profile for {user_id}: {e}")
             return False
@@ -228,6 +487,8 @@ class FirestoreService:
             url = f"{self.base_url}/users/{user_id}?key={self.api_key}&updateMask.fieldPaths=" + "&updateMask.fieldPaths=".join(update_data.keys())
             
             response = self._make_request('PATCH', url, firestore_data)
+            # Invalidate even on failure: the write may have landed before the error
+            self.profile_cache.invalidate(user_id)
             
             if response:
                 logger.info(f"Updated user profile for {user_id}")
@@ -236,6 +497,8 @@ class FirestoreService:
                 logger.error(f"Failed to update user profile for {user_id}")
                 return False
             
+        except FirestoreUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error updating user profile for {user_id}: {e}")
             return False
@@ -5,15 +5,190 @@ import base64
 import os
 import requests
 import io
+import re
+import json
+import queue
+import threading
 from styles import styles
+from cdp_driver import CDPPage, CDPError, XPATH_JS
+from generator_backend import GeneratorBackend, TAB_WAIT_SECONDS
 
-class Gen:
-    def __init__(self, worker_id=None):
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Generator iframe on the perchance page, and the prompt textarea inside it
+GENERATOR_IFRAME_XPATH = "/html/body/div[3]/div[3]/div[1]/div[2]/div[1]/div[1]/iframe"
+PROMPT_TEXTAREA_XPATH = "/html/body/div[1]/div[1]/div[2]/div/div[2]/div[1]/textarea"
+# Inside the generator iframe: generate button, style dropdown and result frames
+GENERATE_BUTTON_XPATH = "/html/body/div[1]/div[3]/div[1]/button"
+STYLE_SELECT_XPATH = "/html/body/div[1]/div[1]/div[4]/div/div[2]/select"
+RESULT_IFRAME_XPATH = "/html/body/div[1]/div[4]/div[{index}]/iframe"
+RESULT_IMAGE_XPATH = "/html/body/div[1]/main/div[2]/img"
+GENERATOR_PAGE_URL = "https://perchance.org/unrestricted-ai-image-generator"
+
+# Results perchance renders per click, unless a job sets the page's image-count
+# dropdown to the fewest images covering its requested variants (cached per tab).
+# GEN_IMAGE_COUNT_XPATH pins the dropdown inside the generator iframe; otherwise
+# a numeric select labelled as an image count is looked up.
+DEFAULT_RESULT_COUNT = 6
+SET_IMAGE_COUNT = os.getenv('GEN_SET_IMAGE_COUNT', '1') == '1'
+IMAGE_COUNT_XPATH = os.getenv('GEN_IMAGE_COUNT_XPATH', '')
+IMAGE_COUNT_JS = """(function (count, xpath) {
+    const numeric = (option) => /^\\s*\\d+\\s*$/.test(option.value || option.text);
+    let select = null;
+    if (xpath) {
+        select = document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    } else {
+        select = Array.from(document.querySelectorAll('select')).find((s) =>
+            s.options.length > 1 && Array.from(s.options).every(numeric) &&
+            /image|count|number|how many/i.test((s.parentElement || s).textContent + ' ' + (s.name || '') + ' ' + (s.id || '')));
+    }
+    if (!select) return null;
+    const values = Array.from(select.options).map((o) => parseInt(o.value || o.text, 10));
+    const covering = values.filter((n) => n >= count);
+    const chosen = covering.length ? Math.min(...covering) : Math.max(...values);
+    const index = values.indexOf(chosen);
+    if (select.selectedIndex !== index) {
+        select.selectedIndex = index;
+        select.dispatchEvent(new Event('change', {bubbles: true}));
+    }
+    return chosen;
+})"""
+
+# Bounds on Selenium calls, so one stuck page cannot block the worker forever
+PAGE_LOAD_TIMEOUT = int(os.getenv('GEN_PAGE_LOAD_TIMEOUT', 30))
+SCRIPT_TIMEOUT = int(os.getenv('GEN_SCRIPT_TIMEOUT', 15))
+# A job's render wait plus extraction must end within the watchdog's JOB_BUDGET_SECONDS
+EXTRACT_TIMEOUT = int(os.getenv('GEN_EXTRACT_TIMEOUT', 15))
+# Time the page gets to render after the generate click before results are scanned
+RENDER_WAIT_SECONDS = 15
+
+# Network-level blocking of third-party page resources through Chrome DevTools.
+# Patterns use CDP wildcards ('*'). A deny pattern overlapping an allow pattern
+# is dropped, so the perchance pages themselves are never blocked.
+RESOURCE_BLOCKING = os.getenv('GEN_RESOURCE_BLOCKING', '0') == '1'
+DEFAULT_BLOCKED_URL_PATTERNS = [
+    "*googletagmanager.com/*",
+    "*google-analytics.com/*",
+    "*doubleclick.net/*",
+    "*googlesyndication.com/*",
+    "*googleadservices.com/*",
+    "*adservice.google.com/*",
+    "*amazon-adsystem.com/*",
+    "*static.cloudflareinsights.com/*",
+    "*fonts.googleapis.com/*",
+    "*fonts.gstatic.com/*",
+    "*.woff2",
+    "*.woff",
+    "*.ttf",
+]
+DEFAULT_ALLOWED_URL_PATTERNS = [
+    "*://perchance.org/*",
+    "*://*.perchance.org/*",
+]
+
+# How finished images are picked up: 'dom' reads data URLs out of the result
+# iframes; 'network' takes the image response bytes from Chrome's CDP network
+# events as soon as they finish loading, with a short DOM fallback.
+IMAGE_CAPTURE_MODE = os.getenv('GEN_IMAGE_CAPTURE', 'dom')
+CAPTURE_URL_PATTERN = os.getenv('GEN_CAPTURE_URL_PATTERN', '*image-generation.perchance.org/api/downloadTemporaryImage*')
+CAPTURE_POLL_SECONDS = 0.25
+CAPTURE_FALLBACK_TIMEOUT = int(os.getenv('GEN_CAPTURE_FALLBACK_TIMEOUT', 5))
+
+# 'selenium' drives jobs through chromedriver; 'cdp' sends them to the page over a
+# direct DevTools websocket once the Selenium-driven initialization has finished
+DRIVER_BACKEND = os.getenv('GEN_DRIVER_BACKEND', 'selenium')
+
+# Generator tabs per browser, each running its own job. Jobs share the single
+# chromedriver session, which is held only while a tab is being driven, not while
+# it waits for its image. Multiple tabs need the Selenium backend with 'dom' capture.
+GEN_TABS = int(os.getenv('GEN_TABS', 1))
+TAB_POLL_SECONDS = 0.5
+
+def url_patterns_from_env(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return list(default)
+    return [pattern.strip() for pattern in value.split(',') if pattern.strip()]
+
+BLOCKED_URL_PATTERNS = url_patterns_from_env('GEN_BLOCKED_URLS', DEFAULT_BLOCKED_URL_PATTERNS)
+ALLOWED_URL_PATTERNS = url_patterns_from_env('GEN_ALLOWED_URLS', DEFAULT_ALLOWED_URL_PATTERNS)
+
+def wildcard_match(text, pattern):
+    regex = '.*'.join(re.escape(part) for part in pattern.split('*'))
+    return re.fullmatch(regex, text) is not None
+
+def effective_blocked_patterns(blocked, allowed):
+    """Deny patterns that do not overlap any allow pattern.
+
+    Network.setBlockedURLs has no allow list of its own, so an allow pattern
+    wins by removing every deny pattern that would match it (or that it matches).
+    """
+    kept = []
+    for pattern in blocked:
+        overlap = next((a for a in allowed if wildcard_match(a, pattern) or wildcard_match(pattern, a)), None)
+        if overlap is not None:
+            print(f"Not blocking {pattern!r}: overlaps allowed pattern {overlap!r}")
+            continue
+        kept.append(pattern)
+    return kept
+
+def process_tree_rss(root_pids):
+    """Resident memory in bytes of the given processes and all their descendants"""
+    root_pids = [pid for pid in root_pids if pid]
+    if psutil is not None:
+        seen = {}
+        for pid in root_pids:
+            try:
+                root = psutil.Process(pid)
+                for proc in [root] + root.children(recursive=True):
+                    if proc.pid not in seen:
+                        seen[proc.pid] = proc.memory_info().rss
+            except psutil.Error:
+                continue
+        return sum(seen.values())
+
+    # Linux fallback without psutil: walk /proc for the parent/child tree
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as fh:
+                # The command name may contain spaces; fields resume after ')'
+                ppid = int(fh.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    seen = set()
+    stack = list(root_pids)
+    while stack:
+        pid = stack.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        try:
+            with open(f'/proc/{pid}/statm') as fh:
+                total += int(fh.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        stack.extend(children.get(pid, []))
+    return total
+
+class Gen(GeneratorBackend):
+    """Generator backend that drives the perchance page in headless Chrome"""
+
+    name = 'selenium'
+
+    def __init__(self, worker_id=None, block_resources=None, capture_mode=None, driver_backend=None, tabs=None):
         # Use worker_id to create separate directories and profiles
-        if worker_id is None:
-            worker_id = os.getenv('WORKER_ID', 'default')
-        
-        self.worker_id = worker_id
+        super().__init__(worker_id)
+        worker_id = self.worker_id
         
         # Telegram bot configuration
         self.SECOND_BOT_TOKEN = os.getenv('SECOND_BOT_TOKEN')
@@ -31,13 +206,47 @@ class Gen:
         print(f"  - Downloads: {self.downloaded_files}")
         
         self.driver = None
-        url = "https://perchance.org/unrestricted-ai-image-generator"
+        # Request blocking and the page metrics used to compare it against a plain load
+        self.block_resources = RESOURCE_BLOCKING if block_resources is None else block_resources
+        self.blocked_url_patterns = effective_blocked_patterns(BLOCKED_URL_PATTERNS, ALLOWED_URL_PATTERNS) if self.block_resources else []
+        self.page_metrics = None
+        self.init_seconds = None
+        self.init_rss_bytes = None
+        self.capture_mode = capture_mode or IMAGE_CAPTURE_MODE
+        if self.capture_mode not in ('dom', 'network'):
+            raise ValueError(f"capture_mode must be 'dom' or 'network', got {self.capture_mode!r}")
+        self.network_captures = 0
+        self.capture_fallbacks = 0
+        self.last_capture_seconds = None
+        self.driver_backend = driver_backend or DRIVER_BACKEND
+        if self.driver_backend not in ('selenium', 'cdp'):
+            raise ValueError(f"driver_backend must be 'selenium' or 'cdp', got {self.driver_backend!r}")
+        self.cdp = None
+        self.cdp_error = None
+        # Generator tabs and the job slots handed out over them
+        self.tab_count = max(1, tabs if tabs is not None else GEN_TABS)
+        if self.tab_count > 1 and (self.capture_mode != 'dom' or self.driver_backend != 'selenium'):
+            print(f"Worker {self.worker_id}: Multiple tabs need the Selenium backend with dom capture, using one tab")
+            self.tab_count = 1
+        self._free_tabs = queue.Queue()
+        self._current_tab = None
+        self.driver_lock = threading.RLock()
+        # Image count per tab: {tab: (requested variants, count set on the page)}
+        self.image_count_supported = SET_IMAGE_COUNT
+        self._image_counts = {}
+        self.image_count_changes = 0
+        self.job_seconds_by_count = {}
+        url = GENERATOR_PAGE_URL
         try:
             # Set up driver without chrome profile
             self.driver = Driver(
                 uc=True, 
-                headless=True
+                headless=True,
+                # Chrome's network events are only readable through the performance log
+                log_cdp_events=self.capture_mode == 'network'
             )
+            self.driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+            self.driver.set_script_timeout(SCRIPT_TIMEOUT)
 
             self.driver.uc_open_with_reconnect('https://perchance.org', 1)
             print(f"Worker {self.worker_id}: Perchance page opened")
@@ -58,19 +267,25 @@ class Gen:
             self.driver.execute_script("window.localStorage.setItem('okayToShowNsfwUntil', '2066299973569');")
             print(f"Worker {self.worker_id}: LocalStorage set for image generation page")
 
-            self.driver.uc_open_with_reconnect(url, 1)
+            if self.blocked_url_patterns:
+                # uc_open_with_reconnect loads in a fresh tab, before blocking could
+                # be applied to it, so the generator page is loaded in this one
+                self.apply_resource_blocking()
+                self.driver.get(url)
+            else:
+                self.driver.uc_open_with_reconnect(url, 1)
             print(f"Worker {self.worker_id}: Page opened")
 
             time.sleep(5)  # Wait for the page to load
+            self.record_page_metrics()
+            self.tab_handles.append(self.driver.current_window_handle)
 
-            self.driver.switch_to.frame(self.driver.find_element("xpath", "/html/body/div[3]/div[3]/div[1]/div[2]/div[1]/div[1]/iframe"))
+            self.driver.switch_to.frame(self.driver.find_element("xpath", GENERATOR_IFRAME_XPATH))
             print(f"Worker {self.worker_id}: Switched to iframe")
 
             time.sleep(1)  # Wait for the iframe to load
 
-            self.generation("girl")
-
-            img = self.extract_images(count = 6)
+            img = self.generate_and_capture("girl")
             if img:
                 print(f"Worker {self.worker_id}: Image extracted successfully")
                 # Save to worker-specific directory
@@ -83,10 +298,97 @@ class Gen:
                 self.send_image_to_telegram_bot(img, "girl", "initialization")
             else:
                 print(f"Worker {self.worker_id}: No image found")    
+            for _ in range(self.tab_count - 1):
+                self.open_generator_tab(url)
+            if len(self.tab_handles) > 1:
+                self.focus_tab(self.tab_handles[0], force=True)
+            for handle in self.tab_handles:
+                self._free_tabs.put(handle)
             print(f"Worker {self.worker_id}: Initialization complete")
-        except:
+            self.init_seconds = time.time() - self.created_at
+            self.init_rss_bytes = self.measure_rss()
+            if self.driver_backend == 'cdp':
+                self.attach_cdp()
+            self.state = "ready"
+        except Exception as e:
             traceback.print_exc()
+            # Tabs opened before the failure never became free; jobs must not wait for them
+            self.tab_handles.clear()
+            self.state = "failed"
+            self.init_error = str(e)
     
+    def open_generator_tab(self, url):
+        """Open another generator tab in this browser for concurrent jobs"""
+        self.driver.switch_to.new_window('tab')
+        if self.blocked_url_patterns:
+            self.apply_resource_blocking()
+        self.driver.get(url)
+        time.sleep(5)  # Wait for the page to load
+        self.tab_handles.append(self.driver.current_window_handle)
+        self._current_tab = None
+        print(f"Worker {self.worker_id}: Opened generator tab {len(self.tab_handles)}")
+
+    def focus_tab(self, handle, force=False):
+        """Point the driver at the generator iframe of a tab; caller holds driver_lock"""
+        if handle == self._current_tab and not force:
+            return
+        self.driver.switch_to.window(handle)
+        self.driver.switch_to.default_content()
+        self.driver.switch_to.frame(self.driver.find_element("xpath", GENERATOR_IFRAME_XPATH))
+        self._current_tab = handle
+
+    def acquire_tab(self, blocking=True, timeout=TAB_WAIT_SECONDS):
+        """Reserve a free generator tab; None if the browser has none, or none is free when not blocking.
+
+        A blocking wait raises RuntimeError once the browser stops being ready
+        (failed or aborted) or no tab came free within timeout.
+        """
+        if not self.tab_handles:
+            return None
+        if not blocking:
+            try:
+                return self._free_tabs.get(block=False)
+            except queue.Empty:
+                return None
+        deadline = time.time() + timeout
+        while True:
+            if not self.is_ready():
+                raise RuntimeError(f"browser is {self.state}, no tab to run the job")
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError(f"no generator tab came free within {timeout}s")
+            try:
+                return self._free_tabs.get(timeout=min(remaining, TAB_POLL_SECONDS))
+            except queue.Empty:
+                continue
+
+    def release_tab(self, handle):
+        if handle is not None:
+            self._free_tabs.put(handle)
+
+    def apply_resource_blocking(self):
+        """Block the configured URL patterns for the current tab via CDP"""
+        self.driver.execute_cdp_cmd('Network.enable', {})
+        self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': self.blocked_url_patterns})
+        print(f"Worker {self.worker_id}: Blocking {len(self.blocked_url_patterns)} URL patterns")
+
+    def record_page_metrics(self):
+        """Navigation timing and resource totals of the generator page, as the browser saw them"""
+        try:
+            self.page_metrics = self.driver.execute_script("""
+                const nav = performance.getEntriesByType('navigation')[0];
+                const resources = performance.getEntriesByType('resource');
+                return {
+                    load_ms: nav ? Math.round(nav.loadEventEnd - nav.startTime) : null,
+                    dom_content_loaded_ms: nav ? Math.round(nav.domContentLoadedEventEnd - nav.startTime) : null,
+                    resources: resources.length,
+                    transfer_kb: Math.round(resources.reduce((sum, r) => sum + (r.transferSize || 0), 0) / 1024)
+                };
+            """)
+            print(f"Worker {self.worker_id}: Page metrics: {self.page_metrics}")
+        except Exception as e:
+            print(f"Worker {self.worker_id}: Could not read page metrics: {e}")
+
     def send_image_to_telegram_bot(self, image_b64, prompt, style="initialization"):
         """Send generated image to the Telegram bot"""
         if not self.SECOND_BOT_TOKEN:
@@ -122,43 +424,169 @@ class Gen:
             print(f"Worker {self.worker_id}: Error sending {style} image to Telegram bot: {e}")
             return False
 
-    def extract_images(self, count=6):
-        is_success = False
+    def scan_result_frames(self, count=6):
+        """One pass over the result iframes; the first base64 image found, or None"""
         base64_data = None
-        while not is_success:
-            for i in range(count):
-                try:
-                    self.driver.switch_to.frame(self.driver.find_element("xpath", f"/html/body/div[1]/div[4]/div[{i+1}]/iframe"))
-                    print(f"Worker {self.worker_id}: Switched to iframe")
-                    img_element = self.driver.find_element("xpath", "/html/body/div[1]/main/div[2]/img")
-                    img_url = img_element.get_attribute("src")
-                    
-                    if img_url.startswith("data:image/jpeg;base64,") or img_url.startswith("data:image/png;base64,") or img_url.startswith("data:image/jpg;base64,"):
-                        base64_data = img_url.split(",")[1]
-                        is_success = True
-                        break
-                    else:
-                        print(f"Worker {self.worker_id}: Image URL is not in base64 format")
-                except Exception as e:
-                    print(f"Worker {self.worker_id}: Error extracting image {i+1}")
-                self.driver.switch_to.default_content()  # Switch back to the main content
-                print(f"Worker {self.worker_id}: Switched back to main content")
-                self.driver.switch_to.frame(self.driver.find_element("xpath", "/html/body/div[3]/div[3]/div[1]/div[2]/div[1]/div[1]/iframe"))
+        for i in range(count):
+            try:
+                self.driver.switch_to.frame(self.driver.find_element("xpath", RESULT_IFRAME_XPATH.format(index=i + 1)))
                 print(f"Worker {self.worker_id}: Switched to iframe")
+                img_element = self.driver.find_element("xpath", RESULT_IMAGE_XPATH)
+                img_url = img_element.get_attribute("src")
+                
+                if img_url.startswith("data:image/jpeg;base64,") or img_url.startswith("data:image/png;base64,") or img_url.startswith("data:image/jpg;base64,"):
+                    base64_data = img_url.split(",")[1]
+                    break
+                else:
+                    print(f"Worker {self.worker_id}: Image URL is not in base64 format")
+            except Exception as e:
+                print(f"Worker {self.worker_id}: Error extracting image {i+1}")
             self.driver.switch_to.default_content()  # Switch back to the main content
             print(f"Worker {self.worker_id}: Switched back to main content")
-            self.driver.switch_to.frame(self.driver.find_element("xpath", "/html/body/div[3]/div[3]/div[1]/div[2]/div[1]/div[1]/iframe"))
+            self.driver.switch_to.frame(self.driver.find_element("xpath", GENERATOR_IFRAME_XPATH))
             print(f"Worker {self.worker_id}: Switched to iframe")
+        self.driver.switch_to.default_content()  # Switch back to the main content
+        print(f"Worker {self.worker_id}: Switched back to main content")
+        self.driver.switch_to.frame(self.driver.find_element("xpath", GENERATOR_IFRAME_XPATH))
+        print(f"Worker {self.worker_id}: Switched to iframe")
         return base64_data
 
-    def generation(self, prompt, style="default"):
-        self.driver.find_element("xpath", "/html/body/div[1]/div[1]/div[2]/div/div[2]/div[1]/textarea").clear()
-        self.driver.find_element("xpath", "/html/body/div[1]/div[1]/div[2]/div/div[2]/div[1]/textarea").send_keys(prompt)  # Enter a test prompt
+    def extract_images(self, count=6, timeout=EXTRACT_TIMEOUT):
+        deadline = time.time() + timeout
+        while True:
+            if self.aborted:
+                raise RuntimeError("job aborted")
+            if time.time() > deadline:
+                print(f"Worker {self.worker_id}: No image after {timeout}s, giving up")
+                return None
+            base64_data = self.scan_result_frames(count)
+            if base64_data:
+                return base64_data
+
+    def play_in_tab(self, tab, prompt, style="default", variants=1):
+        """A job in one of several tabs, holding the driver only while this tab is driven"""
+        with self.driver_lock:
+            self.focus_tab(tab)
+            self.set_style(style)
+            results = self.set_image_count(variants, tab)
+            self.enter_prompt(prompt)
+            self.driver.find_element("xpath", GENERATE_BUTTON_XPATH).click()
+            print(f"Worker {self.worker_id}: Generate button clicked")
+        time.sleep(RENDER_WAIT_SECONDS)
+
+        deadline = time.time() + EXTRACT_TIMEOUT
+        while time.time() <= deadline:
+            if self.aborted:
+                raise RuntimeError("job aborted")
+            with self.driver_lock:
+                self.focus_tab(tab)
+                image = self.scan_result_frames(count = results)
+            if image:
+                return image
+            time.sleep(TAB_POLL_SECONDS)
+        print(f"Worker {self.worker_id}: No image after {EXTRACT_TIMEOUT}s, giving up")
+        return None
+
+    def drain_network_events(self):
+        """Read and discard buffered CDP events, so a capture only sees the current job"""
+        try:
+            self.driver.get_log('performance')
+        except Exception as e:
+            print(f"Worker {self.worker_id}: Could not read performance log: {e}")
+
+    def capture_network_image(self, timeout=EXTRACT_TIMEOUT):
+        """Wait for the first image response matching CAPTURE_URL_PATTERN and return it base64-encoded"""
+        started = time.time()
+        deadline = started + timeout
+        candidates = set()
+        while time.time() < deadline:
+            if self.aborted:
+                raise RuntimeError("job aborted")
+            for entry in self.driver.get_log('performance'):
+                try:
+                    event = json.loads(entry['message'])['message']
+                except (KeyError, TypeError, ValueError):
+                    continue
+                method = event.get('method')
+                params = event.get('params', {})
+                if method == 'Network.responseReceived':
+                    response = params.get('response', {})
+                    if response.get('mimeType', '').startswith('image/') and wildcard_match(response.get('url', ''), CAPTURE_URL_PATTERN):
+                        candidates.add(params.get('requestId'))
+                elif method == 'Network.loadingFinished' and params.get('requestId') in candidates:
+                    try:
+                        body = self.driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': params['requestId']})
+                    except Exception as e:
+                        print(f"Worker {self.worker_id}: Could not read image response body: {e}")
+                        continue
+                    data = self._response_body_base64(body)
+                    if data:
+                        self.last_capture_seconds = time.time() - started
+                        print(f"Worker {self.worker_id}: Image captured from network after {self.last_capture_seconds:.1f}s")
+                        return data
+            time.sleep(CAPTURE_POLL_SECONDS)
+        print(f"Worker {self.worker_id}: No image response after {timeout}s")
+        return None
+
+    @staticmethod
+    def _response_body_base64(body):
+        data = body.get('body', '')
+        if not body.get('base64Encoded'):
+            data = base64.b64encode(data.encode('latin-1')).decode('ascii')
+        return data
+
+    def generate_and_capture(self, prompt, results=DEFAULT_RESULT_COUNT):
+        """Submit prompt and return the first image (base64), using the configured capture mode"""
+        if self.capture_mode == 'network':
+            self.drain_network_events()
+            self.generation(prompt, wait_seconds=0)
+            image = self.capture_network_image()
+            if image:
+                self.network_captures += 1
+                return image
+            # The response may have been missed (e.g. served from cache); the DOM still has it
+            self.capture_fallbacks += 1
+            return self.extract_images(count = results, timeout=CAPTURE_FALLBACK_TIMEOUT)
+        self.generation(prompt)
+        return self.extract_images(count = results)
+
+    def set_image_count(self, variants=1, tab=None):
+        """Set the page's image count to cover variants; returns how many results to scan"""
+        if not self.image_count_supported:
+            return DEFAULT_RESULT_COUNT
+        cached = self._image_counts.get(tab)
+        if cached is not None and cached[0] == variants:
+            return cached[1]
+        try:
+            if self.cdp is not None:
+                chosen = self.cdp.evaluate_in_frame([GENERATOR_IFRAME_XPATH],
+                                                    f"({IMAGE_COUNT_JS})({int(variants)}, {json.dumps(IMAGE_COUNT_XPATH)})")
+            else:
+                chosen = self.driver.execute_script(f"return ({IMAGE_COUNT_JS})(arguments[0], arguments[1]);",
+                                                    int(variants), IMAGE_COUNT_XPATH)
+        except Exception as e:
+            print(f"Worker {self.worker_id}: Could not set image count: {e}")
+            return DEFAULT_RESULT_COUNT
+        if chosen is None:
+            self.image_count_supported = False
+            print(f"Worker {self.worker_id}: No image count setting on the page, keeping {DEFAULT_RESULT_COUNT} results per job")
+            return DEFAULT_RESULT_COUNT
+        self._image_counts[tab] = (variants, int(chosen))
+        self.image_count_changes += 1
+        print(f"Worker {self.worker_id}: Image count set to {chosen}")
+        return int(chosen)
+
+    def enter_prompt(self, prompt):
+        self.driver.find_element("xpath", PROMPT_TEXTAREA_XPATH).clear()
+        self.driver.find_element("xpath", PROMPT_TEXTAREA_XPATH).send_keys(prompt)  # Enter a test prompt
         print(f"Worker {self.worker_id}: Prompt entered")
 
-        self.driver.find_element("xpath", "/html/body/div[1]/div[3]/div[1]/button").click()  # Click the "Generate" button inside the iframe
+    def generation(self, prompt, style="default", wait_seconds=RENDER_WAIT_SECONDS):
+        self.enter_prompt(prompt)
+
+        self.driver.find_element("xpath", GENERATE_BUTTON_XPATH).click()  # Click the "Generate" button inside the iframe
         print(f"Worker {self.worker_id}: Generate button clicked")
-        time.sleep(15)
+        time.sleep(wait_seconds)
     
     def set_style(self, style="default"):
         # show style list with numbers        
@@ -169,19 +597,210 @@ class Gen:
         else:
             style_choice = styles.index(style) + 1 if style in styles else "1"
         # path /html/body/div[1]/div[1]/div[4]/div/div[2]/select
-        style_select = self.driver.find_element("xpath", "/html/body/div[1]/div[1]/div[4]/div/div[2]/select")
+        style_select = self.driver.find_element("xpath", STYLE_SELECT_XPATH)
         #select a style
         style_select.click()
         time.sleep(1)  # Wait for the dropdown to open
         # option path - /html/body/div[1]/div[1]/div[4]/div/div[2]/select/option[1], /html/body/div[1]/div[1]/div[4]/div/div[2]/select/option[2], ...
-        style_option = self.driver.find_element("xpath", f"/html/body/div[1]/div[1]/div[4]/div/div[2]/select/option[{int(style_choice)}]")
+        style_option = self.driver.find_element("xpath", f"{STYLE_SELECT_XPATH}/option[{int(style_choice)}]")
         style_option.click()
         print(f"Worker {self.worker_id}: Style selected: {styles[int(style_choice) - 1]}")
         time.sleep(1)  # Wait for the style to be applied
 
-    def play(self, prompt:str, style:str = "default"):
-        if prompt.strip() == "":
-            prompt = "girl"
-        self.set_style(style)  # Set default style
-        self.generation(prompt)  
-        return self.extract_images(count = 6)      
+    def attach_cdp(self):
+        """Open the direct DevTools connection used by the 'cdp' backend; falls back to Selenium on failure"""
+        try:
+            address = self.driver.capabilities.get('goog:chromeOptions', {}).get('debuggerAddress')
+            if not address:
+                raise CDPError("chromedriver did not report a debugger address")
+            self.cdp = CDPPage.attach(address, GENERATOR_PAGE_URL.split('://', 1)[1])
+            print(f"Worker {self.worker_id}: DevTools connection open on {address}")
+        except Exception as e:
+            self.cdp = None
+            self.cdp_error = str(e)
+            print(f"Worker {self.worker_id}: Could not attach DevTools connection, using Selenium: {e}")
+
+    def cdp_prepare(self, prompt, style="default"):
+        """Select the style and type the prompt through the DevTools connection"""
+        frame = [GENERATOR_IFRAME_XPATH]
+        index = styles.index(style) if style in styles else 0
+        select = XPATH_JS.format(xpath=json.dumps(STYLE_SELECT_XPATH))
+        self.cdp.evaluate_in_frame(frame, f"(() => {{ const s = {select}; s.selectedIndex = {index}; "
+                                          f"s.dispatchEvent(new Event('change', {{bubbles: true}})); }})()")
+        textarea = XPATH_JS.format(xpath=json.dumps(PROMPT_TEXTAREA_XPATH))
+        self.cdp.evaluate_in_frame(frame, f"(() => {{ const t = {textarea}; t.focus(); t.value = ''; }})()")
+        self.cdp.insert_text(prompt)
+        print(f"Worker {self.worker_id}: Style {styles[index]} selected and prompt entered over DevTools")
+
+    def cdp_scrape_results(self, count=6, timeout=CAPTURE_FALLBACK_TIMEOUT):
+        """Read a finished data-URL image out of the result frames over DevTools"""
+        image = XPATH_JS.format(xpath=json.dumps(RESULT_IMAGE_XPATH))
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.aborted:
+                raise RuntimeError("job aborted")
+            for i in range(count):
+                try:
+                    src = self.cdp.evaluate_in_frame([GENERATOR_IFRAME_XPATH, RESULT_IFRAME_XPATH.format(index=i + 1)],
+                                                     f"(() => {{ const img = {image}; return img ? img.src : null; }})()", cache=False)
+                except CDPError:
+                    continue
+                if src and src.startswith("data:image/"):
+                    return src.split(",", 1)[1]
+            time.sleep(CAPTURE_POLL_SECONDS)
+        return None
+
+    def cdp_generate_and_capture(self, prompt, style="default", variants=1, tab=None):
+        """The 'cdp' backend's job: prepare, click and take the image response as it arrives"""
+        self.cdp_prepare(prompt, style)
+        results = self.set_image_count(variants, tab)
+        button = XPATH_JS.format(xpath=json.dumps(GENERATE_BUTTON_XPATH))
+        self.cdp.connection.clear_events()
+        self.cdp.enable_network()
+        started = time.time()
+        try:
+            self.cdp.evaluate_in_frame([GENERATOR_IFRAME_XPATH], f"{button}.click()")
+            print(f"Worker {self.worker_id}: Generate button clicked over DevTools")
+            body = self.cdp.wait_for_response_body(lambda url: wildcard_match(url, CAPTURE_URL_PATTERN),
+                                                   EXTRACT_TIMEOUT, should_stop=lambda: self.aborted)
+        finally:
+            # Network events are only buffered while a job is waiting for them
+            try:
+                self.cdp.connection.call('Network.disable')
+            except CDPError:
+                pass
+        data = self._response_body_base64(body) if body else None
+        if data:
+            self.network_captures += 1
+            self.last_capture_seconds = time.time() - started
+            return data
+        self.capture_fallbacks += 1
+        return self.cdp_scrape_results(count=results)
+
+    def is_ready(self):
+        """True when the browser session initialized and can take jobs"""
+        return self.driver is not None and super().is_ready()
+
+    @property
+    def job_deadline_seconds(self):
+        """Longest a job runs by its own waits and timeouts"""
+        if self.cdp is None and self.capture_mode == 'dom':
+            return RENDER_WAIT_SECONDS + EXTRACT_TIMEOUT
+        # Network capture, then the short DOM fallback
+        return EXTRACT_TIMEOUT + CAPTURE_FALLBACK_TIMEOUT
+
+    def health(self):
+        """Snapshot of this browser's state for readiness checks"""
+        health = super().health()
+        health.update({
+            'state': self.state if self.driver is not None else "failed",
+            'tabs': len(self.tab_handles),
+            'init_seconds': round(self.init_seconds, 1) if self.init_seconds is not None else None,
+            'init_rss_mb': round(self.init_rss_bytes / (1024 * 1024), 1) if self.init_rss_bytes else None,
+            'resource_blocking': {
+                'enabled': self.block_resources,
+                'patterns': len(self.blocked_url_patterns)
+            },
+            'page': self.page_metrics,
+            'image_count': {
+                'supported': self.image_count_supported,
+                'per_tab': sorted({chosen for _, chosen in self._image_counts.values()}),
+                'changes': self.image_count_changes,
+                'avg_job_seconds_by_count': {str(count): round(seconds, 1) for count, seconds in self.job_seconds_by_count.items()}
+            },
+            'driver_backend': 'cdp' if self.cdp is not None else 'selenium',
+            'cdp_error': self.cdp_error,
+            'image_capture': {
+                'mode': self.capture_mode,
+                'network_captures': self.network_captures,
+                'fallbacks': self.capture_fallbacks,
+                'last_capture_seconds': round(self.last_capture_seconds, 1) if self.last_capture_seconds is not None else None
+            }
+        })
+        return health
+
+    def browser_pids(self):
+        """PIDs of chromedriver and the Chrome browser process, when known"""
+        if self.driver is None:
+            return []
+        pids = []
+        service = getattr(self.driver, 'service', None)
+        process = getattr(service, 'process', None)
+        if process is not None:
+            pids.append(process.pid)
+        browser_pid = getattr(self.driver, 'browser_pid', None)
+        if browser_pid:
+            pids.append(browser_pid)
+        return pids
+
+    def measure_rss(self):
+        """Measure the RSS of the driver's process tree; cached in last_rss_bytes"""
+        try:
+            self.last_rss_bytes = process_tree_rss(self.browser_pids())
+        except Exception as e:
+            print(f"Worker {self.worker_id}: Could not measure browser memory: {e}")
+        return self.last_rss_bytes
+
+    def close(self):
+        """Quit the browser; on abort this makes a stuck Selenium call in a job thread return"""
+        if self.cdp is not None:
+            self.cdp.close()
+        driver = self.driver
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception as e:
+                print(f"Worker {self.worker_id}: Error quitting driver: {e}")
+
+    def probe(self, tab=None):
+        """Cheap liveness check: the session, generator iframe and prompt textarea respond.
+
+        Does not generate. Leaves the driver inside the generator iframe (of tab,
+        when given), which is where play() expects it.
+        """
+        checks = {'session': False, 'iframe': False, 'textarea': False}
+        error = None
+        started = time.time()
+        try:
+            if self.driver is None:
+                raise RuntimeError("driver not initialized")
+            with self.driver_lock:
+                if tab is not None:
+                    self.driver.switch_to.window(tab)
+                    self._current_tab = tab
+                self.driver.switch_to.default_content()
+                self.driver.execute_script("return document.readyState")
+                checks['session'] = True
+                self.driver.switch_to.frame(self.driver.find_element("xpath", GENERATOR_IFRAME_XPATH))
+                checks['iframe'] = True
+                self.driver.find_element("xpath", PROMPT_TEXTAREA_XPATH)
+                checks['textarea'] = True
+        except Exception as e:
+            error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            print(f"Worker {self.worker_id}: Probe failed: {error}")
+        return {
+            'ok': all(checks.values()),
+            'checks': checks,
+            'latency_ms': round((time.time() - started) * 1000, 1),
+            'error': error
+        }
+
+    def _job_ended_state(self):
+        return "failed" if self.driver is None else super()._job_ended_state()
+
+    def generate(self, prompt, style="default", tab=None, variants=1):
+        started = time.time()
+        if self.cdp is not None:
+            image = self.cdp_generate_and_capture(prompt, style, variants, tab)
+        elif len(self.tab_handles) > 1:
+            image = self.play_in_tab(tab, prompt, style, variants)
+        else:
+            self.set_style(style)  # Set default style
+            image = self.generate_and_capture(prompt, self.set_image_count(variants, tab))
+        if image:
+            # Job time per image count, to compare the effect of rendering fewer results
+            count = self._image_counts.get(tab, (None, DEFAULT_RESULT_COUNT))[1]
+            elapsed = time.time() - started
+            previous = self.job_seconds_by_count.get(count)
+            self.job_seconds_by_count[count] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+        return image
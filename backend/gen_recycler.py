@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class GenRecycler:
+    """Replaces a Gen browser that has failed or aged past its job-count or memory limits.
+
+    The replacement is built in the background while the old browser keeps
+    serving, then swapped in between jobs, so capacity never drops to zero.
+    build_gen() returns a new Gen; swap_gen(old, new) installs it once the job
+    running on old has drained and returns False if old is no longer current.
+    """
+
+    def __init__(self, build_gen: Callable, swap_gen: Callable,
+                 max_jobs: Optional[int] = None, max_rss_mb: Optional[int] = None,
+                 max_failures: Optional[int] = None):
+        self.build_gen = build_gen
+        self.swap_gen = swap_gen
+        # 0 disables the corresponding limit
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.getenv('GEN_RECYCLE_MAX_JOBS', 200))
+        self.max_rss_mb = max_rss_mb if max_rss_mb is not None else int(os.getenv('GEN_RECYCLE_MAX_RSS_MB', 700))
+        self.max_failures = max_failures if max_failures is not None else int(os.getenv('GEN_RECYCLE_MAX_FAILURES', 3))
+        self._lock = threading.Lock()
+        self._replacing = False
+
+        # Metrics
+        self.recycles: Dict[str, int] = {}
+        self.failed_replacements = 0
+        self.last_replacement_seconds = None
+        logger.info(f"Gen recycler initialized (max_jobs={self.max_jobs}, max_rss_mb={self.max_rss_mb})")
+
+    def recycle_reason(self, gen) -> Optional[str]:
+        """Why gen should be replaced, or None if it is within limits"""
+        if not gen.is_ready():
+            return 'not_ready'
+        if self.max_failures and gen.consecutive_failures >= self.max_failures:
+            return 'failures'
+        if self.max_jobs and gen.jobs_completed + gen.jobs_failed >= self.max_jobs:
+            return 'job_count'
+        if self.max_rss_mb:
+            rss = gen.measure_rss()
+            if rss and rss > self.max_rss_mb * 1024 * 1024:
+                return 'memory'
+        return None
+
+    def check(self, gen) -> Optional[str]:
+        """Start a background replacement of gen if it is past a limit"""
+        with self._lock:
+            if self._replacing:
+                return None
+        reason = self.recycle_reason(gen)
+        if reason is None:
+            return None
+        with self._lock:
+            if self._replacing:
+                return None
+            self._replacing = True
+        logger.info(f"Recycling browser for worker {gen.worker_id} ({reason})")
+        threading.Thread(target=self._replace, args=(gen, reason), name='gen-recycler', daemon=True).start()
+        return reason
+
+    def _replace(self, old_gen, reason):
+        started = time.time()
+        try:
+            new_gen = self.build_gen()
+            if not new_gen.is_ready():
+                logger.error("Replacement browser failed to initialize, keeping the current one")
+                self._discard(new_gen)
+                with self._lock:
+                    self.failed_replacements += 1
+                return
+
+            if not self.swap_gen(old_gen, new_gen):
+                # The browser was already replaced by another path (e.g. the watchdog)
+                self._discard(new_gen)
+                return
+
+            self._discard(old_gen)
+            with self._lock:
+                self.recycles[reason] = self.recycles.get(reason, 0) + 1
+                self.last_replacement_seconds = time.time() - started
+            logger.info(f"Browser recycled ({reason}) in {time.time() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Error recycling browser: {e}")
+            with self._lock:
+                self.failed_replacements += 1
+        finally:
+            with self._lock:
+                self._replacing = False
+
+    @staticmethod
+    def _discard(gen):
+        if gen is not None:
+            try:
+                gen.close()
+            except Exception as e:
+                logger.error(f"Error closing browser: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'max_jobs': self.max_jobs,
+                'max_rss_mb': self.max_rss_mb,
+                'max_failures': self.max_failures,
+                'replacing': self._replacing,
+                'recycles': dict(self.recycles),
+                'failed_replacements': self.failed_replacements,
+                'last_replacement_seconds': round(self.last_replacement_seconds, 1) if self.last_replacement_seconds is not None else None
+            }
@@ -0,0 +1,116 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class GenWatchdog:
+    """Aborts generation jobs that run past their time budget.
+
+    Each job thread reports job_started()/job_finished(); with several generator
+    tabs there is one job per thread. When a job overruns, the watchdog calls
+    gen.abort(), which closes the browser session so the stuck Selenium calls in
+    its job threads fail; a job thread then recycles the browser and requeues or
+    fails the jobs.
+    """
+
+    def __init__(self, budget_seconds: Optional[int] = None, poll_seconds: float = 1.0):
+        self.budget_seconds = budget_seconds or int(os.getenv('JOB_BUDGET_SECONDS', 35))
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        # Running jobs by job thread: [gen, started_at, fired]
+        self._jobs: Dict[int, list] = {}
+        self._thread = None
+
+        # Metrics
+        self.aborted_jobs = 0
+        self.requeued_jobs = 0
+        self.recoveries = 0
+        self.failed_recoveries = 0
+        self.last_recovery_seconds = None
+        self.total_recovery_seconds = 0.0
+        self.last_recovery_reason = None
+        logger.info(f"Gen watchdog initialized (budget={self.budget_seconds}s)")
+
+    def job_started(self, gen):
+        with self._lock:
+            self._jobs[threading.get_ident()] = [gen, time.time(), False]
+
+    def job_finished(self):
+        with self._lock:
+            self._jobs.pop(threading.get_ident(), None)
+
+    def current_job_seconds(self) -> Optional[float]:
+        """Age of the longest-running job"""
+        with self._lock:
+            if not self._jobs:
+                return None
+            return time.time() - min(started_at for _, started_at, _ in self._jobs.values())
+
+    def check(self):
+        """Abort the browser of any job that is over budget; returns True if it did"""
+        overdue = []
+        now = time.time()
+        with self._lock:
+            for job in self._jobs.values():
+                gen, started_at, fired = job
+                if fired or now - started_at <= self.budget_seconds:
+                    continue
+                job[2] = True
+                self.aborted_jobs += 1
+                overdue.append((gen, now - started_at))
+
+        aborted = set()
+        for gen, elapsed in overdue:
+            logger.error(f"Job running for {elapsed:.1f}s exceeds budget of {self.budget_seconds}s, aborting")
+            if id(gen) not in aborted:
+                aborted.add(id(gen))
+                gen.abort()
+        return bool(overdue)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Watchdog check failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='gen-watchdog', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def record_requeue(self):
+        with self._lock:
+            self.requeued_jobs += 1
+
+    def record_recovery(self, seconds: float, reason: str, success: bool = True):
+        with self._lock:
+            if success:
+                self.recoveries += 1
+            else:
+                self.failed_recoveries += 1
+            self.last_recovery_seconds = seconds
+            self.total_recovery_seconds += seconds
+            self.last_recovery_reason = reason
+
+    def stats(self) -> Dict[str, Any]:
+        current = self.current_job_seconds()
+        with self._lock:
+            attempts = self.recoveries + self.failed_recoveries
+            return {
+                'budget_seconds': self.budget_seconds,
+                'current_job_seconds': round(current, 1) if current is not None else None,
+                'running_jobs': len(self._jobs),
+                'aborted_jobs': self.aborted_jobs,
+                'requeued_jobs': self.requeued_jobs,
+                'recoveries': self.recoveries,
+                'failed_recoveries': self.failed_recoveries,
+                'last_recovery_seconds': round(self.last_recovery_seconds, 1) if self.last_recovery_seconds is not None else None,
+                'avg_recovery_seconds': round(self.total_recovery_seconds / attempts, 1) if attempts else None,
+                'last_recovery_reason': self.last_recovery_reason
+            }
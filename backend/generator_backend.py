@@ -0,0 +1,212 @@
+import os
+import time
+import zlib
+import base64
+import struct
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+# Which generator a worker runs (GEN_BACKEND): 'selenium' drives perchance in
+# Chrome (gen.Gen), 'http' calls the image generation API directly
+# (http_generator.HTTPGenerator), 'stub' returns deterministic images
+GEN_BACKEND = os.getenv('GEN_BACKEND', 'selenium')
+# Jobs run at once by the browserless backends (the browser uses GEN_TABS)
+BACKEND_CONCURRENCY = int(os.getenv('GEN_BACKEND_CONCURRENCY', 1))
+STUB_DELAY_SECONDS = float(os.getenv('GEN_STUB_DELAY_SECONDS', 0))
+# Longest a job waits for a free job slot (browser tab) before failing
+TAB_WAIT_SECONDS = int(os.getenv('GEN_TAB_WAIT_SECONDS', 60))
+
+class GeneratorBackend(ABC):
+    """Image generator behind the job threads, health checks and browser recycling.
+
+    Subclasses implement generate(); play() wraps it with the job bookkeeping
+    (state, counters, timing) that readiness and recycling read. tab_count is
+    how many jobs the generator runs at once; the server starts one job thread
+    per slot.
+    """
+
+    name = 'base'
+    # Longest a job runs by the backend's own timeouts, when it has any
+    job_deadline_seconds = None
+
+    def __init__(self, worker_id=None, concurrency=1):
+        if worker_id is None:
+            worker_id = os.getenv('WORKER_ID', 'default')
+        self.worker_id = worker_id
+
+        # Runtime state reported by the readiness endpoint
+        self.state = "starting"  # "starting", "ready", "busy", "failed"
+        self.init_error = None
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        self.consecutive_failures = 0
+        self.last_success_at = None
+        self.avg_job_seconds = None
+        # Set by abort() when the watchdog gives up on a job
+        self.aborted = False
+        self.created_at = time.time()
+        # Process that built this generator; a forked worker inherits the master's
+        self.owner_pid = os.getpid()
+        self.last_rss_bytes = None
+        # Job slots; the browser backend maps them onto generator tabs
+        self.tab_count = max(1, concurrency)
+        self.tab_handles = []
+        self.active_jobs = 0
+        self._jobs_changed = threading.Condition()
+
+    @abstractmethod
+    def generate(self, prompt: str, style: str, tab=None, variants: int = 1) -> Optional[str]:
+        """Produce an image for prompt and style, base64-encoded, or None.
+
+        variants is how many images the caller needs; backends that render
+        several per request can use it to render no more than that.
+        """
+
+    @abstractmethod
+    def probe(self, tab=None) -> Dict[str, Any]:
+        """Cheap check that the generator can take a job, without generating"""
+
+    def close(self):
+        """Release the generator's resources (browser, sessions)"""
+
+    def acquire_tab(self, blocking=True, timeout=None):
+        """Reserve a job slot that needs exclusive use; None for backends without such slots"""
+        return None
+
+    def release_tab(self, handle):
+        pass
+
+    def is_ready(self):
+        """True when the generator initialized and can take jobs"""
+        return self.state in ("ready", "busy")
+
+    def measure_rss(self):
+        """Resident memory of processes owned by this generator, when it has any"""
+        return self.last_rss_bytes
+
+    def wait_idle(self, timeout=None):
+        """Wait until no job is running on this generator; False on timeout"""
+        with self._jobs_changed:
+            return self._jobs_changed.wait_for(lambda: self.active_jobs == 0, timeout)
+
+    def abort(self):
+        """Give up on the running jobs: mark the generator failed and close it"""
+        self.aborted = True
+        self.state = "failed"
+        self.close()
+        print(f"Worker {self.worker_id}: Job aborted, {self.name} generator closed")
+
+    def health(self):
+        """Snapshot of this generator's state for readiness checks"""
+        return {
+            'worker_id': self.worker_id,
+            'backend': self.name,
+            'state': self.state,
+            'init_error': self.init_error,
+            'jobs_completed': self.jobs_completed,
+            'jobs_failed': self.jobs_failed,
+            'consecutive_failures': self.consecutive_failures,
+            'last_success_age_seconds': round(time.time() - self.last_success_at, 1) if self.last_success_at else None,
+            'avg_job_seconds': round(self.avg_job_seconds, 1) if self.avg_job_seconds else None,
+            'age_seconds': round(time.time() - self.created_at, 1),
+            'tabs': self.tab_count,
+            'active_jobs': self.active_jobs,
+            'rss_mb': round(self.last_rss_bytes / (1024 * 1024), 1) if self.last_rss_bytes else None
+        }
+
+    def _record_job(self, started, image):
+        elapsed = time.time() - started
+        if image:
+            self.jobs_completed += 1
+            self.consecutive_failures = 0
+            self.last_success_at = time.time()
+            # Exponential moving average, so estimates follow recent page speed
+            if self.avg_job_seconds is None:
+                self.avg_job_seconds = elapsed
+            else:
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+        else:
+            self.jobs_failed += 1
+            self.consecutive_failures += 1
+
+    def _job_ended_state(self):
+        if self.aborted:
+            return "failed"
+        return "busy" if self.active_jobs else "ready"
+
+    def play(self, prompt:str, style:str = "default", variants:int = 1):
+        if prompt.strip() == "":
+            prompt = "girl"
+        started = time.time()
+        image = None
+        tab = None
+        with self._jobs_changed:
+            self.active_jobs += 1
+            self.state = "busy"
+        try:
+            tab = self.acquire_tab(timeout=TAB_WAIT_SECONDS)
+            # Job time excludes the wait for a tab
+            started = time.time()
+            image = self.generate(prompt, style, tab, variants)
+            return image
+        finally:
+            self.release_tab(tab)
+            with self._jobs_changed:
+                self._record_job(started, image)
+                self.active_jobs -= 1
+                self.state = self._job_ended_state()
+                self._jobs_changed.notify_all()
+
+
+def stub_png(seed: str, size: int = 8) -> bytes:
+    """A small solid-colour PNG whose colour is derived from seed"""
+    red, green, blue = hashlib.sha256(seed.encode('utf-8')).digest()[:3]
+    row = b'\x00' + bytes([red, green, blue]) * size
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * size))
+            + chunk(b'IEND', b''))
+
+
+class StubGenerator(GeneratorBackend):
+    """Deterministic generator for tests and load experiments: the same prompt and
+    style always yield the same image, after an optional fixed delay."""
+
+    name = 'stub'
+
+    def __init__(self, worker_id=None, delay_seconds=None, concurrency=None):
+        super().__init__(worker_id, BACKEND_CONCURRENCY if concurrency is None else concurrency)
+        self.delay_seconds = STUB_DELAY_SECONDS if delay_seconds is None else delay_seconds
+        self.state = "ready"
+        print(f"Worker {self.worker_id}: Stub generator ready (delay={self.delay_seconds}s)")
+
+    def generate(self, prompt, style, tab=None, variants=1):
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+        if self.aborted:
+            raise RuntimeError("job aborted")
+        return base64.b64encode(stub_png(f"{style}|{prompt}")).decode('ascii')
+
+    def probe(self, tab=None):
+        ok = not self.aborted
+        return {'ok': ok, 'checks': {'stub': ok}, 'latency_ms': 0.0, 'error': None if ok else 'aborted'}
+
+
+def create_generator(worker_id=None, backend=None):
+    """Build the generator selected by backend (default GEN_BACKEND) for this worker"""
+    backend = backend or GEN_BACKEND
+    if backend == 'selenium':
+        from gen import Gen
+        return Gen(worker_id=worker_id)
+    if backend == 'http':
+        from http_generator import HTTPGenerator
+        return HTTPGenerator(worker_id=worker_id)
+    if backend == 'stub':
+        return StubGenerator(worker_id=worker_id)
+    raise ValueError(f"GEN_BACKEND must be 'selenium', 'http' or 'stub', got {backend!r}")
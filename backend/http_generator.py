@@ -0,0 +1,138 @@
+import os
+import time
+import uuid
+import base64
+import random
+import requests
+
+from generator_backend import GeneratorBackend, BACKEND_CONCURRENCY
+
+# Image generation API the perchance page calls; point it at a stand-in
+# server (perchance_standin.py) for local testing
+HTTP_BASE_URL = os.getenv('GEN_HTTP_BASE_URL', 'https://image-generation.perchance.org')
+# User key issued by /api/verifyUser; fetched on start and on invalid_key when unset
+HTTP_USER_KEY = os.getenv('GEN_HTTP_USER_KEY')
+HTTP_TIMEOUT = int(os.getenv('GEN_HTTP_TIMEOUT', 30))
+HTTP_RESOLUTION = os.getenv('GEN_HTTP_RESOLUTION', '512x768')
+HTTP_CHANNEL = os.getenv('GEN_HTTP_CHANNEL', 'ai-text-to-image-generator')
+HTTP_RETRY_SECONDS = 1.0
+
+class HTTPGenerator(GeneratorBackend):
+    """Generator backend that calls the image generation endpoints directly, without a browser.
+
+    A job is one /api/generate call (retried while the previous request for this
+    user key is still running) followed by /api/downloadTemporaryImage.
+    """
+
+    name = 'http'
+
+    def __init__(self, worker_id=None, base_url=None, user_key=None, concurrency=None, timeout=None):
+        super().__init__(worker_id, BACKEND_CONCURRENCY if concurrency is None else concurrency)
+        self.base_url = (base_url or HTTP_BASE_URL).rstrip('/')
+        self.timeout = timeout or HTTP_TIMEOUT
+        self.job_deadline_seconds = self.timeout
+        self.session = requests.Session()
+        self.user_key = user_key or HTTP_USER_KEY
+        try:
+            if not self.user_key:
+                self.user_key = self.fetch_user_key()
+            self.state = "ready"
+            print(f"Worker {self.worker_id}: HTTP generator ready ({self.base_url})")
+        except Exception as e:
+            self.state = "failed"
+            self.init_error = str(e)
+            print(f"Worker {self.worker_id}: HTTP generator failed to start: {e}")
+
+    def _params(self, **params):
+        params['__cacheBust'] = random.random()
+        return params
+
+    def fetch_user_key(self):
+        response = self.session.get(f"{self.base_url}/api/verifyUser",
+                                    params=self._params(thread=0), timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data.get('status') not in ('success', 'already_verified') or not data.get('userKey'):
+            raise RuntimeError(f"verifyUser returned status {data.get('status')!r}")
+        return data['userKey']
+
+    @staticmethod
+    def styled_prompt(prompt, style):
+        # The page applies styles client-side; without it the style name goes into the prompt
+        if not style or style == "default":
+            return prompt
+        return f"{prompt}, {style} style"
+
+    def generate(self, prompt, style="default", tab=None, variants=1):
+        deadline = time.time() + self.timeout
+        request_id = uuid.uuid4().hex
+        renewed_key = False
+        while True:
+            if self.aborted:
+                raise RuntimeError("job aborted")
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print(f"Worker {self.worker_id}: No image after {self.timeout}s, giving up")
+                return None
+
+            response = self.session.post(f"{self.base_url}/api/generate", params=self._params(
+                prompt=self.styled_prompt(prompt, style),
+                seed=-1,
+                resolution=HTTP_RESOLUTION,
+                guidanceScale=7,
+                negativePrompt='',
+                channel=HTTP_CHANNEL,
+                subChannel='public',
+                userKey=self.user_key,
+                requestId=request_id
+            ), timeout=remaining)
+            response.raise_for_status()
+            data = response.json()
+            status = data.get('status')
+
+            if status == 'success':
+                image_id = data['imageId']
+                break
+            if status == 'waiting_for_prev_request_to_finish':
+                time.sleep(HTTP_RETRY_SECONDS)
+                continue
+            if status == 'invalid_key' and not renewed_key:
+                renewed_key = True
+                self.user_key = self.fetch_user_key()
+                continue
+            raise RuntimeError(f"Image generation failed with status {status!r}")
+
+        response = self.session.get(f"{self.base_url}/api/downloadTemporaryImage",
+                                    params={'imageId': image_id},
+                                    timeout=max(deadline - time.time(), 1))
+        response.raise_for_status()
+        print(f"Worker {self.worker_id}: Image {image_id} downloaded ({len(response.content)} bytes)")
+        return base64.b64encode(response.content).decode('ascii')
+
+    def probe(self, tab=None):
+        """The generation API answers, without generating"""
+        started = time.time()
+        error = None
+        try:
+            response = self.session.get(self.base_url, timeout=5)
+            ok = response.status_code < 500
+            if not ok:
+                error = f"HTTP {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            ok = False
+            error = str(e)
+        ok = ok and not self.aborted
+        return {
+            'ok': ok,
+            'checks': {'api': ok},
+            'latency_ms': round((time.time() - started) * 1000, 1),
+            'error': error
+        }
+
+    def close(self):
+        self.session.close()
+
+    def health(self):
+        health = super().health()
+        health['base_url'] = self.base_url
+        return health
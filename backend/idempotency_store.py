@@ -0,0 +1,115 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class IdempotencyRecord:
+    """Outcome of the first request seen for an idempotency key"""
+
+    def __init__(self, key: str, prompt: str, style: str):
+        self.key = key
+        self.prompt = prompt
+        self.style = style
+        self.created_at = time.monotonic()
+        # Resolves to the image (base64) or None when the original request failed
+        self.future: Future = Future()
+        self.attached = False
+        # Set once the request has paid its token; a retry of a failed attempt doesn't pay again
+        self.charged = False
+
+    def attach(self, job_future: Future):
+        """Resolve this record when the generation job finishes"""
+        self.attached = True
+        def _copy_result(done: Future):
+            try:
+                self.set_result(done.result())
+            except Exception:
+                self.set_result(None)
+        job_future.add_done_callback(_copy_result)
+
+    def set_result(self, image_b64: Optional[str]):
+        if not self.future.done():
+            self.future.set_result(image_b64)
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return 'pending'
+        return 'completed' if self.future.result() else 'failed'
+
+
+class IdempotencyStore:
+    """TTL'd store of /api/generate outcomes keyed on (user, Idempotency-Key).
+
+    Records live in this process only: a retry is recognised when it reaches
+    the process that saw the first request, so the load balancer has to route
+    on the key (see Load Balancing in PM2_CLUSTER.md).
+    """
+
+    def __init__(self, ttl_seconds: Optional[int] = None, max_entries: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds or int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 600))
+        self.max_entries = max_entries or int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 256))
+        self._records: "OrderedDict[str, IdempotencyRecord]" = OrderedDict()
+        self._lock = threading.Lock()
+        logger.info(f"Idempotency store initialized (ttl={self.ttl_seconds}s, max={self.max_entries})")
+
+    @staticmethod
+    def make_key(user_id: str, idempotency_key: str) -> str:
+        return f"{user_id}:{idempotency_key.strip()}"
+
+    def _purge_expired(self):
+        """Drop expired and overflow records; caller holds the lock"""
+        now = time.monotonic()
+        while self._records:
+            key, record = next(iter(self._records.items()))
+            expired = now - record.created_at > self.ttl_seconds
+            if not expired and len(self._records) <= self.max_entries:
+                break
+            # Never evict a pending record early, its owner still has to resolve it
+            if not expired and not record.future.done():
+                break
+            del self._records[key]
+
+    def reserve(self, key: str, prompt: str, style: str) -> Tuple[IdempotencyRecord, bool]:
+        """Return the record for key, creating it if absent.
+
+        The second element is True when the caller owns a freshly created record
+        and must either attach a job to it or release it. A failed outcome is not
+        replayed: a retry gets a fresh record that keeps the failed attempt's charge.
+        """
+        with self._lock:
+            self._purge_expired()
+            previous = self._records.get(key)
+            if previous is not None and previous.status != 'failed':
+                return previous, False
+            record = IdempotencyRecord(key, prompt, style)
+            if previous is not None:
+                record.charged = previous.charged
+                del self._records[key]
+            self._records[key] = record
+            return record, True
+
+    def release(self, record: IdempotencyRecord):
+        """Forget a reservation whose request was rejected before any work was done.
+
+        A record that already paid stays as a failed outcome, so its retry doesn't pay again.
+        """
+        if record.attached:
+            return
+        if not record.charged:
+            with self._lock:
+                if self._records.get(record.key) is record:
+                    del self._records[record.key]
+        record.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._records),
+                'ttl_seconds': self.ttl_seconds
+            }
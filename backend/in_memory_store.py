@@ -1,75 +1,162 @@
 import logging
+import threading
 from typing import Dict, Optional
 
+from fallback_ledger import fallback_ledger
+from store_persistence import StorePersistence, MEMORY_STORE_PERSIST
+from shared_token_store import SharedTokenStore, SHARED_TOKEN_STORE
+
 logger = logging.getLogger(__name__)
 
 class InMemoryTokenStore:
-    """Simple in-memory token storage for development/testing"""
+    """In-memory token storage, used when Firestore is unavailable.
+
+    With persistence, profiles and token changes are journaled before they are
+    applied and periodically folded into a snapshot, so balances survive a
+    restart. Journal fsyncs and ledger records happen after the lock is
+    released, before the caller gets its answer. Users in the snapshot are read from it on first access. The
+    persisted store is loaded by start(), in the worker.
+    """
     
-    def __init__(self):
+    def __init__(self, ledger=None, persistence=None):
+        # Journals token changes so they can be replayed to Firestore later
+        self.ledger = ledger
+        self.persistence = persistence
         self.users: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._snapshotting = False
+        # Firestore service whose last known counts seed new profiles; set by start()
+        self.service = None
         logger.info("In-memory token store initialized")
     
-    def check_token_availability(self, user_id: str) -> bool:
-        """Check if user has tokens available"""
-        if user_id not in self.users:
-            # Create default user profile
-            self.users[user_id] = {
+    def start(self, service):
+        """Load the persisted store, seed new profiles from service's cache and start
+        the ledger; call after the fork"""
+        if self.persistence and self.persistence.snapshot_path is None:
+            with self._lock:
+                self.users = self.persistence.load()
+        self.service = service
+        if self.ledger:
+            self.ledger.start(service)
+    
+    def _seed_count(self, user_id: str, default: int) -> int:
+        """Tokens a new fallback profile starts with: the last count seen in Firestore, else default"""
+        profile = self.service.profile_cache.last_known(user_id) if self.service else None
+        if profile is None:
+            return default
+        return self.service._with_local_tokens(user_id, profile.get('tokenCount', 0))
+    
+    def _user(self, user_id: str, token_count: Optional[int] = None) -> Optional[Dict]:
+        """Profile of user_id, created with token_count tokens if given; caller holds the lock"""
+        profile = self.users.get(user_id)
+        if profile is None and self.persistence:
+            profile = self.persistence.lookup(user_id)
+            if profile is not None:
+                self.users[user_id] = profile
+        if profile is None and token_count is not None:
+            profile = {
                 'uid': user_id,
-                'tokenCount': 5,
+                'tokenCount': self._seed_count(user_id, token_count),
                 'email': '',
                 'name': '',
                 'photoUrl': ''
             }
-        
-        token_count = self.users[user_id].get('tokenCount', 0)
+            if self.persistence and self.persistence.append_profile(user_id, profile):
+                self._start_snapshot()
+            self.users[user_id] = profile
+        return profile
+    
+    def _journal_delta(self, user_id: str, delta: int):
+        """Record a token change before it is applied; caller holds the lock"""
+        if self.persistence and self.persistence.append_delta(user_id, delta):
+            self._start_snapshot()
+    
+    def _make_durable(self, user_id: Optional[str] = None, delta: int = 0, reconcile: bool = False):
+        """fsync journaled changes and ledger the delta for Firestore; called without the lock"""
+        if self.persistence:
+            self.persistence.sync()
+        if delta and reconcile and self.ledger:
+            self.ledger.record(user_id, delta)
+    
+    def _start_snapshot(self):
+        """Snapshot in the background; caller holds the lock"""
+        if self._snapshotting:
+            return
+        self._snapshotting = True
+        threading.Thread(target=self.snapshot, name='memory-store-snapshot', daemon=True).start()
+    
+    def snapshot(self):
+        """Fold the journal into a new snapshot"""
+        try:
+            with self._lock:
+                covered = self.persistence.rotate()
+                users = {user_id: dict(profile) for user_id, profile in self.users.items()}
+            reader = self.persistence.write_snapshot(users, covered)
+            with self._lock:
+                self.persistence.install_snapshot(reader)
+            logger.info(f"Memory store snapshot of {reader.count} users took {self.persistence.last_snapshot_ms} ms")
+        except Exception as e:
+            logger.error(f"Memory store snapshot failed: {e}")
+        finally:
+            self._snapshotting = False
+    
+    def check_token_availability(self, user_id: str) -> bool:
+        """Check if user has tokens available"""
+        with self._lock:
+            # Create default user profile
+            token_count = self._user(user_id, 5).get('tokenCount', 0)
+        self._make_durable()
         logger.info(f"In-memory check: User {user_id} has {token_count} tokens")
         return token_count > 0
     
-    def consume_token(self, user_id: str) -> bool:
-        """Consume one token from user's account"""
-        if user_id not in self.users:
-            logger.error(f"User {user_id} not found when consuming token")
-            return False
-        
-        current_tokens = self.users[user_id].get('tokenCount', 0)
-        if current_tokens <= 0:
-            logger.error(f"User {user_id} has no tokens to consume")
-            return False
-        
-        self.users[user_id]['tokenCount'] = current_tokens - 1
+    def consume_token(self, user_id: str, reconcile: bool = True) -> bool:
+        """Consume one token from user's account; reconcile=False keeps it out of the ledger"""
+        with self._lock:
+            profile = self._user(user_id)
+            if profile is None:
+                logger.error(f"User {user_id} not found when consuming token")
+                return False
+            
+            current_tokens = profile.get('tokenCount', 0)
+            if current_tokens <= 0:
+                logger.error(f"User {user_id} has no tokens to consume")
+                return False
+            
+            self._journal_delta(user_id, -1)
+            profile['tokenCount'] = current_tokens - 1
+        self._make_durable(user_id, -1, reconcile)
         logger.info(f"Token consumed for user {user_id}. Remaining: {current_tokens - 1}")
         return True
     
     def get_user_profile(self, user_id: str) -> Optional[Dict]:
         """Get user profile"""
-        if user_id not in self.users:
+        with self._lock:
             # Create default user profile
-            self.users[user_id] = {
-                'uid': user_id,
-                'tokenCount': 5,
-                'email': '',
-                'name': '',
-                'photoUrl': ''
-            }
-        
-        return self.users[user_id]
+            profile = self._user(user_id, 5)
+        self._make_durable()
+        return profile
     
-    def add_tokens(self, user_id: str, tokens_to_add: int) -> bool:
-        """Add tokens to user's account"""
-        if user_id not in self.users:
-            self.users[user_id] = {
-                'uid': user_id,
-                'tokenCount': 0,
-                'email': '',
-                'name': '',
-                'photoUrl': ''
-            }
-        
-        current_tokens = self.users[user_id].get('tokenCount', 0)
-        self.users[user_id]['tokenCount'] = current_tokens + tokens_to_add
+    def add_tokens(self, user_id: str, tokens_to_add: int, reconcile: bool = True) -> bool:
+        """Add tokens to user's account; reconcile=False keeps it out of the ledger"""
+        with self._lock:
+            profile = self._user(user_id, 0)
+            self._journal_delta(user_id, tokens_to_add)
+            current_tokens = profile.get('tokenCount', 0)
+            profile['tokenCount'] = current_tokens + tokens_to_add
+        self._make_durable(user_id, tokens_to_add, reconcile)
         logger.info(f"Added {tokens_to_add} tokens to user {user_id}. New total: {current_tokens + tokens_to_add}")
         return True
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {'users_in_memory': len(self.users)}
+            if self.persistence:
+                stats.update(self.persistence.stats())
+            return stats
 
 # Global instance
-in_memory_store = InMemoryTokenStore()
\ No newline at end of file
+if SHARED_TOKEN_STORE:
+    in_memory_store = SharedTokenStore(ledger=fallback_ledger)
+else:
+    in_memory_store = InMemoryTokenStore(ledger=fallback_ledger,
+                                         persistence=StorePersistence() if MEMORY_STORE_PERSIST else None)
\ No newline at end of file
@@ -0,0 +1,75 @@
+import re
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+class JobCoalescer:
+    """Single-flight submission of generation jobs keyed on normalized prompt+style"""
+
+    def __init__(self, job_queue):
+        self.job_queue = job_queue
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        logger.info("Job coalescer initialized")
+
+    @staticmethod
+    def make_key(prompt: str, style: str) -> str:
+        """Build the coalescing key; case and whitespace differences are ignored"""
+        normalized_prompt = re.sub(r'\s+', ' ', (prompt or '').strip().lower())
+        return f"{(style or '').strip().lower()}|{normalized_prompt}"
+
+    def submit(self, prompt: str, style: str) -> Tuple[Future, bool]:
+        """Return a future for the image, enqueuing a new job only if no identical one is pending.
+
+        The second element is True when this call enqueued the job, False when it
+        attached to an already pending one.
+        """
+        key = self.make_key(prompt, style)
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                logger.info(f"Coalesced request onto pending job for key {key!r}")
+                return future, False
+
+            future = Future()
+            self._in_flight[key] = future
+            self.submitted += 1
+
+        def job_callback(image_b64, error=None):
+            # Detach first so requests arriving after completion start a fresh job
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+            if error:
+                logger.error(f"Coalesced job for key {key!r} failed: {error}")
+            future.set_result(image_b64)
+
+        self.job_queue.put({
+            'prompt': prompt,
+            'style': style,
+            'callback': job_callback,
+            'submitted_at': time.time()
+        })
+        return future, True
+
+    def pending_count(self) -> int:
+        """Number of distinct jobs currently in flight"""
+        with self._lock:
+            return len(self._in_flight)
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for health/metrics endpoints"""
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._in_flight)
+            }
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the perchance image generation API, for exercising the HTTP
+generator backend without the real service:
+
+    python perchance_standin.py --port 7001 --delay 2
+    GEN_BACKEND=http GEN_HTTP_BASE_URL=http://localhost:7001 python final_server.py
+
+Implements /api/verifyUser, /api/generate and /api/downloadTemporaryImage with
+the response shapes the HTTP generator expects, including the one-generation-
+at-a-time limit per user key. Images are the deterministic
+stub PNGs, so the same prompt always returns the same bytes.
+"""
+
+import argparse
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+
+from generator_backend import stub_png
+
+USER_KEY = 'standin-user-key'
+
+app = Flask(__name__)
+images = {}
+images_lock = threading.Lock()
+# User keys with a generation running; the real API allows one at a time per key
+busy_keys = set()
+settings = {'delay': 0.0}
+
+
+@app.route('/', methods=['GET'])
+def index():
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/api/verifyUser', methods=['GET'])
+def verify_user():
+    return jsonify({'status': 'success', 'userKey': USER_KEY})
+
+
+@app.route('/api/generate', methods=['POST'])
+def generate():
+    if request.args.get('userKey') != USER_KEY:
+        return jsonify({'status': 'invalid_key'})
+    user_key = request.args['userKey']
+    with images_lock:
+        if user_key in busy_keys:
+            return jsonify({'status': 'waiting_for_prev_request_to_finish'})
+        busy_keys.add(user_key)
+    try:
+        prompt = request.args.get('prompt', '')
+        if settings['delay']:
+            time.sleep(settings['delay'])
+        image_id = uuid.uuid4().hex
+        with images_lock:
+            images[image_id] = stub_png(prompt)
+    finally:
+        with images_lock:
+            busy_keys.discard(user_key)
+    return jsonify({'status': 'success', 'imageId': image_id, 'seed': 0})
+
+
+@app.route('/api/downloadTemporaryImage', methods=['GET'])
+def download_temporary_image():
+    with images_lock:
+        image = images.pop(request.args.get('imageId', ''), None)
+    if image is None:
+        return jsonify({'status': 'not_found'}), 404
+    return Response(image, mimetype='image/png')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=7001)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds each generation takes')
+    args = parser.parse_args()
+    settings['delay'] = args.delay
+    app.run(host='127.0.0.1', port=args.port, threaded=True, use_reloader=False)
+
+
+if __name__ == '__main__':
+    main()
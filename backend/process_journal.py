@@ -0,0 +1,85 @@
+import os
+import re
+import socket
+import logging
+from typing import List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+class ProcessJournal:
+    """A journal file owned by one server process.
+
+    Workers forked from one gunicorn master share a WORKER_ID, so the file name
+    and node id include the pid as well. The process holds an exclusive lock
+    on <journal>.lock for as long as it runs; a journal whose lock can be taken
+    belongs to a process that has exited, and orphans() hands it to the caller
+    to finish its work. Must be created after the fork.
+    """
+
+    def __init__(self, prefix: str, directory: Optional[str] = None, node_prefix: Optional[str] = None):
+        self.prefix = prefix
+        self.directory = directory or os.path.dirname(os.path.abspath(__file__))
+        self.node_prefix = node_prefix or socket.gethostname()
+        self.ident = f"{os.getenv('WORKER_ID', 'default')}-{os.getpid()}"
+        self.path = self.journal_path(self.ident)
+        self.node_id = self.node(self.ident)
+        self._lock_fd = try_lock_file(self.path + '.lock')
+        if self._lock_fd is None:
+            raise RuntimeError(f"{self.path} is locked by another process")
+
+    def journal_path(self, ident: str) -> str:
+        return os.path.join(self.directory, f"{self.prefix}_{ident}.jsonl")
+
+    def node(self, ident: str) -> str:
+        return f"{self.node_prefix}-{ident}"
+
+    def orphans(self) -> List[Tuple[str, str, int]]:
+        """(path, node id, lock fd) of journals left by processes that exited; the caller releases each"""
+        pattern = re.compile(re.escape(self.prefix) + r'_(.+)\.jsonl$')
+        found = []
+        for entry in sorted(os.listdir(self.directory)):
+            match = pattern.match(entry)
+            if not match or match.group(1) == self.ident:
+                continue
+            path = os.path.join(self.directory, entry)
+            lock_fd = try_lock_file(path + '.lock')
+            if lock_fd is not None:
+                found.append((path, self.node(match.group(1)), lock_fd))
+        return found
+
+    @staticmethod
+    def release(path: str, lock_fd: int, remove: bool):
+        """Let go of an orphan; remove deletes it once its work is done"""
+        if remove:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        os.close(lock_fd)
+        if remove:
+            try:
+                os.remove(path + '.lock')
+            except OSError:
+                # Gone already, or (on Windows) opened by a process scanning for orphans
+                pass
+
+
+def try_lock_file(lock_path: str) -> Optional[int]:
+    """An fd holding an exclusive lock on lock_path, or None while another process holds it"""
+    lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        os.close(lock_fd)
+        return None
+    return lock_fd
@@ -0,0 +1,180 @@
+import os
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class _Entry:
+    def __init__(self, profile: Optional[Dict[str, Any]]):
+        self.profile = profile
+        self.loaded_at = time.monotonic()
+
+
+class ProfileCache:
+    """Per-process read-through cache of user profiles.
+
+    load(user_id) returns the profile dict, None when the user does not exist
+    (cached for the shorter negative TTL), or raises on a failed read (not
+    cached; the error reaches every caller waiting on that load). A profile older than the TTL is still served for
+    the stale window while one background reload refreshes it. Concurrent
+    misses for a user share a single load. Callers invalidate() after writing.
+    """
+
+    def __init__(self, load: Callable[[str], Optional[Dict[str, Any]]],
+                 ttl_seconds: Optional[float] = None, negative_ttl_seconds: Optional[float] = None,
+                 stale_seconds: Optional[float] = None, max_entries: Optional[int] = None):
+        self.load = load
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv('PROFILE_CACHE_TTL_SECONDS', 30))
+        self.negative_ttl_seconds = negative_ttl_seconds if negative_ttl_seconds is not None else float(os.getenv('PROFILE_CACHE_NEGATIVE_TTL_SECONDS', 10))
+        self.stale_seconds = stale_seconds if stale_seconds is not None else float(os.getenv('PROFILE_CACHE_STALE_SECONDS', 120))
+        self.max_entries = max_entries or int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', 10000))
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # Only the load registered here stores its result; put() and invalidate()
+        # unregister a load started before a write, so its stale result is dropped
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.load_errors = 0
+        self.refreshes = 0
+        self.invalidations = 0
+        logger.info(f"Profile cache initialized (ttl={self.ttl_seconds}s, negative_ttl={self.negative_ttl_seconds}s, "
+                    f"stale={self.stale_seconds}s)")
+
+    def _lookup(self, user_id: str) -> Tuple[Optional[_Entry], str]:
+        """Cached entry and its freshness ('fresh', 'stale' or 'expired'); caller holds the lock"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None, 'expired'
+        age = time.monotonic() - entry.loaded_at
+        ttl = self.ttl_seconds if entry.profile is not None else self.negative_ttl_seconds
+        if age < ttl:
+            return entry, 'fresh'
+        if entry.profile is not None and age < ttl + self.stale_seconds:
+            return entry, 'stale'
+        return entry, 'expired'
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """The user's profile (a copy), or None if the user does not exist.
+
+        Raises load's error when the profile is not cached and cannot be loaded.
+        """
+        with self._lock:
+            entry, freshness = self._lookup(user_id)
+            if freshness == 'fresh':
+                self._entries.move_to_end(user_id)
+                if entry.profile is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return copy.deepcopy(entry.profile)
+            if freshness == 'stale':
+                self.stale_hits += 1
+                if user_id not in self._inflight:
+                    self._start_load(user_id, background=True)
+                return copy.deepcopy(entry.profile)
+
+            self.misses += 1
+            future = self._inflight.get(user_id)
+            owner = future is None
+            if owner:
+                future = self._start_load(user_id, background=False)
+
+        if owner:
+            self._load(user_id, future)
+        return copy.deepcopy(future.result())
+
+    def peek(self, user_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """(True, profile copy) when a fresh entry is cached, else (False, None); never loads"""
+        with self._lock:
+            entry, freshness = self._lookup(user_id)
+            if freshness != 'fresh':
+                return False, None
+            if entry.profile is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, copy.deepcopy(entry.profile)
+
+    def last_known(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """A copy of the cached profile however old it is, or None; never loads"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return copy.deepcopy(entry.profile) if entry is not None else None
+
+    def _start_load(self, user_id: str, background: bool) -> Future:
+        """Register an in-flight load; caller holds the lock"""
+        future = Future()
+        self._inflight[user_id] = future
+        if background:
+            self.refreshes += 1
+            threading.Thread(target=self._load, args=(user_id, future), name='profile-refresh', daemon=True).start()
+        return future
+
+    def _load(self, user_id: str, future: Future):
+        try:
+            profile = self.load(user_id)
+        except Exception as e:
+            with self._lock:
+                self.load_errors += 1
+                if self._inflight.get(user_id) is future:
+                    del self._inflight[user_id]
+            logger.warning(f"Profile load failed for {user_id}: {e}")
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            if self._inflight.get(user_id) is future:
+                del self._inflight[user_id]
+                self._entries[user_id] = _Entry(profile)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        future.set_result(profile)
+
+    def put(self, user_id: str, profile: Optional[Dict[str, Any]]):
+        """Store a profile we just wrote in full, so the next read needs no load"""
+        with self._lock:
+            self._inflight.pop(user_id, None)
+            self._entries[user_id] = _Entry(copy.deepcopy(profile))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        """Forget the user's profile after we changed it"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                # Expired rather than dropped, so last_known() still has it
+                entry.loaded_at = float('-inf')
+            # A load started before the write may still finish; new readers must not wait on it
+            self._inflight.pop(user_id, None)
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.negative_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'ttl_seconds': self.ttl_seconds,
+                'negative_ttl_seconds': self.negative_ttl_seconds,
+                'stale_seconds': self.stale_seconds,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_ratio': round((lookups - self.misses) / lookups, 3) if lookups else None,
+                'background_refreshes': self.refreshes,
+                'load_errors': self.load_errors,
+                'invalidations': self.invalidations
+            }
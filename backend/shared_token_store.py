@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Share the fallback token store between all server processes on a host
+SHARED_TOKEN_STORE = int(os.getenv('SHARED_TOKEN_STORE', 0))
+SHARED_TOKEN_STORE_PATH = os.getenv('SHARED_TOKEN_STORE_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'shared_tokens.db')
+# How long a process waits for another one's write before giving up
+SHARED_TOKEN_STORE_BUSY_MS = int(os.getenv('SHARED_TOKEN_STORE_BUSY_MS', 5000))
+
+class SharedTokenStore:
+    """Fallback token store in an SQLite file shared by every process on the host.
+
+    Drop-in replacement for InMemoryTokenStore. The database runs in WAL mode,
+    so reads never wait for writers. A consume is a single conditional UPDATE,
+    which makes the check and the decrement atomic across processes, and every
+    server on the host sees the same balance for a user. The database is first
+    opened on use, in the worker. Ledger records are written after the change
+    commits, so the write lock is never held across their fsync.
+    """
+
+    def __init__(self, path: Optional[str] = None, ledger=None):
+        self.path = path or SHARED_TOKEN_STORE_PATH
+        # Journals token changes so they can be replayed to Firestore later
+        self.ledger = ledger
+        # Firestore service whose last known counts seed new users; set by start()
+        self.service = None
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        # Guards the one-time schema setup done by the first connection
+        self._setup_lock = threading.Lock()
+        self._set_up = False
+
+        # Metrics
+        self.consumed = 0
+        self.rejected = 0
+        self.added = 0
+        self.created = 0
+
+    def start(self, service):
+        """Seed new users from service's cache and start the ledger; call after the fork"""
+        self.service = service
+        if self.ledger:
+            self.ledger.start(service)
+
+    def _seed_count(self, user_id: str, default: int) -> int:
+        """Tokens a new user starts with: the last count seen in Firestore, else default"""
+        profile = self.service.profile_cache.last_known(user_id) if self.service else None
+        if profile is None:
+            return default
+        return self.service._with_local_tokens(user_id, profile.get('tokenCount', 0))
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection; sqlite3 connections can't be shared between threads"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SHARED_TOKEN_STORE_BUSY_MS / 1000,
+                                         isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            # WAL with synchronous=NORMAL: a commit survives a process crash without an fsync
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._set_up_schema(connection)
+            self._local.connection = connection
+        return connection
+
+    def _set_up_schema(self, connection: sqlite3.Connection):
+        with self._setup_lock:
+            if self._set_up:
+                return
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    uid TEXT PRIMARY KEY,
+                    tokenCount INTEGER NOT NULL,
+                    email TEXT NOT NULL DEFAULT '',
+                    name TEXT NOT NULL DEFAULT '',
+                    photoUrl TEXT NOT NULL DEFAULT ''
+                )''')
+            self._set_up = True
+        logger.info(f"Shared token store opened at {self.path}")
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def _user(self, connection: sqlite3.Connection, user_id: str, token_count: Optional[int] = None) -> Optional[Dict]:
+        """Profile of user_id, created with token_count tokens if given"""
+        row = connection.execute('SELECT * FROM users WHERE uid = ?', (user_id,)).fetchone()
+        if row is None and token_count is not None:
+            # Another process may create the same user first; its row wins
+            if connection.execute('INSERT OR IGNORE INTO users (uid, tokenCount) VALUES (?, ?)',
+                                  (user_id, self._seed_count(user_id, token_count))).rowcount:
+                self._count('created')
+            row = connection.execute('SELECT * FROM users WHERE uid = ?', (user_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def check_token_availability(self, user_id: str) -> bool:
+        """Check if user has tokens available"""
+        # Create default user profile
+        token_count = self._user(self._connection(), user_id, 5)['tokenCount']
+        logger.info(f"Shared store check: User {user_id} has {token_count} tokens")
+        return token_count > 0
+
+    def consume_token(self, user_id: str, reconcile: bool = True) -> bool:
+        """Consume one token from user's account; reconcile=False keeps it out of the ledger"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            consumed = connection.execute('UPDATE users SET tokenCount = tokenCount - 1 WHERE uid = ? AND tokenCount > 0',
+                                          (user_id,)).rowcount
+            if consumed:
+                remaining = connection.execute('SELECT tokenCount FROM users WHERE uid = ?', (user_id,)).fetchone()[0]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if consumed and self.ledger and reconcile:
+            self.ledger.record(user_id, -1)
+        if not consumed:
+            self._count('rejected')
+            logger.error(f"User {user_id} not found or has no tokens to consume")
+            return False
+        self._count('consumed')
+        logger.info(f"Token consumed for user {user_id}. Remaining: {remaining}")
+        return True
+
+    def get_user_profile(self, user_id: str) -> Optional[Dict]:
+        """Get user profile"""
+        # Create default user profile
+        return self._user(self._connection(), user_id, 5)
+
+    def add_tokens(self, user_id: str, tokens_to_add: int, reconcile: bool = True) -> bool:
+        """Add tokens to user's account; reconcile=False keeps it out of the ledger"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if connection.execute('INSERT OR IGNORE INTO users (uid, tokenCount) VALUES (?, ?)',
+                                  (user_id, self._seed_count(user_id, 0))).rowcount:
+                self._count('created')
+            connection.execute('UPDATE users SET tokenCount = tokenCount + ? WHERE uid = ?', (tokens_to_add, user_id))
+            total = connection.execute('SELECT tokenCount FROM users WHERE uid = ?', (user_id,)).fetchone()[0]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if self.ledger and reconcile:
+            self.ledger.record(user_id, tokens_to_add)
+        self._count('added', tokens_to_add)
+        logger.info(f"Added {tokens_to_add} tokens to user {user_id}. New total: {total}")
+        return True
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                'backend': 'sqlite',
+                'path': self.path,
+                'consumed': self.consumed,
+                'rejected': self.rejected,
+                'added': self.added,
+                'created': self.created
+            }
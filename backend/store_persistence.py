@@ -0,0 +1,276 @@
+import os
+import re
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+from process_journal import try_lock_file
+
+logger = logging.getLogger(__name__)
+
+# Persist the in-memory fallback store as a snapshot plus an operation journal
+MEMORY_STORE_PERSIST = int(os.getenv('MEMORY_STORE_PERSIST', 0))
+MEMORY_STORE_SNAPSHOT_OPS = int(os.getenv('MEMORY_STORE_SNAPSHOT_OPS', 10000))
+MEMORY_STORE_FSYNC = int(os.getenv('MEMORY_STORE_FSYNC', 1))
+
+SNAPSHOT_MAGIC = b'IMSNAP01'
+# magic, user count, last journal segment included, offset of the record index
+SNAPSHOT_HEADER = struct.Struct('<8sQQQ')
+
+class SnapshotReader:
+    """Read-only view of a snapshot file through mmap.
+
+    Records are sorted by user id and an index of their offsets sits at the
+    end of the file, so opening a snapshot reads only the header and a lookup
+    is a binary search that parses just the records it touches.
+    Record: JSON user id, a tab, JSON profile, a newline.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as snapshot_file:
+            self._mm = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.segment, index_offset = SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not a store snapshot")
+        self._index = memoryview(self._mm)[index_offset:index_offset + 8 * self.count].cast('Q')
+
+    def _key(self, position: int) -> Tuple[str, int]:
+        """User id of the record at index position, and where its profile starts"""
+        start = self._index[position]
+        tab = self._mm.find(b'\t', start)
+        return json.loads(self._mm[start:tab]), tab + 1
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key, profile_start = self._key(middle)
+            if key == user_id:
+                return json.loads(self._mm[profile_start:self._mm.find(b'\n', profile_start)])
+            if key < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        for position in range(self.count):
+            key, profile_start = self._key(position)
+            yield key, json.loads(self._mm[profile_start:self._mm.find(b'\n', profile_start)])
+
+    def close(self):
+        self._index.release()
+        self._mm.close()
+
+
+class StorePersistence:
+    """Snapshot and operation journal backing InMemoryTokenStore.
+
+    Every profile creation and token change is appended to the current
+    journal segment before the store applies it. A snapshot folds the previous
+    snapshot and everything up to a segment into a new file; later segments
+    are replayed on top of it at startup. Profiles in the snapshot are only
+    read when a user is first touched, so startup time doesn't grow with the
+    number of users. load() locks the files, so processes sharing a WORKER_ID
+    each get their own set; a restarted process takes over a free one.
+    Appends only write; the store calls sync() after releasing its lock, and
+    one fsync covers every append made before it.
+    """
+
+    def __init__(self, directory: Optional[str] = None, name: Optional[str] = None,
+                 snapshot_ops: Optional[int] = None, fsync: Optional[bool] = None):
+        self.directory = directory or os.getenv('MEMORY_STORE_DIR') or os.path.dirname(os.path.abspath(__file__))
+        self.name = name or f"memory_store_{os.getenv('WORKER_ID', 'default')}"
+        self.snapshot_path = None
+        self._lock_fd = None
+        self.snapshot_ops = snapshot_ops or MEMORY_STORE_SNAPSHOT_OPS
+        self.fsync = MEMORY_STORE_FSYNC if fsync is None else fsync
+        self.reader: Optional[SnapshotReader] = None
+        self.segment = 0
+        self._journal = None
+        self.ops_since_snapshot = 0
+        # Appends written, and appends known to be on disk
+        self._written = 0
+        self._synced = 0
+        self._sync_lock = threading.Lock()
+
+        # Metrics
+        self.snapshots = 0
+        self.load_ms = None
+        self.replayed_ops = 0
+        self.last_snapshot_ms = None
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{self.name}.{segment}.jsonl")
+
+    def _segments(self):
+        pattern = re.compile(re.escape(self.name) + r'\.(\d+)\.jsonl$')
+        matches = (pattern.match(entry) for entry in os.listdir(self.directory))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def _claim(self):
+        """Lock the first set of store files no running process holds; after the fork"""
+        base, slot = self.name, 0
+        while True:
+            name = base if slot == 0 else f"{base}_{slot}"
+            lock_fd = try_lock_file(os.path.join(self.directory, f"{name}.lock"))
+            if lock_fd is None:
+                slot += 1
+                continue
+            self.name, self._lock_fd = name, lock_fd
+            self.snapshot_path = os.path.join(self.directory, f"{name}.snap")
+            return
+
+    def load(self) -> Dict[str, Dict]:
+        """Open the snapshot and replay newer journal segments; the profiles they changed.
+
+        Call once, in the process that serves requests.
+        """
+        started = time.perf_counter()
+        self._claim()
+        if os.path.exists(self.snapshot_path):
+            self.reader = SnapshotReader(self.snapshot_path)
+        covered = self.reader.segment if self.reader else 0
+        users: Dict[str, Dict] = {}
+        segments = self._segments()
+        for segment in segments:
+            if segment <= covered:
+                # Left behind by a crash after the snapshot that includes it
+                os.remove(self._segment_path(segment))
+                continue
+            with open(self._segment_path(segment), encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write; that change was never acknowledged
+                        logger.warning(f"Skipping unreadable record in {self._segment_path(segment)}")
+                        continue
+                    user_id = record['u']
+                    self.replayed_ops += 1
+                    if 'p' in record:
+                        users[user_id] = record['p']
+                        continue
+                    profile = users.get(user_id) or self.lookup(user_id)
+                    if profile is not None:
+                        profile['tokenCount'] = profile.get('tokenCount', 0) + record['d']
+                        users[user_id] = profile
+        self.ops_since_snapshot = self.replayed_ops
+        self.segment = max([covered] + segments) + 1
+        self._journal = open(self._segment_path(self.segment), 'a', encoding='utf-8')
+        self.load_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Memory store loaded in {self.load_ms} ms "
+                    f"({self.reader.count if self.reader else 0} snapshot users, {self.replayed_ops} journal changes)")
+        return users
+
+    def lookup(self, user_id: str) -> Optional[Dict]:
+        return self.reader.get(user_id) if self.reader else None
+
+    def _append(self, record: Dict) -> bool:
+        """Journal one change, durable after the next sync(); whether a snapshot is due"""
+        self._journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._journal.flush()
+        self._written += 1
+        self.ops_since_snapshot += 1
+        return self.ops_since_snapshot >= self.snapshot_ops
+
+    def sync(self):
+        """fsync the appends made so far; called without the store's lock"""
+        if not self.fsync or self._synced >= self._written:
+            return
+        with self._sync_lock:
+            written = self._written
+            if self._synced >= written:
+                # Another request's fsync covered it
+                return
+            os.fsync(self._journal.fileno())
+            self._synced = written
+
+    def append_profile(self, user_id: str, profile: Dict) -> bool:
+        return self._append({'u': user_id, 'p': profile})
+
+    def append_delta(self, user_id: str, delta: int) -> bool:
+        return self._append({'u': user_id, 'd': delta})
+
+    def rotate(self) -> int:
+        """Start a new journal segment; the last segment the next snapshot includes"""
+        with self._sync_lock:
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._synced = self._written
+            self._journal.close()
+            covered = self.segment
+            self.segment += 1
+            self._journal = open(self._segment_path(self.segment), 'a', encoding='utf-8')
+        self.ops_since_snapshot = 0
+        return covered
+
+    def write_snapshot(self, users: Dict[str, Dict], covered: int) -> SnapshotReader:
+        """Write the current snapshot merged with users as the new snapshot; a reader for it.
+
+        Called without the store's lock, so users must be a copy. The caller
+        installs the returned reader.
+        """
+        started = time.perf_counter()
+        temp_path = self.snapshot_path + '.tmp'
+        offsets = []
+        previous = self.reader.items() if self.reader else iter(())
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(b'\0' * SNAPSHOT_HEADER.size)
+            pending = sorted(users.items())
+            merged = _merge_sorted(previous, pending)
+            for user_id, profile in merged:
+                offsets.append(snapshot_file.tell())
+                snapshot_file.write(json.dumps(user_id).encode() + b'\t' +
+                                    json.dumps(profile, separators=(',', ':')).encode() + b'\n')
+            index_offset = snapshot_file.tell()
+            snapshot_file.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            snapshot_file.seek(0)
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(offsets), covered, index_offset))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self.last_snapshot_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.snapshots += 1
+        return SnapshotReader(self.snapshot_path)
+
+    def install_snapshot(self, reader: SnapshotReader):
+        """Switch lookups to a new snapshot and drop the journal segments it includes"""
+        previous, self.reader = self.reader, reader
+        if previous:
+            previous.close()
+        for segment in self._segments():
+            if segment <= reader.segment:
+                os.remove(self._segment_path(segment))
+
+    def stats(self) -> Dict:
+        return {
+            'snapshot_users': self.reader.count if self.reader else 0,
+            'journal_ops_since_snapshot': self.ops_since_snapshot,
+            'snapshots': self.snapshots,
+            'load_ms': self.load_ms,
+            'last_snapshot_ms': self.last_snapshot_ms
+        }
+
+
+def _merge_sorted(previous: Iterator[Tuple[str, Dict]], updates) -> Iterator[Tuple[str, Dict]]:
+    """Merge two user-id-ordered streams; updates win over previous"""
+    updates = iter(updates)
+    update = next(updates, None)
+    for user_id, profile in previous:
+        while update is not None and update[0] < user_id:
+            yield update
+            update = next(updates, None)
+        if update is not None and update[0] == user_id:
+            yield update
+            update = next(updates, None)
+        else:
+            yield user_id, profile
+    while update is not None:
+        yield update
+        update = next(updates, None)
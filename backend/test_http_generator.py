@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Tests for the HTTP generator backend against the local perchance stand-in.
+
+Starts perchance_standin.py's app on a free local port in this process, so no
+other server is needed:
+
+    python test_http_generator.py
+"""
+
+import sys
+import base64
+import logging
+import threading
+
+from werkzeug.serving import make_server
+
+import perchance_standin
+from generator_backend import stub_png
+from http_generator import HTTPGenerator
+
+_server = None
+
+def standin_url():
+    """Base URL of the stand-in, started on first use"""
+    global _server
+    if _server is None:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        _server = make_server('127.0.0.1', 0, perchance_standin.app, threaded=True)
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{_server.server_port}"
+
+def decode(image_b64):
+    return base64.b64decode(image_b64)
+
+def test_generate_returns_standin_image():
+    """A job returns the stand-in's image for the styled prompt"""
+    generator = HTTPGenerator(worker_id='test', base_url=standin_url())
+    assert generator.is_ready(), generator.init_error
+    assert generator.user_key == perchance_standin.USER_KEY
+    image = generator.play("a red fox", "Painted Anime")
+    assert decode(image) == stub_png("a red fox, Painted Anime style")
+    assert generator.jobs_completed == 1 and generator.state == "ready"
+
+def test_default_style_keeps_prompt():
+    generator = HTTPGenerator(worker_id='test', base_url=standin_url())
+    assert decode(generator.play("a lighthouse", "default")) == stub_png("a lighthouse")
+
+def test_invalid_key_is_renewed():
+    """A stale user key is replaced through verifyUser and the job still succeeds"""
+    generator = HTTPGenerator(worker_id='test', base_url=standin_url(), user_key='stale-key')
+    image = generator.play("a mountain", "default")
+    assert decode(image) == stub_png("a mountain")
+    assert generator.user_key == perchance_standin.USER_KEY
+
+def test_concurrent_jobs_wait_for_previous_request():
+    """Jobs sharing a user key are retried while the stand-in is busy with the previous one"""
+    perchance_standin.settings['delay'] = 0.5
+    try:
+        generator = HTTPGenerator(worker_id='test', base_url=standin_url(), concurrency=2)
+        results = {}
+        threads = [threading.Thread(target=lambda p=prompt: results.__setitem__(p, generator.play(p, "default")))
+                   for prompt in ("first", "second")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert {prompt: decode(image) for prompt, image in results.items()} == {
+            "first": stub_png("first"), "second": stub_png("second")}
+        assert generator.jobs_completed == 2 and generator.active_jobs == 0
+    finally:
+        perchance_standin.settings['delay'] = 0.0
+
+def test_timeout_fails_the_job():
+    """A generation slower than the generator's timeout fails instead of hanging"""
+    perchance_standin.settings['delay'] = 2
+    try:
+        generator = HTTPGenerator(worker_id='test', base_url=standin_url(), timeout=1)
+        try:
+            generator.play("a slow one", "default")
+            failed = False
+        except Exception:
+            failed = True
+        assert failed
+        assert generator.jobs_failed == 1 and generator.active_jobs == 0
+    finally:
+        perchance_standin.settings['delay'] = 0.0
+
+def test_probe():
+    generator = HTTPGenerator(worker_id='test', base_url=standin_url())
+    assert generator.probe()['ok']
+    generator.abort()
+    assert not generator.probe()['ok']
+
+def test_unreachable_server_fails_to_start():
+    generator = HTTPGenerator(worker_id='test', base_url='http://127.0.0.1:9', timeout=1)
+    assert generator.state == "failed" and not generator.is_ready()
+
+def main():
+    tests = [value for name, value in globals().items() if name.startswith('test_') and callable(value)]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except Exception as e:
+            failures += 1
+            print(f"❌ {test.__name__}: {type(e).__name__}: {e}")
+    print(f"\n{len(tests) - failures}/{len(tests)} passed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import atexit
+import socket
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from process_journal import ProcessJournal
+
+logger = logging.getLogger(__name__)
+
+# Authorize generations against blocks of tokens leased from Firestore
+TOKEN_LEASES = int(os.getenv('TOKEN_LEASES', 0))
+# Tokens moved into a lease at a time
+LEASE_BLOCK = int(os.getenv('TOKEN_LEASE_BLOCK', 5))
+# A lease unused for this long is returned to the user
+LEASE_TTL_SECONDS = float(os.getenv('TOKEN_LEASE_TTL_SECONDS', 300))
+# Attempts at moving tokens when another server changes the user at the same time
+LEASE_GRANT_ATTEMPTS = 5
+# Journal records written before the journal is rewritten
+JOURNAL_COMPACT_RECORDS = 10000
+
+def _precondition_failed(error: Exception) -> bool:
+    """Whether a FirestoreError says a write's currentDocument precondition did not hold"""
+    return (getattr(error, 'status', None) in ('FAILED_PRECONDITION', 'ABORTED', 'NOT_FOUND')
+            or getattr(error, 'status_code', None) in (404, 409))
+
+
+class _Lease:
+    def __init__(self):
+        # Tokens left to spend, and the count last written to the lease document
+        self.tokens = 0
+        self.settled = 0
+        # Written with the lease document each time it changes, so recovery can tell which
+        # journaled state the document holds
+        self.version = 0
+        self.last_used = time.monotonic()
+        # Held while tokens move to or from Firestore for this user
+        self.lock = threading.Lock()
+
+
+class TokenLeaseManager:
+    """Per-node token leases.
+
+    Tokens are moved out of a user's tokenCount into the lease document
+    users/<uid>/tokenLeases/<node> in one commit, preconditioned on the user
+    document being unchanged since it was read, so no two servers can lease
+    the same token. Generations then spend the lease in memory, with each
+    spend appended to a local journal. Leases idle for the TTL, and all leases
+    at shutdown, are returned in one commit that adds the unspent tokens back
+    and deletes the lease document. After a crash, the journal and the lease
+    documents show what was left, and start() returns it. Journal and node id
+    are per process (see ProcessJournal); leases in the journals of processes
+    that exited are returned the same way.
+    """
+
+    def __init__(self, service, journal_path: Optional[str] = None, block: Optional[int] = None,
+                 ttl_seconds: Optional[float] = None, node_id: Optional[str] = None):
+        self.service = service
+        # Both are per process, so they are picked in start(), after the fork
+        self.journal_path = journal_path
+        self.node_id = node_id
+        self.block = max(1, block or LEASE_BLOCK)
+        self.ttl_seconds = ttl_seconds or LEASE_TTL_SECONDS
+        self._process_journal: Optional[ProcessJournal] = None
+        # (path, node id, lock fd) of journals left by exited processes, not recovered yet
+        self._orphans: List[Tuple[str, str, int]] = []
+        self._leases: Dict[str, _Lease] = {}
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_records = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self.local_consumes = 0
+        self.grants = 0
+        self.granted_tokens = 0
+        self.grant_conflicts = 0
+        self.returns = 0
+        self.returned_tokens = 0
+        self.recovered_tokens = 0
+
+    def _lease_path(self, user_id: str) -> str:
+        return f"users/{user_id}/tokenLeases/{self.node_id}"
+
+    # Journal
+
+    def _append(self, record: Dict[str, Any]):
+        """Write one journal record durably; caller holds the lock"""
+        self._journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_records += 1
+
+    def _compact(self):
+        """Rewrite the journal as the open leases only; caller holds the lock"""
+        records = []
+        for user_id, lease in self._leases.items():
+            if lease.settled:
+                records.append({'t': 'settle', 'user': user_id, 'tokens': lease.settled, 'version': lease.version})
+                records.extend({'t': 'use', 'user': user_id} for _ in range(lease.settled - lease.tokens))
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as temp:
+            temp.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+            temp.flush()
+            os.fsync(temp.fileno())
+        if self._journal:
+            self._journal.close()
+        os.replace(temp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_records = len(records)
+
+    def _read_journal(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Journal records per user from a previous run"""
+        records: Dict[str, List[Dict[str, Any]]] = {}
+        if not os.path.exists(self.journal_path):
+            return records
+        with open(self.journal_path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping unreadable token lease journal record")
+                    continue
+                records.setdefault(record['user'], []).append(record)
+        return records
+
+    def _recover(self):
+        """Return the tokens left in leases from a previous run"""
+        for user_id, records in self._read_journal().items():
+            document = self.service._get_document(self._lease_path(user_id))
+            if document is None:
+                continue
+            fields = document.get('fields', {})
+            settled = int(fields.get('tokens', {}).get('integerValue', 0))
+            version = int(fields.get('version', {}).get('integerValue', 0))
+            # Spends recorded after the lease document was last written
+            spent = 0
+            for record in reversed(records):
+                if record['t'] == 'use':
+                    spent += 1
+                elif record.get('version') == version:
+                    break
+            else:
+                # The journal never saw this lease document's value; assume it was spent
+                spent = settled
+            remaining = max(settled - spent, 0)
+            self._release(user_id, remaining, document.get('updateTime'))
+            self.recovered_tokens += remaining
+        if self.recovered_tokens:
+            logger.info(f"Returned {self.recovered_tokens} tokens left in leases by the previous run")
+
+    def _recover_orphans(self):
+        """Return the leases of exited processes, then delete their journals"""
+        for orphan in list(self._orphans):
+            path, node_id, lock_fd = orphan
+            previous = TokenLeaseManager(self.service, journal_path=path, node_id=node_id)
+            try:
+                previous._recover()
+            except Exception as e:
+                # Still locked by us; tried again on the next expiry pass
+                logger.warning(f"Could not return leases of exited process {node_id} yet: {e}")
+                continue
+            ProcessJournal.release(path, lock_fd, remove=True)
+            self._orphans.remove(orphan)
+            self.recovered_tokens += previous.recovered_tokens
+
+    # Moving tokens
+
+    def _grant(self, user_id: str, lease: _Lease) -> int:
+        """Move up to a block of the user's tokens into the lease; caller holds lease.lock"""
+        for _ in range(LEASE_GRANT_ATTEMPTS):
+            document = self.service._get_document(f"users/{user_id}", ['tokenCount'])
+            if document is None:
+                return 0
+            available = int(document.get('fields', {}).get('tokenCount', {}).get('integerValue', 0))
+            if available <= 0:
+                return 0
+            # Leave the rest for other servers; a user's last token has to be leased to be spent
+            granted = min(self.block, max(1, available // 2))
+            with self._lock:
+                settled = lease.tokens + granted
+                version = time.time_ns()
+                self._append({'t': 'intent', 'user': user_id, 'tokens': settled, 'version': version})
+            try:
+                self.service._commit([
+                    {
+                        'update': {'name': self.service._document_name(f"users/{user_id}")},
+                        'updateMask': {'fieldPaths': []},
+                        'updateTransforms': [{'fieldPath': 'tokenCount', 'increment': {'integerValue': str(-granted)}}],
+                        # Fails if another server changed the count since it was read
+                        'currentDocument': {'updateTime': document['updateTime']}
+                    },
+                    {
+                        'update': {'name': self.service._document_name(self._lease_path(user_id)), 'fields': {
+                            'tokens': {'integerValue': str(settled)},
+                            'version': {'integerValue': str(version)},
+                            'node': {'stringValue': self.node_id}
+                        }},
+                        'updateTransforms': [{'fieldPath': 'updatedAt', 'setToServerValue': 'REQUEST_TIME'}]
+                    }
+                ])
+            except Exception as e:
+                if _precondition_failed(e):
+                    self.grant_conflicts += 1
+                    continue
+                raise
+            with self._lock:
+                self._append({'t': 'settle', 'user': user_id, 'tokens': settled, 'version': version})
+                lease.tokens += granted
+                lease.settled = settled
+                lease.version = version
+                self.grants += 1
+                self.granted_tokens += granted
+            self.service.profile_cache.invalidate(user_id)
+            return granted
+        raise RuntimeError(f"Could not lease tokens for {user_id}: the user kept changing")
+
+    def _release(self, user_id: str, tokens: int, update_time: Optional[str] = None):
+        """Add tokens back to the user and delete the lease document in one commit"""
+        writes = []
+        if tokens:
+            writes.append({
+                'update': {'name': self.service._document_name(f"users/{user_id}")},
+                'updateMask': {'fieldPaths': []},
+                'updateTransforms': [{'fieldPath': 'tokenCount', 'increment': {'integerValue': str(tokens)}}],
+                'currentDocument': {'exists': True}
+            })
+        # The precondition makes returning a lease twice fail instead of adding the tokens twice
+        writes.append({
+            'delete': self.service._document_name(self._lease_path(user_id)),
+            'currentDocument': {'updateTime': update_time} if update_time else {'exists': True}
+        })
+        try:
+            self.service._commit(writes)
+        except Exception as e:
+            if _precondition_failed(e):
+                logger.info(f"Lease for {user_id} was already returned")
+                return
+            raise
+        self.returns += 1
+        self.returned_tokens += tokens
+        self.service.profile_cache.invalidate(user_id)
+
+    def _return_lease(self, user_id: str):
+        """Give the lease's unspent tokens back to the user"""
+        with self._lock:
+            lease = self._leases.get(user_id)
+        if lease is None:
+            return
+        with lease.lock:
+            with self._lock:
+                if not lease.settled:
+                    self._leases.pop(user_id, None)
+                    return
+                # Stop spending before the tokens leave
+                remaining = lease.tokens
+                lease.tokens = 0
+                self._append({'t': 'release', 'user': user_id})
+            try:
+                self._release(user_id, remaining)
+            except Exception:
+                with self._lock:
+                    lease.tokens += remaining
+                raise
+            with self._lock:
+                self._append({'t': 'released', 'user': user_id})
+                lease.settled = 0
+                if self._leases.get(user_id) is lease:
+                    del self._leases[user_id]
+
+    # Spending
+
+    def _spend(self, user_id: str, lease: _Lease) -> bool:
+        with self._lock:
+            if lease.tokens <= 0:
+                return False
+            self._append({'t': 'use', 'user': user_id})
+            lease.tokens -= 1
+            lease.last_used = time.monotonic()
+            self.local_consumes += 1
+            if self._journal_records > JOURNAL_COMPACT_RECORDS:
+                self._compact()
+            return True
+
+    def consume(self, user_id: str) -> bool:
+        """Spend one token, leasing a block first when this server holds none for the user"""
+        while True:
+            with self._lock:
+                lease = self._leases.setdefault(user_id, _Lease())
+            if self._spend(user_id, lease):
+                return True
+            with lease.lock:
+                with self._lock:
+                    if self._leases.get(user_id) is not lease:
+                        # Returned while this request waited; start over with a new lease
+                        continue
+                # Another request may have leased while this one waited
+                if self._spend(user_id, lease):
+                    return True
+                if not self._grant(user_id, lease):
+                    return False
+                if self._spend(user_id, lease):
+                    return True
+
+    def available(self, user_id: str) -> int:
+        """Tokens this server holds for the user"""
+        with self._lock:
+            lease = self._leases.get(user_id)
+            return lease.tokens if lease is not None else 0
+
+    # Lifecycle
+
+    def start(self):
+        """Return leases left by a previous run and start the expiry thread"""
+        if self._thread is not None:
+            return
+        if self.journal_path is None:
+            self._process_journal = ProcessJournal('token_leases', os.getenv('TOKEN_JOURNAL_DIR'),
+                                                   os.getenv('TOKEN_LEASE_NODE_ID'))
+            self.journal_path = self._process_journal.path
+            self.node_id = self.node_id or self._process_journal.node_id
+            self._orphans = self._process_journal.orphans()
+        self.node_id = self.node_id or f"{socket.gethostname()}-{os.getenv('WORKER_ID', 'default')}-{os.getpid()}"
+        try:
+            self._recover()
+        except Exception as e:
+            # The journal is kept; the next start tries again
+            logger.error(f"Could not return leases from the previous run: {e}")
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        else:
+            with self._lock:
+                self._compact()
+        self._recover_orphans()
+        self._thread = threading.Thread(target=self._run, name='token-leases', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        logger.info(f"Token leases started (node={self.node_id}, block={self.block}, ttl={self.ttl_seconds}s)")
+
+    def expire(self):
+        """Return leases unused for the TTL"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [user_id for user_id, lease in self._leases.items() if now - lease.last_used > self.ttl_seconds]
+        for user_id in idle:
+            try:
+                self._return_lease(user_id)
+            except Exception as e:
+                logger.warning(f"Returning lease for {user_id} failed, retrying later: {e}")
+
+    def _run(self):
+        while not self._stop.wait(min(self.ttl_seconds / 4, 30)):
+            if self._orphans:
+                self._recover_orphans()
+            self.expire()
+
+    def close(self):
+        """Return every lease (on shutdown); what cannot be returned is recovered on the next start"""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        with self._lock:
+            user_ids = list(self._leases)
+        for user_id in user_ids:
+            try:
+                self._return_lease(user_id)
+            except Exception as e:
+                logger.warning(f"Returning lease for {user_id} at shutdown failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'node_id': self.node_id,
+                'block': self.block,
+                'ttl_seconds': self.ttl_seconds,
+                'leases': sum(1 for lease in self._leases.values() if lease.settled),
+                'leased_tokens': sum(lease.tokens for lease in self._leases.values()),
+                'local_consumes': self.local_consumes,
+                'grants': self.grants,
+                'granted_tokens': self.granted_tokens,
+                'grant_conflicts': self.grant_conflicts,
+                'returns': self.returns,
+                'returned_tokens': self.returned_tokens,
+                'recovered_tokens': self.recovered_tokens,
+                'orphaned_journals': len(self._orphans)
+            }
@@ -0,0 +1,401 @@
+import os
+import json
+import time
+import atexit
+import socket
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from process_journal import ProcessJournal
+
+logger = logging.getLogger(__name__)
+
+# Apply token consumes/additions locally and flush them to Firestore in batches
+TOKEN_WRITE_BEHIND = int(os.getenv('TOKEN_WRITE_BEHIND', 0))
+FLUSH_INTERVAL_SECONDS = float(os.getenv('TOKEN_FLUSH_INTERVAL_SECONDS', 1.0))
+# How long a user's Firestore token count is trusted once it has no unflushed changes
+BASE_TTL_SECONDS = float(os.getenv('TOKEN_BASE_TTL_SECONDS', 30))
+# fsync the journal after every delta; without it a power loss can drop the last deltas
+JOURNAL_FSYNC = int(os.getenv('TOKEN_JOURNAL_FSYNC', 1))
+# Firestore accepts at most 500 writes per commit; one is the batch marker
+MAX_BATCH_USERS = 499
+
+class _UserTokens:
+    def __init__(self):
+        # Firestore's tokenCount without our unflushed deltas; None until read
+        self.base: Optional[int] = None
+        # Deltas not yet sent, and deltas in the batch being committed
+        self.pending = 0
+        self.inflight = 0
+        self.loaded_at = time.monotonic()
+
+    def count(self) -> Optional[int]:
+        if self.base is None:
+            return None
+        return self.base + self.pending + self.inflight
+
+
+class TokenWriteBehind:
+    """Write-behind buffer for token count changes.
+
+    consume()/add() check and change a user's count under a lock against the
+    last count read from Firestore plus our unflushed deltas, and append the
+    delta to a local journal before returning. A background thread sends the
+    per-user sums as increment transforms in one Firestore commit per
+    interval. Each commit also records its batch number in a marker document
+    for this node. If the outcome of a commit is unknown (crash or timeout),
+    the marker shows whether it landed, so a batch is never applied twice.
+    The journal is replayed on start. Journal and node id are per process
+    (see ProcessJournal); the journals of processes that exited are flushed
+    under their own node ids and then deleted.
+    """
+
+    def __init__(self, service, journal_path: Optional[str] = None, flush_interval: Optional[float] = None,
+                 node_id: Optional[str] = None, base_ttl_seconds: Optional[float] = None):
+        self.service = service
+        # Both are per process, so they are picked in start(), after the fork
+        self.journal_path = journal_path
+        self.node_id = node_id
+        self.flush_interval = flush_interval or FLUSH_INTERVAL_SECONDS
+        self.base_ttl_seconds = base_ttl_seconds if base_ttl_seconds is not None else BASE_TTL_SECONDS
+        self._process_journal: Optional[ProcessJournal] = None
+        # (path, node id, lock fd) of journals left by exited processes, not flushed yet
+        self._orphans: List[Tuple[str, str, int]] = []
+        self._users: Dict[str, _UserTokens] = {}
+        self._lock = threading.Lock()
+        # Serializes flushes; held across the Firestore commit, never by consume()/add()
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._batch = 0
+        # (batch, {user: delta}) of a commit whose outcome is not known yet
+        self._unresolved: Optional[Tuple[int, Dict[str, int]]] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self.deltas = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.writes = 0
+        self.last_flush_ms = None
+        self.recovered_deltas = 0
+
+    # Journal
+
+    def _open_journal(self):
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _append(self, record: Dict[str, Any]):
+        """Write one journal record durably; caller holds the lock"""
+        self._journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self._journal.fileno())
+
+    def _compact(self):
+        """Rewrite the journal as the outstanding deltas only; caller holds the lock"""
+        # Deltas of an unresolved batch are written before its flush record, as they were originally
+        records = [{'t': 'batch', 'next': self._batch}]
+        records.extend({'t': 'delta', 'user': user_id, 'delta': tokens.pending + tokens.inflight}
+                       for user_id, tokens in self._users.items() if tokens.pending or tokens.inflight)
+        if self._unresolved:
+            batch, deltas = self._unresolved
+            records.append({'t': 'flush', 'batch': batch, 'deltas': deltas})
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as temp:
+            temp.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+            temp.flush()
+            os.fsync(temp.fileno())
+        self._journal.close()
+        os.replace(temp_path, self.journal_path)
+        self._open_journal()
+
+    def _replay(self):
+        """Rebuild unflushed deltas and an unresolved batch from the journal"""
+        if not os.path.exists(self.journal_path):
+            return
+        flushing = {}
+        with open(self.journal_path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write; the delta was never acknowledged
+                    logger.warning("Skipping unreadable token journal record")
+                    continue
+                kind = record.get('t')
+                if kind == 'delta':
+                    tokens = self._users.setdefault(record['user'], _UserTokens())
+                    tokens.pending += record['delta']
+                    self.recovered_deltas += 1
+                elif kind == 'batch':
+                    self._batch = max(self._batch, record['next'])
+                elif kind == 'flush':
+                    flushing[record['batch']] = record['deltas']
+                    for user_id, delta in record['deltas'].items():
+                        tokens = self._users.setdefault(user_id, _UserTokens())
+                        tokens.pending -= delta
+                        tokens.inflight += delta
+                    self._batch = max(self._batch, record['batch'] + 1)
+                elif kind in ('done', 'abort'):
+                    deltas = flushing.pop(record['batch'], {})
+                    for user_id, delta in deltas.items():
+                        tokens = self._users[user_id]
+                        tokens.inflight -= delta
+                        if kind == 'abort':
+                            tokens.pending += delta
+        if flushing:
+            batch = max(flushing)
+            self._unresolved = (batch, flushing[batch])
+        if self.recovered_deltas:
+            logger.info(f"Recovered {self.recovered_deltas} journaled token deltas"
+                        f"{f', batch {self._unresolved[0]} unresolved' if self._unresolved else ''}")
+
+    # Token operations
+
+    def _load_base(self, user_id: str) -> Optional[_UserTokens]:
+        """The user's entry with a known Firestore count; None when the user does not exist"""
+        with self._lock:
+            tokens = self._users.get(user_id)
+            if tokens is not None and tokens.base is not None:
+                return tokens
+        # Raises FirestoreError when Firestore cannot be read
+        fields = self.service._load_user_profile(user_id, ['tokenCount'])
+        if fields is None:
+            return None
+        with self._lock:
+            tokens = self._users.setdefault(user_id, _UserTokens())
+            if tokens.base is None:
+                # Assume a batch still in flight has landed; if it turns out it did not, the
+                # count is read again
+                tokens.base = int(fields.get('tokenCount', 0)) - tokens.inflight
+                tokens.loaded_at = time.monotonic()
+            return tokens
+
+    def _apply(self, user_id: str, delta: int, require_tokens: bool) -> Optional[int]:
+        """Journal and apply delta; the new count, or None when the user is unknown or has no tokens"""
+        while True:
+            if self._load_base(user_id) is None:
+                return None
+            with self._lock:
+                # A flush may have dropped the entry or its count since it was loaded
+                tokens = self._users.get(user_id)
+                count = tokens.count() if tokens is not None else None
+                if count is None:
+                    continue
+                if require_tokens and count + delta < 0:
+                    return None
+                self._append({'t': 'delta', 'user': user_id, 'delta': delta})
+                tokens.pending += delta
+                self.deltas += 1
+                return count + delta
+
+    def consume(self, user_id: str) -> bool:
+        """Take one token if the user has one"""
+        return self._apply(user_id, -1, require_tokens=True) is not None
+
+    def add(self, user_id: str, tokens_to_add: int) -> Optional[int]:
+        """Add tokens; the new count, or None when the user does not exist"""
+        return self._apply(user_id, tokens_to_add, require_tokens=False)
+
+    def token_count(self, user_id: str) -> Optional[int]:
+        """The user's count including unflushed deltas, when it is known locally"""
+        with self._lock:
+            tokens = self._users.get(user_id)
+            return tokens.count() if tokens is not None else None
+
+    def unflushed(self, user_id: str) -> int:
+        """Deltas for the user not sent to Firestore yet (a batch in flight counts as landed)"""
+        with self._lock:
+            tokens = self._users.get(user_id)
+            return tokens.pending if tokens is not None else 0
+
+    # Flushing
+
+    def _marker_name(self) -> str:
+        return f"{self.service.document_root}/tokenWriteBehind/{self.node_id}"
+
+    def _commit(self, batch: int, deltas: Dict[str, int]) -> List[Dict[str, Any]]:
+        """Send one batch; the write results, in deltas order"""
+        writes = [{
+            'update': {'name': f"{self.service.document_root}/users/{user_id}"},
+            'updateMask': {'fieldPaths': []},
+            'updateTransforms': [
+                {'fieldPath': 'tokenCount', 'increment': {'integerValue': str(delta)}},
+                {'fieldPath': 'updatedAt', 'setToServerValue': 'REQUEST_TIME'}
+            ]
+        } for user_id, delta in deltas.items()]
+        writes.append({'update': {'name': self._marker_name(), 'fields': {'batch': {'integerValue': str(batch)}}}})
+        return self.service._commit(writes).get('writeResults', [])
+
+    def _landed_batch(self) -> int:
+        """The last batch Firestore has from this node (0 if none)"""
+        document = self.service._get_document(f"tokenWriteBehind/{self.node_id}")
+        if document is None:
+            return 0
+        return int(document.get('fields', {}).get('batch', {}).get('integerValue', 0))
+
+    def _finish_batch(self, batch: int, deltas: Dict[str, int], landed: bool,
+                      results: Optional[List[Dict[str, Any]]] = None):
+        with self._lock:
+            self._append({'t': 'done' if landed else 'abort', 'batch': batch})
+            for index, (user_id, delta) in enumerate(deltas.items()):
+                tokens = self._users.setdefault(user_id, _UserTokens())
+                tokens.inflight -= delta
+                if not landed:
+                    tokens.pending += delta
+                    # The count may have been read assuming the batch landed
+                    tokens.base = None
+                    continue
+                transforms = (results[index].get('transformResults') if results and index < len(results) else None)
+                if transforms:
+                    tokens.base = int(transforms[0]['integerValue']) - tokens.pending
+                    tokens.loaded_at = time.monotonic()
+                else:
+                    # Landed, but the resulting count is unknown: read it again when next needed
+                    tokens.base = None
+            self._unresolved = None
+            self._evict_idle()
+            self._compact()
+        for user_id in deltas:
+            self.service.profile_cache.invalidate(user_id)
+
+    def _evict_idle(self):
+        """Forget users with nothing to flush whose count is older than the TTL; caller holds the lock"""
+        now = time.monotonic()
+        for user_id in [user_id for user_id, tokens in self._users.items()
+                        if not tokens.pending and not tokens.inflight
+                        and (tokens.base is None or now - tokens.loaded_at > self.base_ttl_seconds)]:
+            del self._users[user_id]
+
+    def flush(self) -> bool:
+        """Send the unflushed deltas to Firestore; False when a commit failed"""
+        with self._flush_lock:
+            if self._unresolved:
+                batch, deltas = self._unresolved
+                try:
+                    landed = self._landed_batch() >= batch
+                except Exception as e:
+                    logger.warning(f"Cannot resolve token batch {batch} yet: {e}")
+                    return False
+                self._finish_batch(batch, deltas, landed)
+
+            with self._lock:
+                deltas = {}
+                for user_id, tokens in self._users.items():
+                    if tokens.pending and len(deltas) < MAX_BATCH_USERS:
+                        deltas[user_id] = tokens.pending
+                if not deltas:
+                    self._evict_idle()
+                    return True
+                # Batch numbers only grow, even if the journal is lost
+                batch = max(self._batch, int(time.time() * 1000))
+                self._batch = batch + 1
+                self._append({'t': 'flush', 'batch': batch, 'deltas': deltas})
+                for user_id, delta in deltas.items():
+                    self._users[user_id].pending -= delta
+                    self._users[user_id].inflight += delta
+                self._unresolved = (batch, deltas)
+
+            started = time.monotonic()
+            try:
+                results = self._commit(batch, deltas)
+            except Exception as e:
+                self.flush_failures += 1
+                logger.warning(f"Token batch {batch} ({len(deltas)} users) not confirmed: {e}")
+                return False
+            self.last_flush_ms = round((time.monotonic() - started) * 1000, 1)
+            self.flushes += 1
+            self.writes += len(deltas)
+            self._finish_batch(batch, deltas, True, results)
+            return True
+
+    def _unflushed_users(self) -> int:
+        with self._lock:
+            return sum(1 for tokens in self._users.values() if tokens.pending or tokens.inflight)
+
+    def _flush_orphans(self):
+        """Flush the journals of exited processes under their node ids, then delete them"""
+        for orphan in list(self._orphans):
+            path, node_id, lock_fd = orphan
+            previous = TokenWriteBehind(self.service, journal_path=path, node_id=node_id,
+                                        flush_interval=self.flush_interval)
+            with previous._lock:
+                previous._replay()
+                previous._open_journal()
+                previous._compact()
+            while previous.flush() and previous._unflushed_users():
+                pass
+            previous._journal.close()
+            if previous._unflushed_users():
+                # Still locked by us; tried again on the next interval
+                continue
+            ProcessJournal.release(path, lock_fd, remove=True)
+            self._orphans.remove(orphan)
+            self.recovered_deltas += previous.recovered_deltas
+            logger.info(f"Flushed token journal of exited process {node_id}")
+            try:
+                self.service._commit([{'delete': previous._marker_name()}])
+            except Exception as e:
+                logger.warning(f"Could not delete token batch marker of {node_id}: {e}")
+
+    def start(self):
+        """Replay the journal and start the flush thread"""
+        if self._thread is not None:
+            return
+        if self.journal_path is None:
+            self._process_journal = ProcessJournal('token_journal', os.getenv('TOKEN_JOURNAL_DIR'),
+                                                   os.getenv('TOKEN_WRITE_BEHIND_NODE_ID'))
+            self.journal_path = self._process_journal.path
+            self.node_id = self.node_id or self._process_journal.node_id
+            self._orphans = self._process_journal.orphans()
+        self.node_id = self.node_id or f"{socket.gethostname()}-{os.getenv('WORKER_ID', 'default')}-{os.getpid()}"
+        with self._lock:
+            self._replay()
+            self._open_journal()
+            self._compact()
+        self._thread = threading.Thread(target=self._run, name='token-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        logger.info(f"Token write-behind started (node={self.node_id}, interval={self.flush_interval}s, "
+                    f"journal={self.journal_path})")
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                if self._orphans:
+                    self._flush_orphans()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Token flush error: {e}")
+
+    def close(self):
+        """Stop the flush thread after a last flush; anything left stays in the journal"""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout=self.flush_interval * 2)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning(f"Final token flush failed, deltas stay journaled: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'node_id': self.node_id,
+                'flush_interval_seconds': self.flush_interval,
+                'users': len(self._users),
+                'unflushed_users': sum(1 for tokens in self._users.values() if tokens.pending or tokens.inflight),
+                'unflushed_delta': sum(tokens.pending + tokens.inflight for tokens in self._users.values()),
+                'unresolved_batch': self._unresolved[0] if self._unresolved else None,
+                'deltas': self.deltas,
+                'flushes': self.flushes,
+                'writes': self.writes,
+                'coalesced': self.deltas - self.writes if self.deltas > self.writes else 0,
+                'flush_failures': self.flush_failures,
+                'last_flush_ms': self.last_flush_ms,
+                'recovered_deltas': self.recovered_deltas,
+                'orphaned_journals': len(self._orphans)
+            }
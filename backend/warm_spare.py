@@ -0,0 +1,143 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class WarmSpare:
+    """Optional pre-initialized standby Gen, swapped in when the active one fails or is retired.
+
+    take() hands out the standby (after a quick probe) and starts building the
+    next one in the background. The standby is only kept while the active and
+    standby browsers together fit in the configured memory budget.
+    """
+
+    def __init__(self, build_gen: Callable, get_active_gen: Callable,
+                 enabled: Optional[bool] = None, memory_budget_mb: Optional[int] = None):
+        self.build_gen = build_gen
+        self.get_active_gen = get_active_gen
+        self.enabled = enabled if enabled is not None else os.getenv('GEN_WARM_SPARE', '0') == '1'
+        # Combined RSS allowed for active + standby browsers; 0 disables the check
+        self.memory_budget_mb = memory_budget_mb if memory_budget_mb is not None else int(os.getenv('GEN_SPARE_MEMORY_BUDGET_MB', 900))
+        self._lock = threading.Lock()
+        self._spare = None
+        self._building = False
+
+        # Metrics
+        self.builds = 0
+        self.failed_builds = 0
+        self.over_budget = 0
+        self.swaps = 0
+        self.stale_spares = 0
+        self.last_build_seconds = None
+        self.spare_rss_bytes = None
+        logger.info(f"Warm spare {'enabled' if self.enabled else 'disabled'} (budget={self.memory_budget_mb}MB)")
+
+    def start(self):
+        """Build the first standby in the background"""
+        if self.enabled:
+            self._build_in_background()
+
+    def _build_in_background(self):
+        with self._lock:
+            if self._building or self._spare is not None:
+                return
+            self._building = True
+        threading.Thread(target=self._build, name='gen-warm-spare', daemon=True).start()
+
+    def _build(self):
+        started = time.time()
+        spare = None
+        try:
+            spare = self.build_gen()
+            if not spare.is_ready():
+                logger.error("Warm spare failed to initialize")
+                self._discard(spare)
+                with self._lock:
+                    self.failed_builds += 1
+                return
+
+            spare_rss = spare.measure_rss() or 0
+            if self.memory_budget_mb:
+                active = self.get_active_gen()
+                active_rss = (active.measure_rss() or 0) if active is not None else 0
+                if spare_rss + active_rss > self.memory_budget_mb * 1024 * 1024:
+                    logger.warning(f"Warm spare exceeds memory budget "
+                                   f"({(spare_rss + active_rss) / (1024 * 1024):.0f}MB > {self.memory_budget_mb}MB), discarding")
+                    self._discard(spare)
+                    with self._lock:
+                        self.over_budget += 1
+                    return
+
+            with self._lock:
+                self._spare = spare
+                self.builds += 1
+                self.spare_rss_bytes = spare_rss
+                self.last_build_seconds = time.time() - started
+            logger.info(f"Warm spare ready in {time.time() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Error building warm spare: {e}")
+            self._discard(spare)
+            with self._lock:
+                self.failed_builds += 1
+        finally:
+            with self._lock:
+                self._building = False
+
+    def ready(self) -> bool:
+        """Whether a standby is waiting to be taken"""
+        with self._lock:
+            return self._spare is not None
+
+    def take(self):
+        """Return the ready standby (or None) and start building its replacement"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            spare, self._spare = self._spare, None
+            self.spare_rss_bytes = None
+
+        if spare is not None and not spare.probe()['ok']:
+            logger.warning("Warm spare failed its probe, discarding")
+            self._discard(spare)
+            with self._lock:
+                self.stale_spares += 1
+            spare = None
+
+        if spare is not None:
+            with self._lock:
+                self.swaps += 1
+            logger.info("Swapping in warm spare")
+        self._build_in_background()
+        return spare
+
+    def shutdown(self):
+        with self._lock:
+            spare, self._spare = self._spare, None
+        self._discard(spare)
+
+    @staticmethod
+    def _discard(gen):
+        if gen is not None:
+            try:
+                gen.close()
+            except Exception as e:
+                logger.error(f"Error closing browser: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'ready': self._spare is not None,
+                'building': self._building,
+                'memory_budget_mb': self.memory_budget_mb,
+                'spare_rss_mb': round(self.spare_rss_bytes / (1024 * 1024), 1) if self.spare_rss_bytes else None,
+                'builds': self.builds,
+                'failed_builds': self.failed_builds,
+                'over_budget': self.over_budget,
+                'stale_spares': self.stale_spares,
+                'swaps': self.swaps,
+                'last_build_seconds': round(self.last_build_seconds, 1) if self.last_build_seconds is not None else None
+            }
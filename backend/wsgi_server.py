@@ -0,0 +1,128 @@
+# Production WSGI runner for final_server.
+#
+# Serves the Flask app with gunicorn's threaded (gthread) worker instead of the
+# Werkzeug development server. Each in-flight generation holds one thread for up
+# to GENERATION_TIMEOUT seconds, so WSGI_THREADS bounds concurrent generations.
+#
+# GEN_PLACEMENT controls where the Gen browser is started:
+#   master  - (default) the app is preloaded, so Gen/Chrome is built once in the
+#             gunicorn master before forking. A recycled or crashed worker gets
+#             the same browser back without a cold start, unless an earlier
+#             worker already replaced and quit it; then the new worker probes
+#             the inherited browser and builds its own. Only one worker is
+#             allowed, because the job queue and gen_lock live in that process.
+#   worker  - every worker imports the app after forking and builds its own Gen,
+#             i.e. WSGI_WORKERS browsers per server.
+#
+# gunicorn doesn't run on Windows. There, this script runs final_server as if it
+# were started directly (Werkzeug's threaded server, one process, one browser),
+# so the PM2 config and the .bat scripts work on both platforms.
+#
+# Run with:  python wsgi_server.py
+import os
+import sys
+import runpy
+
+try:
+    from gunicorn.app.base import BaseApplication
+    HAS_GUNICORN = True
+except ImportError:
+    # Windows: gunicorn needs fcntl
+    BaseApplication = object
+    HAS_GUNICORN = False
+
+PORT = int(os.getenv('PORT', 5000))
+WORKER_ID = os.getenv('WORKER_ID', 'worker-1')
+GENERATION_TIMEOUT = int(os.getenv('GENERATION_TIMEOUT', 60))
+
+GEN_PLACEMENT = os.getenv('GEN_PLACEMENT', 'master')
+WSGI_WORKERS = int(os.getenv('WSGI_WORKERS', 1))
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', 32))
+WSGI_MAX_REQUESTS = int(os.getenv('WSGI_MAX_REQUESTS', 0))
+
+
+class FinalServerApplication(BaseApplication):
+    def __init__(self, options=None):
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key.lower(), value)
+
+    def load(self):
+        # Imported here so the Gen is built wherever gunicorn loads the app:
+        # in the master when preloading, otherwise in each forked worker
+        from final_server import app
+        return app
+
+
+def post_worker_init(worker):
+    """Start the job thread inside the worker; threads don't survive fork"""
+    import final_server
+    final_server.start_gen_worker()
+
+
+def quit_gen_browser(owner_pid):
+    """Quit the active browser if the process owner_pid built it"""
+    final_server = sys.modules.get('final_server')
+    gen = getattr(final_server, 'gen', None)
+    if gen is not None and gen.owner_pid == owner_pid:
+        try:
+            gen.close()
+            print(f"Worker {WORKER_ID}: Gen browser closed")
+        except Exception as e:
+            print(f"Worker {WORKER_ID}: Error closing Gen browser: {e}")
+
+
+def worker_exit(server, worker):
+    # The warm spare is always built inside the worker, after forking
+    final_server = sys.modules.get('final_server')
+    if final_server is not None:
+        final_server.warm_spare.shutdown()
+    # A browser this worker built (per-worker placement, or a recycled or warm
+    # spare replacement of the master's) exits with it; the master's stays
+    quit_gen_browser(os.getpid())
+
+
+def on_exit(server):
+    # With master placement the browser outlives individual workers
+    quit_gen_browser(os.getpid())
+
+
+def build_options():
+    workers = WSGI_WORKERS
+    if GEN_PLACEMENT not in ('master', 'worker'):
+        raise ValueError(f"GEN_PLACEMENT must be 'master' or 'worker', got {GEN_PLACEMENT!r}")
+    if GEN_PLACEMENT == 'master' and workers > 1:
+        print(f"GEN_PLACEMENT=master drives a single browser from one worker; ignoring WSGI_WORKERS={workers}")
+        workers = 1
+
+    return {
+        'bind': f'0.0.0.0:{PORT}',
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': WSGI_THREADS,
+        'preload_app': GEN_PLACEMENT == 'master',
+        # A request may legitimately wait GENERATION_TIMEOUT for its job; give
+        # in-flight generations that long (plus margin) to finish on reload
+        'timeout': GENERATION_TIMEOUT + 30,
+        'graceful_timeout': GENERATION_TIMEOUT + 15,
+        'keepalive': 5,
+        'max_requests': WSGI_MAX_REQUESTS,
+        'max_requests_jitter': WSGI_MAX_REQUESTS // 10,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+        'on_exit': on_exit,
+    }
+
+
+if __name__ == '__main__':
+    if not HAS_GUNICORN:
+        print(f"gunicorn is not available on this platform; running final_server directly for worker {WORKER_ID}")
+        runpy.run_module('final_server', run_name='__main__')
+        sys.exit(0)
+    options = build_options()
+    print(f"Starting gunicorn for worker {WORKER_ID} on port {PORT} "
+          f"({options['workers']} worker(s) x {WSGI_THREADS} threads, Gen placement: {GEN_PLACEMENT})")
+    FinalServerApplication(options).run()
@@ -3,7 +3,7 @@ module.exports = {
         {
             name: 'genapp-server-1',
             script: 'python',
-            args: 'server.py',
+            args: 'wsgi_server.py',
             cwd: './backend',
             instances: 1,
             autorestart: true,
@@ -13,7 +13,8 @@ module.exports = {
                 PORT: 5001,
                 WORKER_ID: 'worker-1',
                 GEN_POOL_SIZE: 3,
-                FLASK_ENV: 'production'
+                FLASK_ENV: 'production',
+                SHARED_TOKEN_STORE: 1
             },
             error_file: './logs/genapp-server-1-error.log',
             out_file: './logs/genapp-server-1-out.log',
@@ -23,7 +24,7 @@ module.exports = {
         {
             name: 'genapp-server-2',
             script: 'python',
-            args: 'server.py',
+            args: 'wsgi_server.py',
             cwd: './backend',
             instances: 1,
             autorestart: true,
@@ -33,7 +34,8 @@ module.exports = {
                 PORT: 5002,
                 WORKER_ID: 'worker-2',
                 GEN_POOL_SIZE: 3,
-                FLASK_ENV: 'production'
+                FLASK_ENV: 'production',
+                SHARED_TOKEN_STORE: 1
             },
             error_file: './logs/genapp-server-2-error.log',
             out_file: './logs/genapp-server-2-out.log',
@@ -43,7 +45,7 @@ module.exports = {
         {
             name: 'genapp-server-3',
             script: 'python',
-            args: 'server.py',
+            args: 'wsgi_server.py',
             cwd: './backend',
             instances: 1,
             autorestart: true,
@@ -53,7 +55,8 @@ module.exports = {
                 PORT: 5003,
                 WORKER_ID: 'worker-3',
                 GEN_POOL_SIZE: 3,
-                FLASK_ENV: 'production'
+                FLASK_ENV: 'production',
+                SHARED_TOKEN_STORE: 1
             },
             error_file: './logs/genapp-server-3-error.log',
             out_file: './logs/genapp-server-3-out.log',
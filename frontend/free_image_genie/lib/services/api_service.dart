@@ -58,12 +58,16 @@ class ApiService {
     String method,
     String endpoint, {
     Map<String, dynamic>? body,
+    Map<String, String>? extraHeaders,
   }) async {
     final baseUrl = _baseUrl; // Get random worker URL
     final url = Uri.parse('$baseUrl$endpoint');
 
     // First attempt with current token
-    Map<String, String> headers = await _getAuthHeaders(context);
+    Map<String, String> headers = {
+      ...await _getAuthHeaders(context),
+      ...?extraHeaders,
+    };
 
     http.Response response;
     if (method.toUpperCase() == 'GET') {
@@ -83,7 +87,7 @@ class ApiService {
       final refreshed = await _refreshTokenIfNeeded(context);
       if (refreshed) {
         // Retry with new token
-        headers = await _getAuthHeaders(context);
+        headers = {...await _getAuthHeaders(context), ...?extraHeaders};
         if (method.toUpperCase() == 'GET') {
           response = await http.get(url, headers: headers);
         } else {
@@ -102,23 +106,55 @@ class ApiService {
     return response;
   }
 
-  /// Generate an image using the backend API
+  /// Random key so the server can recognise retries of the same generation
+  static String _newIdempotencyKey() {
+    final secureRandom = Random.secure();
+    return List.generate(
+      16,
+      (_) => secureRandom.nextInt(256).toRadixString(16).padLeft(2, '0'),
+    ).join();
+  }
+
+  /// Attempts per generation, all sent with the same Idempotency-Key
+  static const int _generateAttempts = 3;
+  static const Duration _generateTimeout = Duration(seconds: 90);
+  static const Duration _generateRetryDelay = Duration(seconds: 2);
+
+  /// Generate an image using the backend API.
+  ///
+  /// One Idempotency-Key is created per call (one user action) and reused when
+  /// the request times out, fails on the network or gets a 202/5xx, so the
+  /// server answers retries with the original outcome instead of charging again.
   static Future<Map<String, dynamic>?> generateImage({
     required BuildContext context,
     required String prompt,
     required String style,
+    String? idempotencyKey,
   }) async {
-    try {
-      final requestBody = {'prompt': prompt, 'style': style};
-
-      AppLogger.info('Calling API: /api/generate with body: $requestBody');
+    final key = idempotencyKey ?? _newIdempotencyKey();
+    final requestBody = {'prompt': prompt, 'style': style};
 
-      final response = await _makeAuthenticatedRequest(
-        context,
-        'POST',
-        '/api/generate',
-        body: requestBody,
-      );
+    for (var attempt = 1; ; attempt++) {
+      http.Response response;
+      try {
+        AppLogger.info(
+          'Calling API: /api/generate with body: $requestBody (attempt $attempt)',
+        );
+        response = await _makeAuthenticatedRequest(
+          context,
+          'POST',
+          '/api/generate',
+          body: requestBody,
+          extraHeaders: {'Idempotency-Key': key},
+        ).timeout(_generateTimeout);
+      } catch (e) {
+        AppLogger.error('Network error calling generate API: $e');
+        if (attempt < _generateAttempts) {
+          await Future.delayed(_generateRetryDelay);
+          continue;
+        }
+        throw Exception('Network error: $e');
+      }
 
       AppLogger.info('API Response status: ${response.statusCode}');
 
@@ -126,14 +162,25 @@ class ApiService {
         final responseData = jsonDecode(response.body);
         AppLogger.info('API Response: Image generated successfully');
         return responseData;
-      } else {
-        final errorData = jsonDecode(response.body);
-        AppLogger.error('API Error: ${errorData['message']}');
-        throw Exception('API Error: ${errorData['message']}');
       }
-    } catch (e) {
-      AppLogger.error('Network error calling generate API: $e');
-      throw Exception('Network error: $e');
+
+      // 202: the first attempt is still running; 5xx: it failed or timed out
+      final retryable =
+          response.statusCode == 202 || response.statusCode >= 500;
+      if (retryable && attempt < _generateAttempts) {
+        AppLogger.info('Retrying generation with the same Idempotency-Key');
+        await Future.delayed(_generateRetryDelay);
+        continue;
+      }
+
+      String? message;
+      try {
+        message = jsonDecode(response.body)['message'];
+      } catch (_) {
+        message = 'HTTP ${response.statusCode}';
+      }
+      AppLogger.error('API Error: $message');
+      throw Exception('API Error: $message');
     }
   }
 